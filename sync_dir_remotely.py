@@ -13,20 +13,48 @@
 # Imports
 #########################################################
 import argparse
-import base64
+import atexit
+import binascii
+import collections
 import copy # copy.deepcopy(x)
+import ctypes
+import ctypes.util
 import datetime
+import errno
 import getpass
 import hashlib
 import json
+import math
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
+import Queue
 import re
+import select
 import socket
+import stat
 import struct
 import sys
 import threading
 import time
+import zlib
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 
 
@@ -40,8 +68,9 @@ def parse_args():
       '--mode',
       required=True,
       type=str,
-      choices=('remote', 'local'),
-      help='Mode to run this script in.',
+      choices=('remote', 'local', 'stats'),
+      help=('Mode to run this script in. [stats] prints the metrics of the '
+          'remote server.'),
   )
 
   parser.add_argument(
@@ -95,6 +124,155 @@ def parse_args():
       help='Token used to sign network messages.',
   )
 
+  parser.add_argument(
+      '--monitor',
+      type=str,
+      default=MONITOR_AUTO,
+      choices=(MONITOR_AUTO, MONITOR_INOTIFY, MONITOR_POLL),
+      help=('How to watch the dirs for changes. [{}] uses inotify when the '
+          'platform supports it and polls otherwise.').format(MONITOR_AUTO),
+  )
+
+  parser.add_argument(
+      '--exclude',
+      type=str,
+      action='append',
+      default=[],
+      help=('Regex of relative paths not to sync, matched from their start. '
+          'Dirs are matched with a trailing separator and excluded dirs are '
+          'never crawled. May be given many times.'),
+  )
+
+  parser.add_argument(
+      '--gitignore',
+      action='store_true',
+      help=('Also exclude what the .gitignore files found in the dirs ignore, '
+          'along with .git dirs.'),
+  )
+
+  parser.add_argument(
+      '--lazy_hash',
+      action='store_true',
+      help=('Compare files by size and mtime and only hash them when those '
+          'disagree. Dedup and moves only use files that were hashed.'),
+  )
+
+  parser.add_argument(
+      '--hash_workers',
+      type=int,
+      default=min(MAX_DEFAULT_HASH_WORKERS, multiprocessing.cpu_count()),
+      help='Number of workers hashing file contents in parallel.',
+  )
+
+  parser.add_argument(
+      '--hash_pool',
+      type=str,
+      default=HASH_POOL_THREAD,
+      choices=(HASH_POOL_THREAD, HASH_POOL_PROCESS),
+      help='Whether the hashing workers are threads or processes.',
+  )
+
+  parser.add_argument(
+      '--hash',
+      type=str,
+      default=HASH_AUTO,
+      choices=(HASH_AUTO,) + ContentHash.available(),
+      help=('Content hash algorithm. [{}] reuses the one in the index or '
+          'else picks the fastest one. The server algorithm always wins when '
+          'the client connects.').format(HASH_AUTO),
+  )
+
+  parser.add_argument(
+      '--dedup',
+      type=str,
+      default=DEDUP_COPY,
+      choices=(DEDUP_OFF, DEDUP_COPY, DEDUP_HARDLINK),
+      help=('How the server materialises files whose contents it already '
+          'has under another path instead of having them uploaded. '
+          '[{}] shares the inode, so only use it if files are never edited '
+          'in place on the server.').format(DEDUP_HARDLINK),
+  )
+
+  parser.add_argument(
+      '--write_workers',
+      type=int,
+      default=DEFAULT_WRITE_WORKERS,
+      help='Number of threads the server writes uploaded files with.',
+  )
+
+  parser.add_argument(
+      '--durability',
+      type=str,
+      default=DURABILITY_BATCH,
+      choices=(DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_FILE),
+      help=('When the server fsyncs uploaded files. [{}] leaves it to the OS, '
+          '[{}] syncs each upload batch before renaming it into place and '
+          '[{}] syncs every file as soon as it is written.').format(
+              DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_FILE),
+  )
+
+  parser.add_argument(
+      '--compression',
+      type=str,
+      default=COMPRESSION_ZLIB,
+      choices=StreamCompression.available(),
+      help=('Compression the client asks for when uploading. Files that do '
+          'not compress well are always sent as they are.'),
+  )
+
+  parser.add_argument(
+      '--compression_level',
+      type=int,
+      default=6,
+      help='Compression level. Lower is faster, higher sends fewer bytes.',
+  )
+
+  parser.add_argument(
+      '--upload_batch_bytes',
+      type=int,
+      default=16 * 1024 * 1024,
+      help='Maximum bytes of file contents in each upload batch.',
+  )
+
+  parser.add_argument(
+      '--upload_window',
+      type=int,
+      default=4,
+      help='Number of upload batches in flight before waiting for an ack.',
+  )
+
+  parser.add_argument(
+      '--sync_debounce_secs',
+      type=float,
+      default=DEFAULT_SYNC_DEBOUNCE_SECS,
+      help=('Changes are uploaded once the dirs were quiet for this long, so '
+          'bursts of writes are synced together. Syncs are delayed by at '
+          'most [{}] secs.').format(SYNC_MAX_DELAY_SECS),
+  )
+
+  parser.add_argument(
+      '--index_dir',
+      type=str,
+      default=DEFAULT_INDEX_DIR,
+      help=('Dir where the hash index of each synced dir is persisted across '
+          'restarts. Pass an empty string to disable it.'),
+  )
+
+  parser.add_argument(
+      '--metrics_file',
+      type=str,
+      default='',
+      help=('If set, the metrics are periodically written to this file in '
+          'the Prometheus text format.'),
+  )
+
+  parser.add_argument(
+      '--metrics_interval_secs',
+      type=float,
+      default=15.0,
+      help='How often the metrics file is rewritten.',
+  )
+
   parser.add_argument(
       '-i',
       '--ip_version',
@@ -115,6 +293,25 @@ def md5(*args):
   return md5_hash.hexdigest()
 
 
+def hash_path(path_and_algorithm):
+  '''Returns a tuple (abs_path, digest) where digest is None if unreadable.
+
+  Lives at module level so process pools can pickle it.
+  '''
+  abs_path, algorithm = path_and_algorithm
+  try:
+    return (abs_path, ContentHash.hash_file(abs_path, algorithm))
+  except (IOError, OSError):
+    return (abs_path, None)
+
+
+def as_buffer(data):
+  '''Returns a read-only view of [data] that every C module accepts.'''
+  if isinstance(data, bytearray):
+    return buffer(data)
+  return data
+
+
 def read_token(args_token):
   prompt_msg = 'Please type the token for the communication: '
   if args_token:
@@ -146,34 +343,211 @@ def create_socket(ip_version):
 # Common Classes
 #########################################################
 class Logger(object):
+  '''Logs [msg].format(*args) lines through a background LogWriter.
+
+  Pass the arguments instead of formatting the message at the call site, so
+  disabled levels cost a single comparison.
+  '''
   LEVEL = 3
+  _writer = None
+  _writer_lock = threading.Lock()
 
   def __init__(self, log_name):
     self._name = log_name
 
-  def debug(self, msg):
-    self._log(3, msg)
+  @staticmethod
+  def is_enabled(level):
+    return level <= Logger.LEVEL
+
+  @staticmethod
+  def flush():
+    '''Waits until every line logged so far was written.'''
+    if Logger._writer:
+      Logger._writer.flush()
 
-  def info(self, msg):
-    self._log(2, msg)
+  def debug(self, msg, *args):
+    if 3 <= Logger.LEVEL:
+      self._log(3, msg, args)
 
-  def warn(self, msg):
-    self._log(1, msg)
+  def info(self, msg, *args):
+    if 2 <= Logger.LEVEL:
+      self._log(2, msg, args)
 
-  def error(self, msg):
-    self._log(0, msg)
+  def warn(self, msg, *args):
+    if 1 <= Logger.LEVEL:
+      self._log(1, msg, args)
 
-  def _log(self, level, msg):
-    if level > Logger.LEVEL:
-      return
+  def error(self, msg, *args):
+    if 0 <= Logger.LEVEL:
+      self._log(0, msg, args)
+
+  def _log(self, level, msg, args):
+    if args:
+      msg = msg.format(*args)
+    if Logger._writer is None:
+      with Logger._writer_lock:
+        if Logger._writer is None:
+          Logger._writer = LogWriter()
+    Logger._writer.write((level, time.time(), self._name, msg))
+
+
+class LogWriter(object):
+  '''Writes log records to stdout from a thread of its own.
+
+  The queue is bounded so a burst of logging slows the callers down instead
+  of growing without limit. Stdout is flushed whenever the queue drains.
+  '''
+
+  def __init__(self, max_records=None):
+    self._queue = Queue.Queue(max_records or LOG_QUEUE_RECORDS)
+    self._thread = threading.Thread(target=self._thread_main,
+        name='LogWriterThread')
+    self._thread.daemon = True
+    self._thread.start()
+    atexit.register(self.flush)
+
+  def write(self, record):
+    self._queue.put(record)
+
+  def flush(self, timeout_secs=None):
+    deadline = time.time() + (timeout_secs or LOG_FLUSH_TIMEOUT_SECS)
+    while self._queue.unfinished_tasks and time.time() < deadline:
+      time.sleep(0.001)
+
+  def _thread_main(self):
+    while True:
+      records = [self._queue.get()]
+      while True:
+        try:
+          records.append(self._queue.get_nowait())
+        except Queue.Empty:
+          break
+      stream = sys.stdout
+      for level, ts, name, msg in records:
+        ts = datetime.datetime.fromtimestamp(ts) \
+            .strftime('%Y-%m-%d %H:%M:%S.%f')
+        if level >= 0 and level < len(LOG_LEVELS):
+          level = LOG_LEVELS[level].upper()[0]
+        stream.write('[{}][{}]<{}> {}\n'.format(level, ts, name, msg))
+      stream.flush()
+      for record in records:
+        self._queue.task_done()
+
+
+class Histogram(object):
+  '''Counts observed values into cumulative upper-bound buckets.'''
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * len(buckets)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    for i in range(len(self.buckets)):
+      if value <= self.buckets[i]:
+        self.counts[i] += 1
+        break
+    self.count += 1
+    self.sum += value
+
+  def snapshot(self):
+    cumulative = []
+    total = 0
+    for i in range(len(self.buckets)):
+      total += self.counts[i]
+      cumulative.append([self.buckets[i], total])
+    return {'buckets': cumulative, 'count': self.count, 'sum': self.sum}
+
+
+class MetricsTimer(object):
+  '''Observes the seconds spent in a with block into a histogram.'''
+
+  def __init__(self, metrics, name):
+    self._metrics = metrics
+    self._name = name
+
+  def __enter__(self):
+    self._start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self._metrics.observe(self._name, time.time() - self._start)
+
+
+class Metrics(object):
+  '''Process wide registry of counters and latency histograms.'''
 
-    ts = datetime.datetime.fromtimestamp(time.time()) \
-        .strftime('%Y-%m-%d %H:%M:%S.%f')
-    if level >= 0 and level < len(LOG_LEVELS):
-      level = LOG_LEVELS[level].upper()[0]
-    stream = sys.stdout
-    stream.write('[{}][{}]<{}> {}\n'.format(level, ts, self._name, msg))
-    stream.flush()
+  def __init__(self):
+    self.log = Logger(type(self).__name__)
+    self._lock = threading.Lock()
+    self._counters = {}
+    self._histograms = {}
+    self._thread = None
+
+  def increment(self, name, value=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + value
+
+  def observe(self, name, value):
+    with self._lock:
+      histogram = self._histograms.get(name)
+      if histogram is None:
+        histogram = Histogram(METRICS_LATENCY_BUCKETS_SECS)
+        self._histograms[name] = histogram
+      histogram.observe(value)
+
+  def timer(self, name):
+    return MetricsTimer(self, name)
+
+  def snapshot(self):
+    '''Returns a JSON friendly copy of every counter and histogram.'''
+    with self._lock:
+      return {
+        'counters': dict(self._counters),
+        'histograms': dict((name, histogram.snapshot())
+            for name, histogram in self._histograms.items()),
+      }
+
+  def to_prometheus(self):
+    '''Returns the snapshot() in the Prometheus text exposition format.'''
+    snapshot = self.snapshot()
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+      name = METRICS_PREFIX + name
+      lines.append('# TYPE {} counter'.format(name))
+      lines.append('{} {}'.format(name, value))
+    for name, histogram in sorted(snapshot['histograms'].items()):
+      name = METRICS_PREFIX + name
+      lines.append('# TYPE {} histogram'.format(name))
+      for bucket, count in histogram['buckets']:
+        lines.append('{}_bucket{{le="{}"}} {}'.format(name, bucket, count))
+      lines.append('{}_bucket{{le="+Inf"}} {}'.format(
+          name, histogram['count']))
+      lines.append('{}_sum {}'.format(name, histogram['sum']))
+      lines.append('{}_count {}'.format(name, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self, path):
+    '''Atomically replaces [path] with to_prometheus().'''
+    tmp_path = path + TMP_FILE_SUFFIX
+    with open(tmp_path, 'w') as fp:
+      fp.write(self.to_prometheus())
+    os.rename(tmp_path, path)
+
+  def start_dumping(self, path, interval_secs):
+    '''Writes the metrics to [path] every [interval_secs] in background.'''
+    def dump_main():
+      while True:
+        time.sleep(interval_secs)
+        try:
+          self.write_prometheus(path)
+        except (IOError, OSError) as exception:
+          self.log.warn('Failed to write metrics to [{}] with [{}].', path,
+              exception)
+    self._thread = threading.Thread(target=dump_main, name='MetricsThread')
+    self._thread.daemon = True
+    self._thread.start()
 
 
 class HumaReadbleException(Exception):
@@ -182,6 +556,10 @@ class HumaReadbleException(Exception):
     self.msg = msg
 
 
+class SkippedFileException(Exception):
+  '''Raised by StreamHandler.recvChunks() for a file the sender skipped.'''
+
+
 class AutoShutdown(object):
   def __init__(self, seconds):
     self.log = Logger(type(self).__name__)
@@ -192,6 +570,7 @@ class AutoShutdown(object):
         'The program is exiting.'.format(self._seconds))
     self.log.error(msg)
     print(msg)
+    Logger.flush()
     # Pretty lazy/dirty/ugly way of doing this.
     os._exit(42)
 
@@ -209,37 +588,53 @@ class StreamHandler(object):
   def __init__(self, token, socket):
     self.log = Logger(type(self).__name__)
     self._socket = socket
-    self._buffer = ''
     self._serde = MessageSerde(token)
+    # Bytes sent through this handler only; METRICS counts every handler.
+    self.sent_bytes = 0
 
   def __enter__(self):
     self.log.debug('Entering...')
     return self
 
-  def recvMessage(self):
+  def recvMessage(self, idle_timeout_secs=None):
+    '''Receives the next message.
+
+    If given, [idle_timeout_secs] replaces the socket timeout while no byte
+    of the message has arrived yet.
+    '''
     self.log.debug('Receiving message...')
-    while True:
-      data = self._socket.recv(BUFFER_SIZE_BYTES)
-      datal = len(data)
+    if idle_timeout_secs is None:
+      header = self._recv_exactly(MessageSerde.HEADER.size)
+    else:
+      timeout_secs = self._socket.gettimeout()
+      self._socket.settimeout(idle_timeout_secs)
+      try:
+        header = self._recv_exactly(1)
+      finally:
+        self._socket.settimeout(timeout_secs)
+      header += self._recv_exactly(MessageSerde.HEADER.size - 1)
+    msg_type, body_md5, body_bytes = self._serde.parse_header(header)
+    body = self._recv_exactly(body_bytes)
+    METRICS.increment('bytes_received', len(header) + body_bytes)
+    message = self._serde.decode_body(msg_type, body_md5, body)
+    self.log.debug('Received message_type=[{}] body_bytes=[{}].',
+        message.type_str(), body_bytes)
+    return message
+
+  def _recv_exactly(self, size):
+    '''Returns a bytearray of [size] bytes received in place.'''
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+      datal = self._socket.recv_into(
+          view[received:], min(size - received, BUFFER_SIZE_BYTES))
       if datal == 0:
         msg = 'Remote client disconnected.'
         self.log.debug(msg)
         raise socket.error(msg)
-      elif datal > 0:
-        self.log.debug('Received [{}] bytes.'.format(datal))
-        self._buffer += data
-        message, unused = self._serde.deserialise(self._buffer)
-        unused_bytes = len(unused)
-        used_bytes = len(self._buffer) - unused_bytes
-        self._buffer = unused
-        if message == None:
-          continue
-        self.log.debug(
-            'Received message_type=[{}] used_bytes=[{}] unused_bytes=[{}].'\
-                .format(message.type_str(), used_bytes, unused_bytes))
-        return message
-      else:
-        assert False, 'Should never get here!!! recv_bytes=[{}]'.format(datal)
+      received += datal
+    return data
 
   def __exit__(self, exc_type, exc_value, traceback):
     self.log.debug('Exiting...')
@@ -249,9 +644,75 @@ class StreamHandler(object):
 
   def sendMessage(self, message):
     data = self._serde.serialise(message)
-    self.log.debug('Sending message of type [{}] and size [{}] bytes...'\
-        .format(message.type_str(), len(data)))
+    self.log.debug('Sending message of type [{}] and size [{}] bytes...',
+        message.type_str(), len(data))
     self._socket.sendall(data)
+    METRICS.increment('bytes_sent', len(data))
+    self.sent_bytes += len(data)
+
+  def sendChunk(self, data):
+    '''Sends [data] as a single FILE_CHUNK frame without copying it.'''
+    with METRICS.timer('serialise_seconds'):
+      header = self._serde.serialise_header(MessageType.FILE_CHUNK, data)
+    self._socket.sendall(header)
+    if data:
+      self._socket.sendall(data)
+    METRICS.increment('bytes_sent', len(header) + len(data))
+    self.sent_bytes += len(header) + len(data)
+
+  def sendSkip(self):
+    '''Sends a FILE_SKIP frame in place of the chunks of a file.'''
+    header = self._serde.serialise_header(MessageType.FILE_SKIP, b'')
+    self._socket.sendall(header)
+    METRICS.increment('bytes_sent', len(header))
+    self.sent_bytes += len(header)
+
+  def sendFile(self, fp):
+    '''Streams [fp] as FILE_CHUNK frames ended by an empty one.
+
+    Returns the total number of content bytes sent.
+    '''
+    return self.sendChunks(iter(lambda: fp.read(CHUNK_SIZE_BYTES), b''))
+
+  def sendChunks(self, pieces):
+    '''Streams [pieces] coalesced into FILE_CHUNK frames.
+
+    Returns the total number of content bytes sent.
+    '''
+    total_bytes = 0
+    pending = []
+    pending_bytes = 0
+    for data in pieces:
+      pending.append(data)
+      pending_bytes += len(data)
+      if pending_bytes >= CHUNK_SIZE_BYTES:
+        self.sendChunk(b''.join(pending))
+        total_bytes += pending_bytes
+        pending = []
+        pending_bytes = 0
+    if pending_bytes:
+      self.sendChunk(b''.join(pending))
+      total_bytes += pending_bytes
+    self.sendChunk(b'')
+    return total_bytes
+
+  def recvChunks(self):
+    '''Yields FILE_CHUNK payloads until the empty terminating chunk.
+
+    Raises SkippedFileException if the sender skipped the file instead.
+    '''
+    while True:
+      message = self.recvMessage()
+      if message.type == MessageType.FILE_SKIP:
+        raise SkippedFileException()
+      if message.type != MessageType.FILE_CHUNK:
+        err = 'Expected a FILE_CHUNK frame but received [{}].'.format(
+            message.type_str())
+        self.log.error(err)
+        raise HumaReadbleException(err)
+      if not message.payload:
+        return
+      yield message.payload
 
 
 class MessageType(object):
@@ -262,6 +723,16 @@ class MessageType(object):
   DIFF_RESPONSE = 3
   UPLOAD_REQUEST = 4
   UPLOAD_RESPONSE = 5
+  SIGNATURE_REQUEST = 6
+  SIGNATURE_RESPONSE = 7
+  RENAME_REQUEST = 8
+  RENAME_RESPONSE = 9
+  STATS_REQUEST = 10
+  STATS_RESPONSE = 11
+  # Raw binary frames streamed after a request. Never answered on their own.
+  FILE_CHUNK = 100
+  # Sent instead of the FILE_CHUNK frames of a file that could not be read.
+  FILE_SKIP = 101
 
   @staticmethod
   def to_str(type_int):
@@ -278,6 +749,22 @@ class MessageType(object):
       return 'UPLOAD_REQUEST'
     elif type_int == MessageType.UPLOAD_RESPONSE:
       return 'UPLOAD_RESPONSE'
+    elif type_int == MessageType.SIGNATURE_REQUEST:
+      return 'SIGNATURE_REQUEST'
+    elif type_int == MessageType.SIGNATURE_RESPONSE:
+      return 'SIGNATURE_RESPONSE'
+    elif type_int == MessageType.RENAME_REQUEST:
+      return 'RENAME_REQUEST'
+    elif type_int == MessageType.RENAME_RESPONSE:
+      return 'RENAME_RESPONSE'
+    elif type_int == MessageType.STATS_REQUEST:
+      return 'STATS_REQUEST'
+    elif type_int == MessageType.STATS_RESPONSE:
+      return 'STATS_RESPONSE'
+    elif type_int == MessageType.FILE_CHUNK:
+      return 'FILE_CHUNK'
+    elif type_int == MessageType.FILE_SKIP:
+      return 'FILE_SKIP'
     else:
       return 'UNKNOWN'
 
@@ -291,6 +778,8 @@ class Message(object):
     self.type = message_type
     self.body = {}
     self.body['ts'] = time.time()
+    # Raw bytes carried instead of the json body by FILE_CHUNK frames.
+    self.payload = None
 
   def __str__(self):
     return 'Message(type=[{}] body=[{}])'\
@@ -301,311 +790,3094 @@ class Message(object):
 
 
 class MessageSerde(object):
+  HEADER = struct.Struct('>i32si')
+
   def __init__(self, token):
     self.log = Logger(type(self).__name__)
     self._token = token
 
   def serialise(self, message):
     """ Returns a list of bytes containing the serialised msg """
-    json_body = json.dumps(message.body)
-    body_md5 = self._md5(json_body)
-    body_bytes = len(json_body)
-    header = struct.pack('>i32si', message.type, body_md5, body_bytes)
-    return header + json_body
+    with METRICS.timer('serialise_seconds'):
+      if message.type == MessageType.FILE_CHUNK:
+        body = message.payload
+      else:
+        body = json.dumps(message.body)
+      return self.serialise_header(message.type, body) + body
+
+  def serialise_header(self, message_type, body):
+    """ Returns the signed header that must precede [body] on the wire """
+    body_md5 = self._md5(body)
+    return MessageSerde.HEADER.pack(message_type, body_md5, len(body))
 
   def deserialise(self, input):
     """ Returns a tuple (Message, UnusedBytesList) """
-    self.log.debug('Deserialising input of [{}] bytes...'.format(len(input)))
-    header_bytes = 4 + 32 + 4
+    self.log.debug('Deserialising input of [{}] bytes...', len(input))
+    header_bytes = MessageSerde.HEADER.size
     if len(input) < header_bytes:
       return (None, input)
-    msg_type, body_md5, body_bytes = \
-        struct.unpack('>i32si', input[0:header_bytes])
+    msg_type, body_md5, body_bytes = self.parse_header(input[0:header_bytes])
     total_bytes = header_bytes + body_bytes
     if len(input) < total_bytes:
       return (None, input)
-    json_body = input[header_bytes:total_bytes]
-    expected_md5 = self._md5(json_body)
+    message = self.decode_body(
+        msg_type, body_md5, input[header_bytes:total_bytes])
+    return (message, input[total_bytes:])
+
+  def parse_header(self, header):
+    """ Returns a tuple (msg_type, body_md5, body_bytes) """
+    msg_type, body_md5, body_bytes = MessageSerde.HEADER.unpack(header)
+    # Checked before the unsigned body is buffered, so a peer cannot make
+    # the receiver allocate arbitrary amounts of memory.
+    if body_bytes < 0 or body_bytes > MAX_FRAME_BYTES:
+      err = 'Server aborting! Invalid body_bytes=[{}]'.format(body_bytes)
+      self.log.error(err)
+      raise HumaReadbleException(err)
+    return (msg_type, body_md5, body_bytes)
+
+  def decode_body(self, msg_type, body_md5, body):
+    """ Returns the Message of a complete body after checking its md5 """
+    with METRICS.timer('deserialise_seconds'):
+      return self._decode_body(msg_type, body_md5, body)
+
+  def _decode_body(self, msg_type, body_md5, body):
+    expected_md5 = self._md5(body)
     if body_md5 != expected_md5:
       err = 'Server aborting! Expected_MD5=[{}] Actual_MD5=[{}]'\
           .format(expected_md5, body_md5)
       self.log.error(err)
       raise HumaReadbleException(err)
     message = Message(msg_type)
-    message.body.update(json.loads(json_body))
-    return (message, input[total_bytes:])
+    if msg_type in (MessageType.FILE_CHUNK, MessageType.FILE_SKIP):
+      message.payload = body
+    else:
+      message.body.update(json.loads(str(body)))
+    return message
 
   def _md5(self, data):
-    return md5(os.getenv('USER'), data, self._token)
+    return md5(os.getenv('USER', ''), data, self._token)
 
 
-class DirCrawler(object):
-  def __init__(self, root_dir, exclude_list=[]):
-    self.log = Logger(type(self).__name__)
-    self._dir = root_dir
-    self._dir = os.path.expanduser(self._dir)
-    self._dir = os.path.abspath(self._dir)
-    assert os.path.isdir(self._dir), \
-        'Argument root_dir [{}] => [{}] must exist.'.format(root_dir, self._dir)
-    self._excludes = [re.compile(pattern) for pattern in exclude_list]
-
-  def crawl(self):
-    '''Returns a list of relative paths of all files recursively.'''
-    self.log.debug('Starting to crawl [{}]...'.format(self._dir))
-    all_files = []
-    for root, dirs, files in os.walk(self._dir):
-      for f in files:
-        complete_path = os.path.join(root, f)
-        rel_path = os.path.relpath(complete_path, self._dir)
-        if not self._is_excluded(rel_path):
-          assert not os.path.isabs(rel_path), rel_path
-          all_files.append(rel_path)
-    self.log.debug(
-        'Crawl found a total of [{}] files...'.format(len(all_files)))
-    return all_files
+class ContentHash(object):
+  '''The content hash algorithms files can be compared with.
 
-  def crawl_and_hash(self, previous_results={}):
-    '''Returns a dict with keyed off file_rel_path with md5_hash information.
+  Every digest is truncated to DIGEST_HEX_CHARS so they are all the size of
+  an md5 hex digest on the wire and in the index.
+  '''
+  ALGORITHMS = ('blake2b', 'sha256', 'sha1', 'md5')
+  DIGEST_HEX_CHARS = 32
+  _fastest = None
 
-    Each dict key refers to the relative path of a file.
-    Each dict value contains a tuple with two elements:
-    1. Epoch modified time.
-    2. MD5 hash of the contents of the file.
-    '''
-    all_files = self.crawl()
-    self.log.debug('Computing the md5 hash for [{}] files...'\
-        .format(len(all_files)))
-    data = {}
-    computed_md5s = 0
-    reused_md5s = 0
-    for rel_path in all_files:
-      abs_path = os.path.join(self._dir, rel_path)
-      mtime = os.path.getmtime(abs_path)
-      if rel_path in previous_results and \
-          previous_results[rel_path][0] >= mtime:
-        reused_md5s += 1
-        data[rel_path] = previous_results[rel_path]
-      else:
-        md5 = DirCrawler.md5_hash(abs_path)
-        computed_md5s += 1
-        data[rel_path] = (mtime, md5)
-    self.log.info('Finished computing all [{}] md5s and reused [{}].'.format(
-        computed_md5s, reused_md5s))
-    return data
+  @staticmethod
+  def available():
+    return tuple(name for name in ContentHash.ALGORITHMS
+        if ContentHash.is_available(name))
 
   @staticmethod
-  def md5_hash(file_path):
-    md5_hash = hashlib.md5()
-    with open(file_path, "rb") as f:
-      for fragment in iter(lambda: f.read(BUFFER_SIZE_BYTES), b''):
-        md5_hash.update(fragment)
-    return md5_hash.hexdigest()
-
-  def _is_excluded(self, path):
-    for regex in self._excludes:
-      if None != regex.match(path):
-        # print path
-        return True
-    return False
+  def is_available(algorithm):
+    try:
+      ContentHash.new(algorithm)
+      return True
+    except (ValueError, AttributeError):
+      return False
 
+  @staticmethod
+  def new(algorithm):
+    if algorithm == 'blake2b':
+      return hashlib.blake2b(digest_size=ContentHash.DIGEST_HEX_CHARS // 2)
+    if algorithm not in ContentHash.ALGORITHMS:
+      raise ValueError('Unknown hash algorithm [{}].'.format(algorithm))
+    return hashlib.new(algorithm)
 
-class DirMonitor(object):
-  def __init__(self, root_dirs):
-    self.log = Logger(type(self).__name__)
-    self.dirs = root_dirs
-    self._crawlers = []
-    for root in root_dirs:
-      self._crawlers.append(DirCrawler(root))
-    self.files = [list() for i in range(len(self._crawlers))]
-    self._crawl_all()
+  @staticmethod
+  def hexdigest(hasher):
+    return hasher.hexdigest()[:ContentHash.DIGEST_HEX_CHARS]
 
-  def get_dirs(self):
-    return self.dirs
+  @staticmethod
+  def hash_file(file_path, algorithm):
+    hasher = ContentHash.new(algorithm)
+    with open(file_path, 'rb') as fp:
+      for fragment in iter(lambda: fp.read(BUFFER_SIZE_BYTES), b''):
+        hasher.update(fragment)
+    return ContentHash.hexdigest(hasher)
 
-  def get_files(self):
-    return self.files
+  @staticmethod
+  def fastest():
+    '''Returns the available algorithm with the best measured throughput.'''
+    if ContentHash._fastest is None:
+      data = b'\0' * BUFFER_SIZE_BYTES
+      timings = []
+      for algorithm in ContentHash.available():
+        start = time.time()
+        for i in range(4):
+          ContentHash.new(algorithm).update(data)
+        timings.append((time.time() - start, algorithm))
+      ContentHash._fastest = min(timings)[1]
+    return ContentHash._fastest
 
-  def start_monitoring(self):
-    self._thread = threading.Thread(
-        target=self._thread_main, name='DirMonitorThread')
-    self._thread.daemon = True
-    self._is_monitoring = True
-    self._thread.start()
-    return self
+  @staticmethod
+  def resolve(algorithm, preferred=None):
+    '''Turns HASH_AUTO into a concrete algorithm, [preferred] first.'''
+    if algorithm and algorithm != HASH_AUTO:
+      return algorithm
+    if preferred and ContentHash.is_available(preferred):
+      return preferred
+    return ContentHash.fastest()
 
-  def stop_monitoring(self):
-    self._is_monitoring = False
-    if self._thread:
-      # self._thread.join()
-      self._thread = None
-    return self
 
-  def _thread_main(self):
-    self.log.info('Monitoring thread is running...')
-    while self._is_monitoring:
-      self.log.info('Monitor knows of [{}] files.'.format(len(self.files)))
-      self._crawl_all()
-      time.sleep(5.0)
-    self.log.info('Monitoring thread is exiting.')
+class HashPool(object):
+  '''Hashes many files concurrently on a lazily created worker pool.'''
 
-  def _crawl_all(self):
-    files = []
-    for i in range(len(self._crawlers)):
-      crawler = self._crawlers[i]
-      previous = self.files[i]
-      files.append(crawler.crawl_and_hash(previous))
-    self.files = files
+  def __init__(self, workers=1, kind=None):
+    self.log = Logger(type(self).__name__)
+    self._workers = workers
+    self._kind = kind or HASH_POOL_THREAD
+    self._pool = None
+    self._lock = threading.Lock()
 
+  def hash_paths(self, abs_paths, algorithm):
+    '''Yields (abs_path, digest) tuples in completion order.
 
-class StateDiffer(object):
-  def __init__(self):
-    pass
+    The caller should list the largest files first so that no single big
+    file is left running alone at the end.
+    '''
+    jobs = [(abs_path, algorithm) for abs_path in abs_paths]
+    if self._workers <= 1 or len(jobs) <= 1:
+      for job in jobs:
+        yield hash_path(job)
+      return
+    for result in self._get_pool().imap_unordered(hash_path, jobs):
+      yield result
 
-  def diff(self, src, dst):
-    '''Returns all files from src that need to be uploaded to dst
+  def close(self):
+    with self._lock:
+      if self._pool:
+        self._pool.terminate()
+        self._pool = None
 
-    Both [src] and [dst] should be lists containing dict() with the same
-    exact format as returned from the DirCrawler.crawl_and_hash() method.
+  def _get_pool(self):
+    with self._lock:
+      if self._pool is None:
+        self.log.debug('Starting a [{}] pool with [{}] workers...', self._kind,
+            self._workers)
+        if self._kind == HASH_POOL_PROCESS:
+          self._pool = multiprocessing.Pool(self._workers)
+        else:
+          self._pool = multiprocessing.pool.ThreadPool(self._workers)
+      return self._pool
 
-    Returns a tuple. Each position contains the files that need to be uploaded
-    for that same index in [src].
-    '''
-    # Always return no diff
-    assert len(src) == len(dst), \
-        ('Both local and remote need to be monitoring the same amount of '
-            'dirs. local_dirs=[{}] remote_dirs=[{}]').format(len(src), len(dst))
-    dir_count = len(src)
-    results = []
-    for i in range(dir_count):
-      src_dir = src[i]
-      dst_dir = dst[i]
-      current_diff = []
-      results.append(current_diff)
-      for path, (mtime, md5_hash) in src_dir.items():
-        assert not os.path.isabs(path), path
-        if path not in dst_dir or md5_hash != dst_dir[path][1]:
-          current_diff.append(path)
-    return results
 
+class HashIndex(object):
+  '''Persists the digest of every file of a root dir across restarts.
 
+  Entries are keyed off the relative path and record the algorithm of their
+  digest. They are only trusted while the file stat key (size, mtime_ns,
+  inode, ctime_ns) is unchanged. Updates are
+  appended to a journal which is periodically compacted into the snapshot
+  file with an atomic rename. The entries themselves are only held by the
+  DirCrawler, which hands them back for compaction.
+  '''
+  VERSION = 2
 
-#########################################################
-# Remote Server Classes
-#########################################################
-class RemoteServer(object):
-  def __init__(self, args):
+  def __init__(self, index_dir, root_dir):
     self.log = Logger(type(self).__name__)
-    self.log.debug('Initializing...')
-    self._args = args
-    self._monitor = DirMonitor(args.dirs)
-    self._msg_handler = RemoteMessageHandler(self._monitor)
+    index_dir = os.path.abspath(os.path.expanduser(index_dir))
+    if not os.path.isdir(index_dir):
+      os.makedirs(index_dir)
+    name = hashlib.md5(root_dir).hexdigest()
+    self._root = root_dir
+    self._snapshot_path = os.path.join(index_dir, name + '.index')
+    self._journal_path = os.path.join(index_dir, name + '.journal')
+    self._journal = None
+    self._journal_lines = 0
+    self._lock = threading.Lock()
 
-  def __enter__(self):
-    self.log.debug('Entering...')
-    self._monitor.start_monitoring()
-    self._socket = create_socket(self._args.ip_version)
-    self._socket.bind(('', self._args.port))
-    return self
+  def load(self):
+    '''Returns a dict of rel_path => (stat_key, algorithm, digest).'''
+    with self._lock:
+      entries = {}
+      if self._read(self._snapshot_path, entries, header=True) is None:
+        # The journal only makes sense on top of the rejected snapshot.
+        self._journal_lines = 0
+        self._journal = open(self._journal_path, 'w')
+      else:
+        self._journal_lines = self._read(
+            self._journal_path, entries, header=False)
+        self._journal = open(self._journal_path, 'a')
+      self.log.info('Loaded [{}] entries for [{}] from [{}].',
+          len(entries), self._root, self._snapshot_path)
+      return entries
 
-  def run(self):
-    self.log.debug('Running...')
+  def update(self, changed, removed):
+    '''Persists [changed] rel_path => (stat_key, algorithm, digest).
+
+    Also forgets every rel_path in [removed].
+    '''
+    if not changed and not removed:
+      return
+    with self._lock:
+      if self._journal is None:
+        return
+      lines = []
+      for rel_path, value in changed.items():
+        lines.append(json.dumps([rel_path] + list(value)))
+      for rel_path in removed:
+        lines.append(json.dumps([rel_path, None, None, None]))
+      self._journal.write('\n'.join(lines) + '\n')
+      self._journal.flush()
+      self._journal_lines += len(lines)
+
+  def needs_compaction(self, total_entries):
+    '''Returns whether the journal outgrew the [total_entries] it describes.'''
+    with self._lock:
+      return self._journal is not None and \
+          self._journal_lines >= max(MIN_INDEX_JOURNAL_LINES, total_entries)
+
+  def compact(self, entries):
+    '''Atomically rewrites the snapshot and empties the journal.
+
+    [entries] yields the (rel_path, (stat_key, algorithm, digest)) of every
+    entry to keep.
+    '''
+    with self._lock:
+      if self._journal is not None:
+        self._compact(entries)
+
+  def close(self):
+    with self._lock:
+      if self._journal:
+        self._journal.close()
+        self._journal = None
+
+  def _read(self, path, entries, header):
+    '''Replays [path] into the [entries] dict and returns the lines read.
+
+    Returns None without reading any entry if the [header] of [path] shows it
+    was written for another version or root.
+    '''
+    if not os.path.exists(path):
+      return 0
+    lines = 0
+    with open(path, 'r') as fp:
+      for line in fp:
+        if header:
+          header = False
+          try:
+            record = json.loads(line)
+          except ValueError:
+            record = None
+          if not isinstance(record, dict) or \
+              record.get('version') != HashIndex.VERSION or \
+              record.get('root') != self._root:
+            self.log.warn('Ignoring incompatible index [{}].', path)
+            return None
+          lines += 1
+          continue
+        try:
+          record = json.loads(line)
+          if not isinstance(record, list):
+            raise TypeError(record)
+          rel_path, stat_key, algorithm, digest = record
+          if stat_key is not None:
+            stat_key = tuple(stat_key)
+            if len(stat_key) != 4 or algorithm not in ContentHash.ALGORITHMS:
+              raise ValueError(record)
+        except (ValueError, TypeError):
+          # A torn last line from a crash or a malformed one. Those files
+          # get rehashed.
+          continue
+        lines += 1
+        if stat_key is None:
+          entries.pop(rel_path, None)
+        else:
+          entries[rel_path] = (stat_key, algorithm, digest)
+    return lines
+
+  def _compact(self, entries):
+    tmp_path = self._snapshot_path + TMP_FILE_SUFFIX
+    total_entries = 0
+    with open(tmp_path, 'w') as fp:
+      fp.write(json.dumps({'version': HashIndex.VERSION, 'root': self._root}))
+      fp.write('\n')
+      for rel_path, value in entries:
+        fp.write(json.dumps([rel_path] + list(value)))
+        fp.write('\n')
+        total_entries += 1
+      fp.flush()
+      os.fsync(fp.fileno())
+    os.rename(tmp_path, self._snapshot_path)
+    self._journal.close()
+    self._journal = open(self._journal_path, 'w')
+    self._journal_lines = 0
+    self.log.debug('Compacted [{}] entries into [{}].', total_entries,
+        self._snapshot_path)
+
+
+class GitignoreRules(object):
+  '''The rules of one .gitignore file matched against paths below its dir.
+
+  Supports comments, negations, dir only rules, anchored rules and the *, ?,
+  [...] and ** wildcards. Later rules take precedence over earlier ones.
+  '''
+  def __init__(self, lines):
+    # (regex, negate, dir_only) of every rule, the last rule first.
+    self._rules = []
+    for line in lines:
+      rule = GitignoreRules.parse(line)
+      if rule is not None:
+        self._rules.insert(0, rule)
+    self._file_regex = GitignoreRules._combine(
+        [rule for rule in self._rules if not rule[2]])
+    self._dir_regex = GitignoreRules._combine(self._rules)
+
+  @staticmethod
+  def parse(line):
+    '''Returns a tuple (regex, negate, dir_only) or None for no rule.'''
+    line = line.rstrip('\r\n')
+    if not line.endswith('\\ '):
+      line = line.rstrip(' ')
+    if not line or line.startswith('#'):
+      return None
+    negate = line.startswith('!')
+    if negate:
+      line = line[1:]
+    elif line.startswith('\\'):
+      line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    # Patterns with a separator before their end are relative to the dir of
+    # the .gitignore, the others match at any depth.
+    anchored = '/' in line
+    line = line.lstrip('/')
+    if not line:
+      return None
+    regex = '' if anchored else '(?:.*/)?'
+    segments = line.split('/')
+    for i, segment in enumerate(segments):
+      last = i == len(segments) - 1
+      if segment == '**':
+        regex += '.*' if last else '(?:.*/)?'
+      else:
+        regex += GitignoreRules._translate(segment) + ('' if last else '/')
+    return (re.compile(regex + r'\Z'), negate, dir_only)
+
+  @staticmethod
+  def _translate(segment):
+    '''Returns the regex of one glob [segment] of a path.'''
+    regex = ''
+    i = 0
+    while i < len(segment):
+      c = segment[i]
+      i += 1
+      if c == '*':
+        regex += '[^/]*'
+      elif c == '?':
+        regex += '[^/]'
+      elif c == '\\' and i < len(segment):
+        regex += re.escape(segment[i])
+        i += 1
+      elif c == '[':
+        # A ] right after the opening [ or [! is part of the set.
+        end = segment.find(']', i + 2 if segment.startswith('!', i) else i + 1)
+        if end < 0:
+          regex += re.escape(c)
+          continue
+        chars = segment[i:end].replace('\\', '\\\\')
+        if chars.startswith('!'):
+          chars = '^' + chars[1:]
+        elif chars.startswith('^'):
+          chars = '\\' + chars
+        regex += '[' + chars + ']'
+        i = end + 1
+      else:
+        regex += re.escape(c)
+    return regex
+
+  @staticmethod
+  def _combine(rules):
+    if not rules:
+      return None
+    return re.compile('|'.join(
+        '(?:{})'.format(regex.pattern) for regex, negate, dir_only in rules))
+
+  def match(self, rel_path, is_dir=False):
+    '''Returns whether the last rule matching [rel_path] ignores it.
+
+    Returns None if no rule matches.
+    '''
+    regex = self._dir_regex if is_dir else self._file_regex
+    # One regex tells the common case of no rule matching at all.
+    if regex is None or regex.match(rel_path) is None:
+      return None
+    for rule, negate, dir_only in self._rules:
+      if (is_dir or not dir_only) and rule.match(rel_path):
+        return not negate
+    return None
+
+
+class ExcludeMatcher(object):
+  '''Tells which paths below a root dir are not synced.
+
+  All exclude regexes are combined into one, matched against relative paths
+  from their start. Dirs are matched with a trailing separator so a regex
+  excluding everything below a dir excludes the dir itself. With [gitignore]
+  the .gitignore files loaded through update_gitignore() apply as well.
+  '''
+  def __init__(self, patterns=None, gitignore=False):
+    self.log = Logger(type(self).__name__)
+    self._regex = None
+    if patterns:
+      self._regex = re.compile('|'.join(
+          '(?:{})'.format(pattern) for pattern in patterns))
+    self._gitignore = gitignore
+    # rel_dir => (stat_key, GitignoreRules) of every loaded .gitignore.
+    self._rules = {}
+
+  def uses_gitignore(self):
+    return self._gitignore
+
+  def excludes(self, rel_path, is_dir=False):
+    '''Returns whether [rel_path] is excluded, not looking at its parents.'''
+    if is_dir:
+      if self._regex is not None and self._regex.match(rel_path + os.sep):
+        return True
+    else:
+      if rel_path.endswith(TMP_FILE_SUFFIX):
+        # Files FileWriter is still writing.
+        return True
+      if self._regex is not None and self._regex.match(rel_path):
+        return True
+    if not self._gitignore:
+      return False
+    if is_dir and os.path.basename(rel_path) == GIT_DIR_NAME:
+      return True
+    rel_dir = rel_path
+    while rel_dir:
+      rel_dir = os.path.dirname(rel_dir)
+      loaded = self._rules.get(rel_dir)
+      if loaded is not None:
+        ignored = loaded[1].match(
+            rel_path[len(rel_dir) + 1 if rel_dir else 0:], is_dir)
+        if ignored is not None:
+          return ignored
+    return False
+
+  def excludes_path(self, rel_path, is_dir=False):
+    '''Returns whether [rel_path] or any dir above it is excluded.'''
+    parts = rel_path.split(os.sep)
+    for i in range(1, len(parts)):
+      if self.excludes(os.sep.join(parts[:i]), is_dir=True):
+        return True
+    return self.excludes(rel_path, is_dir)
+
+  def update_gitignore(self, rel_dir, abs_path, file_stat):
+    '''(Re)loads the .gitignore of [rel_dir] if its [file_stat] changed.
+
+    A None [file_stat] means the dir has no .gitignore (anymore).
+    '''
+    if not self._gitignore:
+      return
+    loaded = self._rules.get(rel_dir)
+    if file_stat is None:
+      self._rules.pop(rel_dir, None)
+      return
+    stat_key = DirCrawler.stat_key(file_stat)
+    if loaded is not None and loaded[0] == stat_key:
+      return
+    try:
+      with open(abs_path) as fp:
+        rules = GitignoreRules(fp.readlines())
+    except IOError, e:
+      self.log.warn('Failed to read [{}]: {}', abs_path, e)
+      return
+    self.log.debug('Loaded [{}].', abs_path)
+    self._rules[rel_dir] = (stat_key, rules)
+
+
+class DirCrawler(object):
+  # Each file it knows is packed into one string of the stat key and the
+  # algorithm its digest is valid for, the crawl that last saw it and the raw
+  # digest bytes, if any.
+  KNOWN_STAT = struct.Struct('<qqQqB')
+  KNOWN_EPOCH = struct.Struct('<I')
+  KNOWN_DIGEST_OFFSET = KNOWN_STAT.size + KNOWN_EPOCH.size
+
+  def __init__(self, root_dir, exclude_list=[], hash_pool=None,
+      index_dir=None, hash_algorithm=None, gitignore=False, lazy=False):
+    self.log = Logger(type(self).__name__)
+    self._hash_pool = hash_pool or HashPool()
+    self._dir = root_dir
+    self._dir = os.path.expanduser(self._dir)
+    self._dir = os.path.abspath(self._dir)
+    assert os.path.isdir(self._dir), \
+        'Argument root_dir [{}] => [{}] must exist.'.format(root_dir, self._dir)
+    self._excludes = ExcludeMatcher(exclude_list, gitignore)
+    # rel_path => packed stat of every file seen, updated in place.
+    self._known = {}
+    # Guards self._known as crawls run alongside writers recording files.
+    self._lock = threading.RLock()
+    # Counts crawls. Files not seen by the last one no longer exist.
+    self._epoch = 0
+    # rel_path => (stat_key, algorithm, digest) or None, not yet persisted.
+    self._unsaved = {}
+    # rel_dir => (mtime_ns, names, subdirs) of the dirs listed so far.
+    self._listings = {}
+    self._index = None
+    if index_dir:
+      self._index = HashIndex(index_dir, self._dir)
+      for rel_path, value in self._index.load().iteritems():
+        self._known[rel_path] = DirCrawler._pack_known(*value)
+    self._algorithm = ContentHash.resolve(
+        hash_algorithm or HASH_MD5, self.index_algorithm())
+    # Lazy crawlers only hash on demand and index other files by metadata.
+    self._lazy = lazy
+    # Files stated by the running or last crawl_changes().
+    self._stated_files = 0
+
+  def get_hash_algorithm(self):
+    return self._algorithm
+
+  def set_hash_algorithm(self, algorithm):
+    '''Digests of another algorithm are recomputed on the next crawl.'''
+    self._algorithm = algorithm
+
+  def index_algorithm(self):
+    '''Returns the algorithm of the known digests or None if unknown.'''
+    for record in self._known.itervalues():
+      if len(record) > DirCrawler.KNOWN_DIGEST_OFFSET:
+        return DirCrawler._unpack_known(record)[1]
+    return None
+
+  def get_dir(self):
+    return self._dir
+
+  def progress(self):
+    '''Returns the number of files the running or last crawl stated.'''
+    return self._stated_files
+
+  def inode(self, rel_path):
+    '''Returns the inode [rel_path] had when last seen or None if unknown.
+
+    Files a crawl found missing are still known until the next crawl.
+    '''
+    record = self._known.get(rel_path)
+    if record is None:
+      return None
+    return DirCrawler.KNOWN_STAT.unpack_from(record)[2]
+
+  def crawl(self, rel_dir=''):
+    '''Returns a list of relative paths of all files recursively.
+
+    Only the subtree under [rel_dir] is crawled if one is given.
+    '''
+    return [rel_path for rel_path, file_stat in self._scan(rel_dir)]
+
+  def crawl_and_hash(self, previous_results={}):
+    '''Returns a dict with keyed off file_rel_path with hash information.
+
+    Each dict key refers to the relative path of a file.
+    Each dict value contains a tuple with three elements:
+    1. Epoch modified time.
+    2. Digest of the contents of the file with the crawler hash algorithm.
+       Lazy crawlers leave it None unless a digest is already known.
+    3. Size in bytes.
+    '''
+    data = dict(previous_results)
+    for rel_path, entry in self.crawl_changes(previous_results):
+      if entry is None:
+        del data[rel_path]
+      else:
+        data[rel_path] = entry
+    return data
+
+  def crawl_changes(self, files):
+    '''Returns a list of (rel_path, entry) updates bringing [files] up to date.
+
+    [files] maps rel_paths to entries in the crawl_and_hash() format and is
+    only read, so a FileIndex can be updated in place with the results. The
+    entry of a file that no longer exists is None.
+    '''
+    self.start_crawl()
+    updates = self.scan_changes(files)
+    updates.extend(self.removed_files(files))
+    return updates
+
+  def start_crawl(self):
+    '''Starts a crawl made of scan_changes() calls and one removed_files().
+
+    Files the previous crawl did not see are forgotten now, so their inodes
+    outlive the crawl that found them missing, which is how moves are told
+    apart from new files.
+    '''
+    with self._lock:
+      stale = [rel_path for rel_path, record in self._known.iteritems()
+          if not self._seen(rel_path, record)]
+      for rel_path in stale:
+        self._forget(rel_path, save=False)
+      self._save()
+      self._epoch += 1
+      self._stated_files = 0
+
+  def scan_changes(self, files, rel_dir='', recursive=True):
+    '''Returns the (rel_path, entry) updates of the files below [rel_dir].
+
+    Only the files directly in [rel_dir] are looked at unless [recursive].
+    Files that were not found are left to removed_files().
+    '''
+    algorithm = self._algorithm
+    self.log.debug('Computing the [{}] hash of changed files in [{}]...',
+        algorithm, rel_dir)
+    updates = []
+    stated_files = 0
+    computed_digests = 0
+    hashed_bytes = 0
+    reused_digests = 0
+    unhashed_files = 0
+    pending = []
+    for rel_path, file_stat in self._scan(rel_dir, recursive):
+      stated_files += 1
+      self._stated_files += 1
+      stat_key = DirCrawler.stat_key(file_stat)
+      previous = files.get(rel_path)
+      digest = self._cached_digest(rel_path, file_stat, stat_key, algorithm,
+          previous)
+      if digest is not None or self._lazy:
+        if digest is not None:
+          reused_digests += 1
+        else:
+          unhashed_files += 1
+        self._remember(rel_path, stat_key, algorithm, digest)
+        entry = (file_stat.st_mtime, digest, file_stat.st_size)
+        if entry != previous:
+          updates.append((rel_path, entry))
+      else:
+        pending.append((file_stat.st_size, rel_path, file_stat, stat_key))
+    # Largest first so one huge file does not dominate the tail.
+    pending.sort(reverse=True)
+    stats = {}
+    abs_paths = []
+    for size, rel_path, file_stat, stat_key in pending:
+      abs_path = os.path.join(self._dir, rel_path)
+      stats[abs_path] = (rel_path, file_stat, stat_key)
+      abs_paths.append(abs_path)
+    for abs_path, digest in self._hash_pool.hash_paths(abs_paths, algorithm):
+      if digest is None:
+        continue
+      rel_path, file_stat, stat_key = stats[abs_path]
+      computed_digests += 1
+      hashed_bytes += file_stat.st_size
+      self._remember(rel_path, stat_key, algorithm, digest)
+      entry = (file_stat.st_mtime, digest, file_stat.st_size)
+      if entry != files.get(rel_path):
+        updates.append((rel_path, entry))
+    with self._lock:
+      self._save()
+    METRICS.increment('files_stated', stated_files)
+    METRICS.increment('files_hashed', computed_digests)
+    METRICS.increment('bytes_hashed', hashed_bytes)
+    self.log.info('Finished computing all [{}] {} digests and reused [{}].'
+        ' Left [{}] files unhashed.', computed_digests, algorithm,
+        reused_digests, unhashed_files)
+    return updates
+
+  def removed_files(self, files):
+    '''Returns a (rel_path, None) update for each file the crawl did not see.
+
+    [files] must not change while it is iterated.
+    '''
+    return [(rel_path, None) for rel_path in files if not self._seen(rel_path)]
+
+  def subdirs(self, rel_dir=''):
+    '''Returns the names of the dirs in [rel_dir] that are crawled.'''
+    entries, subdirs = self._list_dir(rel_dir)
+    return [name for name in subdirs or []
+        if not self.is_excluded(os.path.join(rel_dir, name), is_dir=True)]
+
+  def hash_file(self, rel_path, previous=None, need_digest=False):
+    '''Returns the crawl_and_hash() entry of one file or None if it is gone.
+
+    The [previous] tuple is returned as is if the file was not modified. Lazy
+    crawlers only hash the file if a digest is needed.
+    '''
+    file_stat = None
+    if not self.is_excluded(rel_path):
+      file_stat = self._stat(rel_path)
+    if os.path.basename(rel_path) == GITIGNORE_FILE_NAME:
+      self._excludes.update_gitignore(os.path.dirname(rel_path),
+          os.path.join(self._dir, rel_path), file_stat)
+    if file_stat is None:
+      self._forget(rel_path)
+      return None
+    METRICS.increment('files_stated')
+    stat_key = DirCrawler.stat_key(file_stat)
+    algorithm = self._algorithm
+    digest = self._cached_digest(
+        rel_path, file_stat, stat_key, algorithm, previous)
+    if digest is None and (need_digest or not self._lazy):
+      abs_path, digest = hash_path(
+          (os.path.join(self._dir, rel_path), algorithm))
+      if digest is None:
+        self._forget(rel_path)
+        return None
+      METRICS.increment('files_hashed')
+      METRICS.increment('bytes_hashed', file_stat.st_size)
+    with self._lock:
+      self._remember_locked(rel_path, stat_key, algorithm, digest)
+      self._save()
+    entry = (file_stat.st_mtime, digest, file_stat.st_size)
+    if entry == previous:
+      return previous
+    return entry
+
+  def record(self, rel_path, file_stat, algorithm, digest):
+    '''Remembers the [digest] of a file written with a known content.
+
+    Returns its crawl_and_hash() entry or None if it is not to be indexed.
+    '''
+    if algorithm != self._algorithm or self.is_excluded(rel_path) or \
+        not stat.S_ISREG(file_stat.st_mode):
+      return None
+    with self._lock:
+      self._remember_locked(
+          rel_path, DirCrawler.stat_key(file_stat), algorithm, digest)
+      self._save()
+    return (file_stat.st_mtime, digest, file_stat.st_size)
+
+  @staticmethod
+  def stat_key(file_stat):
+    '''Returns the (size, mtime_ns, inode, ctime_ns) a digest is valid for.'''
+    mtime_ns = DirCrawler.mtime_ns(file_stat)
+    ctime_ns = getattr(file_stat, 'st_ctime_ns', None)
+    if ctime_ns is None:
+      ctime_ns = int(file_stat.st_ctime * 1e9)
+    return (file_stat.st_size, mtime_ns, file_stat.st_ino, ctime_ns)
+
+  @staticmethod
+  def mtime_ns(file_stat):
+    mtime_ns = getattr(file_stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+      mtime_ns = int(file_stat.st_mtime * 1e9)
+    return mtime_ns
+
+  def _scan(self, rel_dir='', recursive=True):
+    '''Yields the (rel_path, stat) of all files below [rel_dir].
+
+    Only the files directly in [rel_dir] are yielded unless [recursive].
+    Every file is stat()'ed once. A dir whose own mtime did not change since
+    it was last listed still has the same entries, so the previous listing
+    is reused instead of reading the dir again.
+    '''
+    self.log.debug('Starting to crawl [{}]...', self._dir)
+    if rel_dir and self.is_excluded(rel_dir, is_dir=True):
+      return
+    # Dirs modified this recently may still change within the same mtime
+    # tick, so their listings are not trusted later.
+    max_mtime_ns = int((time.time() - DIR_LISTING_MIN_AGE_SECS) * 1e9)
+    found_files = 0
+    listings = {}
+    listed_dirs = 0
+    pending = [rel_dir]
+    while pending:
+      dir_path = pending.pop()
+      try:
+        dir_stat = os.stat(os.path.join(self._dir, dir_path))
+      except OSError:
+        continue
+      mtime_ns = DirCrawler.mtime_ns(dir_stat)
+      listing = self._listings.get(dir_path)
+      if listing is not None and listing[0] == mtime_ns:
+        unused, names, subdirs = listing
+        entries = [(name, self._stat(os.path.join(dir_path, name)))
+            for name in names]
+      else:
+        listed_dirs += 1
+        entries, subdirs = self._list_dir(dir_path)
+        if entries is None:
+          continue
+        names = [name for name, file_stat in entries]
+      if mtime_ns < max_mtime_ns:
+        listings[dir_path] = (mtime_ns, names, subdirs)
+      if self._excludes.uses_gitignore():
+        # Its rules apply to everything else in the dir, so load them first.
+        gitignore = dict(entries).get(GITIGNORE_FILE_NAME)
+        self._excludes.update_gitignore(dir_path, os.path.join(
+            self._dir, dir_path, GITIGNORE_FILE_NAME), gitignore)
+      for name, file_stat in entries:
+        rel_path = os.path.join(dir_path, name)
+        if file_stat is not None and not self._excludes.excludes(rel_path):
+          found_files += 1
+          yield (rel_path, file_stat)
+      for name in subdirs if recursive else []:
+        rel_path = os.path.join(dir_path, name)
+        if not self._excludes.excludes(rel_path, is_dir=True):
+          pending.append(rel_path)
+    if not rel_dir and recursive:
+      self._listings = listings
+    else:
+      self._listings.update(listings)
+    self.log.debug('Crawl found a total of [{}] files and listed [{}] dirs.',
+        found_files, listed_dirs)
+
+  def _list_dir(self, rel_dir):
+    '''Returns a tuple (entries, subdirs) of the entries of one dir.
+
+    Entries are (name, stat) tuples of everything but the subdirs, with a None
+    stat unless it is a file. Symlinks are followed but never crawled into.
+    Returns (None, None) if the dir cannot be listed.
+    '''
+    abs_dir = os.path.join(self._dir, rel_dir)
+    entries = []
+    subdirs = []
+    try:
+      if scandir is not None:
+        for entry in scandir(abs_dir):
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              subdirs.append(entry.name)
+              continue
+            file_stat = entry.stat()
+          except OSError:
+            file_stat = None
+          entries.append((entry.name, DirCrawler._regular_stat(file_stat)))
+      else:
+        for name in os.listdir(abs_dir):
+          abs_path = os.path.join(abs_dir, name)
+          try:
+            file_stat = os.lstat(abs_path)
+            if stat.S_ISDIR(file_stat.st_mode):
+              subdirs.append(name)
+              continue
+            if stat.S_ISLNK(file_stat.st_mode):
+              file_stat = os.stat(abs_path)
+          except OSError:
+            file_stat = None
+          entries.append((name, DirCrawler._regular_stat(file_stat)))
+    except OSError, e:
+      self.log.debug('Failed to list [{}]: {}', abs_dir, e)
+      return (None, None)
+    return (entries, subdirs)
+
+  @staticmethod
+  def _regular_stat(file_stat):
+    '''Returns [file_stat] if it is the stat of a regular file or else None.'''
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+      return None
+    return file_stat
+
+  def _cached_digest(self, rel_path, file_stat, stat_key, algorithm, previous):
+    '''Returns the digest of an unmodified file or None to hash it.'''
+    record = self._known.get(rel_path)
+    if record is not None and len(record) > DirCrawler.KNOWN_DIGEST_OFFSET:
+      if record.startswith(DirCrawler._pack_stat(stat_key, algorithm)):
+        return binascii.hexlify(record[DirCrawler.KNOWN_DIGEST_OFFSET:])
+    elif previous is not None and previous[0] >= file_stat.st_mtime:
+      return previous[1]
+    return None
+
+  @staticmethod
+  def _pack_stat(stat_key, algorithm):
+    return DirCrawler.KNOWN_STAT.pack(
+        *(stat_key + (ContentHash.ALGORITHMS.index(algorithm),)))
+
+  @staticmethod
+  def _pack_known(stat_key, algorithm, digest, epoch=0):
+    record = DirCrawler._pack_stat(stat_key, algorithm) + \
+        DirCrawler.KNOWN_EPOCH.pack(epoch)
+    if digest is not None:
+      record += binascii.unhexlify(digest)
+    return record
+
+  @staticmethod
+  def _unpack_known(record):
+    '''Returns a tuple (stat_key, algorithm, digest, epoch) of a record.'''
+    values = DirCrawler.KNOWN_STAT.unpack_from(record)
+    epoch, = DirCrawler.KNOWN_EPOCH.unpack_from(
+        record, DirCrawler.KNOWN_STAT.size)
+    digest = None
+    if len(record) > DirCrawler.KNOWN_DIGEST_OFFSET:
+      digest = binascii.hexlify(record[DirCrawler.KNOWN_DIGEST_OFFSET:])
+    return (values[:4], ContentHash.ALGORITHMS[values[4]], digest, epoch)
+
+  def _seen(self, rel_path, record=None):
+    '''Returns whether the current crawl saw [rel_path].'''
+    record = record or self._known.get(rel_path)
+    return record is not None and DirCrawler.KNOWN_EPOCH.unpack_from(
+        record, DirCrawler.KNOWN_STAT.size)[0] == self._epoch
+
+  def _remember(self, rel_path, stat_key, algorithm, digest):
+    '''Records the [digest] of a file, which may be None, as seen.'''
+    with self._lock:
+      self._remember_locked(rel_path, stat_key, algorithm, digest)
+
+  def _remember_locked(self, rel_path, stat_key, algorithm, digest):
+    record = DirCrawler._pack_known(stat_key, algorithm, digest, self._epoch)
+    previous = self._known.get(rel_path)
+    self._known[rel_path] = record
+    if self._index is None:
+      return
+    offset = DirCrawler.KNOWN_STAT.size
+    if previous is not None and previous[:offset] == record[:offset] and \
+        previous[DirCrawler.KNOWN_DIGEST_OFFSET:] == \
+        record[DirCrawler.KNOWN_DIGEST_OFFSET:]:
+      return
+    if digest is not None:
+      self._unsaved[rel_path] = (stat_key, algorithm, digest)
+    elif previous is not None and \
+        len(previous) > DirCrawler.KNOWN_DIGEST_OFFSET:
+      self._unsaved[rel_path] = None
+    if len(self._unsaved) >= MIN_INDEX_JOURNAL_LINES:
+      self._save()
+
+  def _save(self):
+    '''Persists what was remembered or forgotten since the last call.
+
+    Must be called with self._lock held.
+    '''
+    if not self._unsaved:
+      return
+    changed = {}
+    removed = []
+    for rel_path, value in self._unsaved.iteritems():
+      if value is None:
+        removed.append(rel_path)
+      else:
+        changed[rel_path] = value
+    self._unsaved = {}
+    self._index.update(changed, removed)
+    if self._index.needs_compaction(len(self._known)):
+      self._index.compact(self._persisted())
+
+  def _persisted(self):
+    for rel_path, record in self._known.iteritems():
+      stat_key, algorithm, digest, epoch = DirCrawler._unpack_known(record)
+      if digest is not None:
+        yield (rel_path, (stat_key, algorithm, digest))
+
+  def forget(self, rel_path):
+    self._forget(rel_path)
+
+  def _forget(self, rel_path, save=True):
+    with self._lock:
+      record = self._known.pop(rel_path, None)
+      if self._index is None or record is None or \
+          len(record) <= DirCrawler.KNOWN_DIGEST_OFFSET:
+        return
+      self._unsaved[rel_path] = None
+      if save or len(self._unsaved) >= MIN_INDEX_JOURNAL_LINES:
+        self._save()
+
+  def _stat(self, rel_path):
+    '''Returns the os.stat() of [rel_path] or None if it is not a file.'''
+    abs_path = os.path.join(self._dir, rel_path)
+    try:
+      return DirCrawler._regular_stat(os.stat(abs_path))
+    except OSError:
+      return None
+
+  @staticmethod
+  def md5_hash(file_path):
+    return ContentHash.hash_file(file_path, HASH_MD5)
+
+  def is_excluded(self, rel_path, is_dir=False):
+    '''Returns whether [rel_path] or any dir above it is not synced.'''
+    return self._excludes.excludes_path(rel_path, is_dir)
+
+
+class InotifyWatcher(object):
+  '''Thin ctypes wrapper around the Linux inotify API.'''
+  IN_MODIFY = 0x00000002
+  IN_ATTRIB = 0x00000004
+  IN_CLOSE_WRITE = 0x00000008
+  IN_MOVED_FROM = 0x00000040
+  IN_MOVED_TO = 0x00000080
+  IN_CREATE = 0x00000100
+  IN_DELETE = 0x00000200
+  IN_DELETE_SELF = 0x00000400
+  IN_MOVE_SELF = 0x00000800
+  IN_Q_OVERFLOW = 0x00004000
+  IN_IGNORED = 0x00008000
+  IN_DONT_FOLLOW = 0x02000000
+  IN_ISDIR = 0x40000000
+  IN_CLOEXEC = 0o2000000
+  WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+      IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+      IN_DONT_FOLLOW)
+  EVENT_HEADER = struct.Struct('iIII')
+  _libc = None
+
+  @staticmethod
+  def is_supported():
+    return InotifyWatcher._load_libc() is not None
+
+  @staticmethod
+  def _load_libc():
+    if InotifyWatcher._libc is None and sys.platform.startswith('linux'):
+      try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        InotifyWatcher._libc = libc
+      except (OSError, AttributeError):
+        pass
+    return InotifyWatcher._libc
+
+  def __init__(self):
+    self.log = Logger(type(self).__name__)
+    self._libc = InotifyWatcher._load_libc()
+    self._fd = self._libc.inotify_init1(InotifyWatcher.IN_CLOEXEC)
+    if self._fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1() failed.')
+
+  def add_watch(self, path):
+    '''Returns the watch descriptor for [path] or None if it is gone.'''
+    wd = self._libc.inotify_add_watch(
+        self._fd, path, InotifyWatcher.WATCH_MASK)
+    if wd < 0:
+      error = ctypes.get_errno()
+      if error in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+        return None
+      raise OSError(error, 'inotify_add_watch({}) failed.'.format(path))
+    return wd
+
+  def rm_watch(self, wd):
+    self._libc.inotify_rm_watch(self._fd, wd)
+
+  def read_events(self, timeout_secs):
+    '''Returns a list of (wd, mask, cookie, name) tuples.'''
+    readable, unused, unused = select.select([self._fd], [], [], timeout_secs)
+    if not readable:
+      return []
+    data = os.read(self._fd, BUFFER_SIZE_BYTES)
+    events = []
+    offset = 0
+    header_size = InotifyWatcher.EVENT_HEADER.size
+    while offset + header_size <= len(data):
+      wd, mask, cookie, name_size = \
+          InotifyWatcher.EVENT_HEADER.unpack_from(data, offset)
+      offset += header_size
+      name = data[offset:offset + name_size].rstrip(b'\0')
+      offset += name_size
+      events.append((wd, mask, cookie, name))
+    return events
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+
+class DirMonitor(object):
+  def __init__(self, root_dirs, backend=None, hash_pool=None, index_dir=None,
+      hash_algorithm=None, exclude_list=None, gitignore=False,
+      lazy_hash=False, background_index=False):
+    self.log = Logger(type(self).__name__)
+    self.dirs = root_dirs
+    self._backend = backend or MONITOR_AUTO
+    self._lazy_hash = lazy_hash
+    self._crawlers = []
+    for root in root_dirs:
+      self._crawlers.append(DirCrawler(root, exclude_list or [], hash_pool,
+          index_dir, gitignore=gitignore, lazy=lazy_hash))
+    # All roots share one algorithm, preferably the one already indexed.
+    indexed = [crawler.index_algorithm() for crawler in self._crawlers]
+    self._hash_algorithm = ContentHash.resolve(hash_algorithm or HASH_MD5,
+        next((algorithm for algorithm in indexed if algorithm), None))
+    for crawler in self._crawlers:
+      crawler.set_hash_algorithm(self._hash_algorithm)
+    self.log.info('Hashing contents with [{}].', self._hash_algorithm)
+    # One FileIndex per root, only ever updated in place.
+    self.files = [FileIndex(lazy=lazy_hash) for crawler in self._crawlers]
+    # How many indexed files have each size, to tell which unhashed files
+    # may be copies of indexed ones.
+    self._sizes = collections.Counter()
+    # Every change to self.files bumps the generation and appends one
+    # (generation, dir_index, rel_path) entry to the journal. Journal entries
+    # are complete for every generation after self._journal_start.
+    self.generation = 0
+    self._journal = []
+    self._journal_start = 0
+    # (generation, dir_index, old_rel_path, new_rel_path, digest) of every
+    # file move, kept as long as the journal covers its generation.
+    self._moves = []
+    self._lock = threading.Lock()
+    # Notified with self._lock held whenever the generation changes.
+    self._changed = threading.Condition(self._lock)
+    # Serialises updates of the index and crawler state. Crawls only hold it
+    # to apply their results, so writers never wait for a whole crawl.
+    self._crawl_lock = threading.RLock()
+    # Serialises crawls. Always taken before self._crawl_lock.
+    self._scan_lock = threading.RLock()
+    # The rel_paths updated by others while their root is being crawled, so
+    # the crawl does not overwrite them with older results.
+    self._touched = [None] * len(self._crawlers)
+    # Maps inotify watch descriptors to (dir_index, rel_dir).
+    self._watches = {}
+    # Whether the first crawl of each root completed. A background index is
+    # built by the monitoring thread one top level dir at a time, with the
+    # names of the ones already indexed kept until the whole root is.
+    self._indexed = [False] * len(self._crawlers)
+    self._indexed_dirs = [set() for crawler in self._crawlers]
+    if not background_index:
+      self._crawl_all()
+
+  def get_dirs(self):
+    return self.dirs
+
+  def get_files(self):
+    return self.files
+
+  def is_lazy(self):
+    '''Returns whether files are only hashed on demand.'''
+    return self._lazy_hash
+
+  def get_hash_algorithm(self):
+    return self._hash_algorithm
+
+  def set_hash_algorithm(self, algorithm):
+    '''Switches every root to [algorithm] and rehashes what is needed.'''
+    with self._scan_lock:
+      with self._crawl_lock:
+        if algorithm == self._hash_algorithm:
+          return
+        self.log.info('Switching hash algorithm from [{}] to [{}]...',
+            self._hash_algorithm, algorithm)
+        self._hash_algorithm = algorithm
+        for crawler in self._crawlers:
+          crawler.set_hash_algorithm(algorithm)
+      self._crawl_all()
+
+  def snapshot(self):
+    '''Returns a tuple (generation, files) with a consistent full view.'''
+    with self._lock:
+      return (self.generation,
+          [dict(files.iteritems()) for files in self.files])
+
+  def changes_since(self, generation):
+    '''Returns a tuple (generation, changes) relative to [generation].
+
+    The changes contain one dict per root dir with the keys:
+    - 'changed': dict of rel_path => entry for added or modified files.
+    - 'removed': list of rel_paths that no longer exist.
+
+    The changes are None if the journal no longer reaches back to
+    [generation] and a full snapshot() must be used instead.
+    '''
+    with self._lock:
+      if generation < self._journal_start or generation > self.generation:
+        return (self.generation, None)
+      changes = [{'changed': {}, 'removed': []} for i in range(len(self.files))]
+      seen = set()
+      for entry_generation, dir_index, rel_path in reversed(self._journal):
+        if entry_generation <= generation:
+          break
+        if (dir_index, rel_path) in seen:
+          continue
+        seen.add((dir_index, rel_path))
+        files = self.files[dir_index]
+        if rel_path in files:
+          changes[dir_index]['changed'][rel_path] = files[rel_path]
+        else:
+          changes[dir_index]['removed'].append(rel_path)
+      return (self.generation, changes)
+
+  def moves_since(self, generation):
+    '''Returns the files moved after [generation], one list per root dir.
+
+    Each move is a [old_rel_path, new_rel_path, digest] list, with chains
+    of moves collapsed into one and only for files that are still there. The
+    digest is None for files moved while unhashed and not hashed since.
+    Returns None if the journal no longer reaches back to [generation].
+    '''
+    with self._lock:
+      if generation < self._journal_start or generation > self.generation:
+        return None
+      results = [collections.OrderedDict() for files in self.files]
+      for move_generation, dir_index, old, new, digest in self._moves:
+        if move_generation <= generation:
+          continue
+        moves = results[dir_index]
+        # An earlier move to [old] is extended to [new] instead.
+        origin = next((src for src, dst in moves.items() if dst[0] == old),
+            old)
+        moves.pop(origin, None)
+        if origin != new:
+          moves[origin] = (new, digest)
+      renames = []
+      for i, moves in enumerate(results):
+        current = []
+        renames.append(current)
+        for old, (new, digest) in moves.items():
+          entry = self.files[i].get(new)
+          if entry is not None and digest in (None, entry[1]):
+            current.append([old, new, entry[1]])
+      return renames
+
+  def record_moved(self, dir_index, old, new, file_stat, algorithm, digest):
+    '''Indexes a file renamed from [old] to [new] without reading it.'''
+    with self._crawl_lock:
+      crawler = self._crawlers[dir_index]
+      crawler.forget(old)
+      entry = crawler.record(new, file_stat, algorithm, digest)
+      updates = [(dir_index, old, None)]
+      if entry is not None:
+        updates.append((dir_index, new, entry))
+      self._update_files(updates)
+
+  def index_lock(self):
+    '''Returns the lock to hold while moving files that are then recorded.
+
+    Holding it across the rename and the record_written() call stops the
+    monitor from hashing the file from its inotify events in between.
+    '''
+    return self._crawl_lock
+
+  def record_written(self, dir_index, rel_path, file_stat, algorithm, digest):
+    '''Indexes a file whose [digest] is known without reading it back.'''
+    with self._crawl_lock:
+      entry = self._crawlers[dir_index].record(
+          rel_path, file_stat, algorithm, digest)
+      if entry is not None:
+        self._update_files([(dir_index, rel_path, entry)])
+
+  def entries(self, dir_index, rel_paths):
+    '''Returns the current entry or None of each of [rel_paths].'''
+    with self._lock:
+      files = self.files[dir_index]
+      return [files.get(rel_path) for rel_path in rel_paths]
+
+  def ensure_digests(self, dir_index, rel_paths):
+    '''Hashes the files of [rel_paths] that were indexed without a digest.'''
+    with self._crawl_lock:
+      crawler = self._crawlers[dir_index]
+      files = self.files[dir_index]
+      updates = []
+      for rel_path in rel_paths:
+        previous = files.get(rel_path)
+        if previous is not None and previous[1] is None:
+          updates.append((dir_index, rel_path,
+              crawler.hash_file(rel_path, previous, need_digest=True)))
+      self._update_files(updates)
+
+  def has_size(self, size):
+    '''Returns whether any indexed file is [size] bytes big.'''
+    with self._lock:
+      return size in self._sizes
+
+  def ensure_sized_digests(self, sizes, max_bytes):
+    '''Hashes the files indexed without a digest whose size is in [sizes].
+
+    Smaller files go first and no more than [max_bytes] are hashed. Returns
+    the sizes whose files all have digests now.
+    '''
+    with self._lock:
+      unhashed = sorted((StateDiffer.size(entry), dir_index, rel_path)
+          for dir_index in range(len(self.files))
+          for rel_path, entry in self.files[dir_index].iteritems()
+          if entry[1] is None and StateDiffer.size(entry) in sizes)
+    hashed_sizes = set(sizes)
+    pending = [[] for files in self.files]
+    for size, dir_index, rel_path in unhashed:
+      if size > max_bytes:
+        hashed_sizes.discard(size)
+        continue
+      max_bytes -= size
+      pending[dir_index].append(rel_path)
+    for dir_index in range(len(pending)):
+      if pending[dir_index]:
+        self.ensure_digests(dir_index, pending[dir_index])
+    return hashed_sizes
+
+  def diff_from(self, files, trees):
+    '''Returns the StateDiffer.diff() of [files] against the monitored files.
+
+    [trees] holds the MerkleTree of each dict in [files].
+    '''
+    with self._lock:
+      with METRICS.timer('diff_seconds'):
+        # Each FileIndex is the MerkleTree of its own files.
+        return StateDiffer().diff(files, self.files, trees, self.files)
+
+  def indexing_progress(self):
+    '''Returns a dict describing how far the first crawl of the roots got.'''
+    with self._lock:
+      return {
+        'roots': len(self._indexed),
+        'indexed_roots': sum(1 for indexed in self._indexed if indexed),
+        'indexed_dirs': sum(len(dirs) for dirs in self._indexed_dirs),
+        'indexed_files': sum(len(files) for files in self.files),
+        'stated_files': sum(crawler.progress() for crawler in self._crawlers),
+      }
+
+  def wait_for_index(self, timeout_secs):
+    '''Blocks until every root is indexed or the timeout.
+
+    Returns a dict mapping the index of each root that is still pending to
+    the names of its top level dirs that are indexed. Files directly in the
+    root are indexed once it holds ''.
+    '''
+    deadline = time.time() + timeout_secs
+    with self._lock:
+      while not all(self._indexed):
+        remaining_secs = deadline - time.time()
+        if remaining_secs <= 0:
+          break
+        self._changed.wait(remaining_secs)
+      return dict((i, frozenset(self._indexed_dirs[i]))
+          for i in range(len(self._indexed)) if not self._indexed[i])
+
+  @staticmethod
+  def top_dir(rel_path):
+    '''Returns the top level dir of [rel_path] or '' if it has none.'''
+    if os.sep not in rel_path:
+      return ''
+    return rel_path.split(os.sep, 1)[0]
+
+  def find_digest(self, digest):
+    '''Returns a (dir_index, rel_path) whose contents hash to [digest].
+
+    Returns None if no indexed file has those contents.
+    '''
+    with self._lock:
+      for dir_index in range(len(self.files)):
+        rel_path = self.files[dir_index].find(digest)
+        if rel_path is not None:
+          return (dir_index, rel_path)
+      return None
+
+  def start_monitoring(self):
+    self._thread = threading.Thread(
+        target=self._thread_main, name='DirMonitorThread')
+    self._thread.daemon = True
+    self._is_monitoring = True
+    self._thread.start()
+    return self
+
+  def stop_monitoring(self):
+    self._is_monitoring = False
+    if self._thread:
+      # self._thread.join()
+      self._thread = None
+    return self
+
+  def _thread_main(self):
+    self.log.info('Monitoring thread is running...')
+    self._index_pending()
+    use_inotify = self._backend == MONITOR_INOTIFY or \
+        (self._backend == MONITOR_AUTO and InotifyWatcher.is_supported())
+    if use_inotify:
+      try:
+        self._inotify_main()
+      except OSError as exception:
+        self.log.warn('Falling back to polling after inotify failed '
+            'with [{}].', exception)
+    while self._is_monitoring:
+      self.log.info('Monitor knows of [{}] files.',
+          sum(len(files) for files in self.files))
+      self._crawl_all()
+      time.sleep(5.0)
+    self.log.info('Monitoring thread is exiting.')
+
+  def _inotify_main(self):
+    '''Applies inotify events to the index with periodic full crawls.'''
+    watcher = InotifyWatcher()
+    try:
+      for i in range(len(self._crawlers)):
+        self._watch_tree(watcher, i, '')
+      # Anything that changed before the watches existed.
+      self._crawl_all()
+      last_crawl = time.time()
+      while self._is_monitoring:
+        events = watcher.read_events(INOTIFY_READ_TIMEOUT_SECS)
+        # Coalesce bursts so a file being written is hashed only once.
+        while events and len(events) < INOTIFY_MAX_BATCH_EVENTS:
+          more_events = watcher.read_events(INOTIFY_COALESCE_SECS)
+          if not more_events:
+            break
+          events.extend(more_events)
+        needs_crawl = time.time() - last_crawl > FULL_CRAWL_INTERVAL_SECS
+        if events and not needs_crawl:
+          needs_crawl = not self._apply_events(watcher, events)
+        if needs_crawl:
+          self.log.info('Running full crawl. Monitor knows of [{}] files.',
+              sum(len(files) for files in self.files))
+          # Dirs created since the last crawl may never have been watched if
+          # their events were dropped. Watching a dir again is harmless.
+          for i in range(len(self._crawlers)):
+            self._watch_tree(watcher, i, '')
+          self._crawl_all()
+          last_crawl = time.time()
+    finally:
+      watcher.close()
+
+  def _watch_tree(self, watcher, dir_index, rel_dir):
+    crawler = self._crawlers[dir_index]
+    root = crawler.get_dir()
+    if rel_dir and crawler.is_excluded(rel_dir, is_dir=True):
+      return
+    for current, dirs, unused in os.walk(os.path.join(root, rel_dir)):
+      current_rel_dir = os.path.relpath(current, root)
+      wd = watcher.add_watch(current)
+      if wd is not None:
+        self._watches[wd] = (dir_index, current_rel_dir)
+      # Excluded dirs are never crawled, so their events would be dropped.
+      dirs[:] = [name for name in dirs if not crawler.is_excluded(
+          os.path.normpath(os.path.join(current_rel_dir, name)), is_dir=True)]
+
+  def _unwatch_tree(self, watcher, dir_index, rel_dir):
+    prefix = rel_dir + os.sep
+    for wd, (i, watched_dir) in list(self._watches.items()):
+      if i == dir_index and \
+          (watched_dir == rel_dir or watched_dir.startswith(prefix)):
+        watcher.rm_watch(wd)
+        del self._watches[wd]
+
+  def _apply_events(self, watcher, events):
+    '''Updates the index from [events].
+
+    Returns False if the events cannot be trusted and a full crawl is needed.
+    '''
+    with self._scan_lock:
+      with self._crawl_lock:
+        return self._apply_events_locked(watcher, events)
+
+  def _apply_events_locked(self, watcher, events):
+    dirty = set()
+    for wd, mask, cookie, name in events:
+      if mask & InotifyWatcher.IN_Q_OVERFLOW:
+        self.log.warn('Inotify queue overflowed.')
+        return False
+      if mask & InotifyWatcher.IN_IGNORED:
+        self._watches.pop(wd, None)
+        continue
+      if wd not in self._watches:
+        continue
+      dir_index, rel_dir = self._watches[wd]
+      if mask & (InotifyWatcher.IN_DELETE_SELF | InotifyWatcher.IN_MOVE_SELF):
+        if rel_dir == '.':
+          self.log.warn('Root dir [{}] was moved or deleted.',
+              self.dirs[dir_index])
+          return False
+        continue
+      rel_path = os.path.normpath(os.path.join(rel_dir, name))
+      if not mask & InotifyWatcher.IN_ISDIR:
+        dirty.add((dir_index, rel_path))
+      elif mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+        self._watch_tree(watcher, dir_index, rel_path)
+        crawler = self._crawlers[dir_index]
+        for file_path in crawler.crawl(rel_path):
+          dirty.add((dir_index, file_path))
+      elif mask & (InotifyWatcher.IN_DELETE | InotifyWatcher.IN_MOVED_FROM):
+        self._unwatch_tree(watcher, dir_index, rel_path)
+        prefix = rel_path + os.sep
+        for file_path in self.files[dir_index]:
+          if file_path.startswith(prefix):
+            dirty.add((dir_index, file_path))
+    updates = []
+    removed = []
+    added = []
+    for dir_index, rel_path in dirty:
+      crawler = self._crawlers[dir_index]
+      previous = self.files[dir_index].get(rel_path)
+      inode = crawler.inode(rel_path)
+      entry = crawler.hash_file(rel_path, previous)
+      updates.append((dir_index, rel_path, entry))
+      if previous is not None and entry is None:
+        removed.append((dir_index, rel_path, inode, previous))
+      elif previous is None and entry is not None:
+        added.append((dir_index, rel_path, crawler.inode(rel_path), entry))
+    self._update_files(updates, DirMonitor._find_moves(removed, added))
+    return True
+
+  def _crawl_all(self):
+    with self._scan_lock:
+      with METRICS.timer('crawl_seconds'):
+        for i in range(len(self._crawlers)):
+          self._crawl_root(i)
+
+  def _index_pending(self):
+    '''Crawls the roots that were never indexed, one at a time.'''
+    for i in range(len(self._crawlers)):
+      if self._indexed[i] or not self._is_monitoring:
+        continue
+      self.log.info('Indexing root dir [{}]...', self.dirs[i])
+      with self._scan_lock:
+        with METRICS.timer('crawl_seconds'):
+          self._crawl_root(i, initial=True)
+      self.log.info('Indexed [{}] files of root dir [{}].', len(self.files[i]),
+          self.dirs[i])
+
+  def _crawl_root(self, dir_index, initial=False):
+    '''Crawls one root, only holding self._crawl_lock to apply the results.
+
+    An [initial] crawl applies the files of each top level dir as soon as it
+    is crawled and marks it indexed. Must be called with self._scan_lock held.
+    '''
+    crawler = self._crawlers[dir_index]
+    files = self.files[dir_index]
+    with self._crawl_lock:
+      crawler.start_crawl()
+      self._touched[dir_index] = set()
+    try:
+      updates = []
+      units = [('', not initial)]
+      while units:
+        rel_dir, recursive = units.pop(0)
+        updates.extend(crawler.scan_changes(files, rel_dir, recursive))
+        if not initial:
+          continue
+        with self._crawl_lock:
+          self._update_files(self._crawled(dir_index, updates), crawled=True)
+        updates = []
+        if not rel_dir:
+          units.extend((name, True) for name in sorted(crawler.subdirs()))
+        with self._lock:
+          self._indexed_dirs[dir_index].add(rel_dir)
+          self._changed.notify_all()
+      with self._crawl_lock:
+        updates = self._crawled(dir_index,
+            updates + crawler.removed_files(files))
+        removed = []
+        added = []
+        for _, rel_path, entry in updates:
+          if entry is None:
+            removed.append((dir_index, rel_path, crawler.inode(rel_path),
+                files[rel_path]))
+          elif rel_path not in files:
+            added.append((dir_index, rel_path, crawler.inode(rel_path), entry))
+        self._update_files(updates, DirMonitor._find_moves(removed, added),
+            crawled=True)
+    finally:
+      with self._crawl_lock:
+        self._touched[dir_index] = None
+    with self._lock:
+      self._indexed[dir_index] = True
+      self._indexed_dirs[dir_index] = set()
+      self._changed.notify_all()
+
+  def _crawled(self, dir_index, updates):
+    '''Returns the _update_files() tuples of the crawled [updates] of the
+    root at [dir_index] that nobody else changed since its crawl started.
+    '''
+    touched = self._touched[dir_index]
+    return [(dir_index, rel_path, entry) for rel_path, entry in updates
+        if rel_path not in touched]
+
+  @staticmethod
+  def _find_moves(removed, added):
+    '''Pairs removed and added files with the same inode and contents.
+
+    Both are lists of (dir_index, rel_path, inode, entry). Contents are
+    compared as StateDiffer.differs() does, so unhashed files count as the
+    same if their size and mtime are. Returns a list of (dir_index,
+    old_rel_path, new_rel_path, digest) where the digest may be None.
+    '''
+    if not removed or not added:
+      return []
+    sources = {}
+    for dir_index, rel_path, inode, entry in removed:
+      if inode is not None:
+        sources[(dir_index, inode)] = (rel_path, entry)
+    moves = []
+    for dir_index, rel_path, inode, entry in added:
+      old, old_entry = sources.get((dir_index, inode), (None, None))
+      if old is not None and StateDiffer.differs(entry, old_entry) is False:
+        del sources[(dir_index, inode)]
+        moves.append((dir_index, old, rel_path, entry[1]))
+    return moves
+
+  def _update_files(self, updates, moves=None, crawled=False):
+    '''Applies (dir_index, rel_path, entry) updates to the index in place.
+
+    A None entry means the file no longer exists. [moves] are recorded as
+    returned by _find_moves(). Updates that were not [crawled] win over the
+    results of a crawl of their root that is still running.
+    '''
+    changed = []
+    with self._lock:
+      for dir_index, rel_path, entry in updates:
+        if not crawled and self._touched[dir_index] is not None:
+          self._touched[dir_index].add(rel_path)
+        files = self.files[dir_index]
+        previous = files.get(rel_path)
+        if previous == entry:
+          continue
+        if previous is not None:
+          self._count_size(previous, -1)
+        if entry is None:
+          files.pop(rel_path)
+        else:
+          files[rel_path] = entry
+          self._count_size(entry, 1)
+        changed.append((dir_index, rel_path))
+      self._record_changes(changed, moves)
+
+  def _count_size(self, entry, count):
+    '''Must be called with self._lock held.'''
+    size = StateDiffer.size(entry)
+    self._sizes[size] += count
+    if not self._sizes[size]:
+      del self._sizes[size]
+
+  def _record_changes(self, changed, moves=None):
+    '''Must be called with self._lock held.'''
+    if changed:
+      self.generation += 1
+      self._changed.notify_all()
+      for dir_index, rel_path in changed:
+        self._journal.append((self.generation, dir_index, rel_path))
+      for dir_index, old, new, digest in moves or []:
+        self.log.debug('Detected move of [{}] to [{}].', old, new)
+        self._moves.append((self.generation, dir_index, old, new, digest))
+      self._trim_journal()
+
+  def wait_for_change(self, generation, timeout_secs):
+    '''Blocks until the index moves past [generation] or the timeout.
+
+    Returns whether the index changed.
+    '''
+    deadline = time.time() + timeout_secs
+    with self._lock:
+      while self.generation == generation:
+        remaining_secs = deadline - time.time()
+        if remaining_secs <= 0:
+          return False
+        self._changed.wait(remaining_secs)
+      return True
+
+  def _trim_journal(self):
+    '''Keeps the journal no larger than the index it describes.'''
+    max_entries = max(MIN_JOURNAL_ENTRIES,
+        sum(len(files) for files in self.files))
+    if len(self._journal) <= max_entries:
+      return
+    drop = len(self._journal) - max_entries
+    # Never split a generation so changes_since() stays exact.
+    while drop < len(self._journal) and \
+        self._journal[drop][0] == self._journal[drop - 1][0]:
+      drop += 1
+    self._journal_start = self._journal[drop - 1][0]
+    self._journal = self._journal[drop:]
+    self._moves = [move for move in self._moves
+        if move[0] > self._journal_start]
+
+
+class StreamCompression(object):
+  '''Per-file compression of the FILE_CHUNK streams.'''
+
+  @staticmethod
+  def available():
+    methods = (COMPRESSION_NONE, COMPRESSION_ZLIB)
+    if lzma is not None:
+      methods += (COMPRESSION_LZMA,)
+    return methods
+
+  @staticmethod
+  def is_compressible(file_path, method, level):
+    '''Samples the head of [file_path] to judge if compressing pays off.'''
+    if method == COMPRESSION_NONE:
+      return False
+    with open(file_path, 'rb') as fp:
+      sample = fp.read(COMPRESSION_SAMPLE_BYTES)
+    if len(sample) < COMPRESSION_MIN_SAMPLE_BYTES:
+      return False
+    compressed_bytes = sum(len(data) for data in
+        StreamCompression.compress([sample], method, level))
+    return compressed_bytes <= len(sample) * COMPRESSION_MAX_RATIO
+
+  @staticmethod
+  def compress(pieces, method, level):
+    '''Yields the compressed form of the byte stream in [pieces].'''
+    if method == COMPRESSION_LZMA:
+      compressor = lzma.LZMACompressor(preset=level)
+    else:
+      compressor = zlib.compressobj(level)
+    for data in pieces:
+      data = compressor.compress(data)
+      if data:
+        yield data
+    yield compressor.flush()
+
+  @staticmethod
+  def decompress(chunks, method):
+    '''Yields the decompressed stream in pieces of bounded size.'''
+    if method == COMPRESSION_LZMA:
+      decompressor = lzma.LZMADecompressor()
+      for data in chunks:
+        data = decompressor.decompress(as_buffer(data))
+        if data:
+          yield data
+      return
+    decompressor = zlib.decompressobj()
+    for data in chunks:
+      data = as_buffer(data)
+      while data:
+        output = decompressor.decompress(data, CHUNK_SIZE_BYTES)
+        if output:
+          yield output
+        data = decompressor.unconsumed_tail
+    data = decompressor.flush()
+    if data:
+      yield data
+
+
+class HashingWriter(object):
+  '''Wraps a writable [fp] and hashes everything written through it.'''
+
+  def __init__(self, fp, algorithm):
+    self._fp = fp
+    self._hasher = ContentHash.new(algorithm)
+
+  def write(self, data):
+    self._hasher.update(data)
+    self._fp.write(data)
+
+  def hexdigest(self):
+    return ContentHash.hexdigest(self._hasher)
+
+
+class ChunkReader(object):
+  '''Reads exact byte counts out of an iterator of FILE_CHUNK payloads.'''
+
+  def __init__(self, chunks):
+    self._chunks = iter(chunks)
+    self._buffer = bytearray()
+
+  def read(self, size):
+    '''Returns [size] bytes or fewer only if the chunks ran out.'''
+    while len(self._buffer) < size:
+      data = next(self._chunks, None)
+      if data is None:
+        break
+      self._buffer += data
+    data = self._buffer[:size]
+    del self._buffer[:size]
+    return data
+
+
+class FileWindow(object):
+  '''A bounded read-ahead window over a file that is scanned forward.'''
+
+  def __init__(self, fp):
+    self._fp = fp
+    self._data = b''
+    self._start = 0
+    self._eof = False
+
+  def end(self, offset):
+    '''Returns min(offset, file size) reading ahead as needed.'''
+    while not self._eof and self._start + len(self._data) < offset:
+      data = self._fp.read(CHUNK_SIZE_BYTES)
+      if not data:
+        self._eof = True
+      self._data += data
+    return min(offset, self._start + len(self._data))
+
+  def get(self, start, end):
+    return self._data[start - self._start:end - self._start]
+
+  def byte(self, offset):
+    return ord(self._data[offset - self._start])
+
+  def discard(self, offset):
+    '''Drops data before [offset] once enough of it has been consumed.'''
+    if offset - self._start >= CHUNK_SIZE_BYTES:
+      self._data = self._data[offset - self._start:]
+      self._start = offset
+
+
+class DeltaCodec(object):
+  '''rsync-style delta encoding of a file against block signatures.
+
+  The delta is a byte stream of records:
+  - 'C' + (start_block, block_count): copy blocks from the base file.
+  - 'L' + (length) + data: literal data.
+  '''
+  ADLER_MOD = 65521
+
+  @staticmethod
+  def block_size(file_size):
+    size = int(math.sqrt(file_size))
+    return max(DELTA_MIN_BLOCK_BYTES, min(DELTA_MAX_BLOCK_BYTES, size))
+
+  @staticmethod
+  def weak_hash(data):
+    return zlib.adler32(data) & 0xffffffff
+
+  @staticmethod
+  def roll(weak, out_byte, in_byte, block_size):
+    '''Slides the adler32 [weak] hash of a window one byte forward.'''
+    a = weak & 0xffff
+    b = weak >> 16
+    a = (a - out_byte + in_byte) % DeltaCodec.ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % DeltaCodec.ADLER_MOD
+    return (b << 16) | a
+
+  @staticmethod
+  def strong_hash(data):
+    return hashlib.md5(data).hexdigest()[:16]
+
+  @staticmethod
+  def signatures(path):
+    '''Returns the block signatures of the file in [path].'''
+    with open(path, 'rb') as fp:
+      stat = os.fstat(fp.fileno())
+      block_size = DeltaCodec.block_size(stat.st_size)
+      blocks = []
+      for block in iter(lambda: fp.read(block_size), b''):
+        blocks.append([
+            DeltaCodec.weak_hash(block), DeltaCodec.strong_hash(block)])
+    return {
+      'size': stat.st_size,
+      'mtime': stat.st_mtime,
+      'block_size': block_size,
+      'blocks': blocks,
+    }
+
+  @staticmethod
+  def encode(fp, signatures):
+    '''Yields the delta records that rebuild [fp] from the signed base.'''
+    block_size = signatures['block_size']
+    blocks = signatures['blocks']
+    table = {}
+    for index in range(len(blocks)):
+      weak, strong = blocks[index]
+      table.setdefault(weak, {}).setdefault(strong, index)
+    # The last base block may be shorter and can only match at the very end.
+    tail_bytes = signatures['size'] - (len(blocks) - 1) * block_size
+    window = FileWindow(fp)
+    pos = 0
+    literal_start = 0
+    copy_start = copy_count = 0
+    unmatched_bytes = 0
+    weak = None
+    while True:
+      end = window.end(pos + block_size)
+      if end == pos:
+        break
+      if end - pos < block_size and end - pos != tail_bytes:
+        # Not enough data left to ever match another block.
+        pos = end
+        break
+      if weak is None:
+        weak = DeltaCodec.weak_hash(window.get(pos, end))
+      index = None
+      candidates = table.get(weak)
+      if candidates:
+        index = candidates.get(
+            DeltaCodec.strong_hash(window.get(pos, end)))
+      if index is not None:
+        if literal_start < pos:
+          if copy_count:
+            yield struct.pack('>cII', b'C', copy_start, copy_count)
+            copy_count = 0
+          yield struct.pack('>cI', b'L', pos - literal_start)
+          yield window.get(literal_start, pos)
+        if copy_count and copy_start + copy_count == index:
+          copy_count += 1
+        else:
+          if copy_count:
+            yield struct.pack('>cII', b'C', copy_start, copy_count)
+          copy_start = index
+          copy_count = 1
+        unmatched_bytes = 0
+        pos = end
+        literal_start = pos
+        weak = None
+        window.discard(pos)
+        continue
+      if window.end(end + 1) > end and end - pos == block_size:
+        weak = DeltaCodec.roll(
+            weak, window.byte(pos), window.byte(end), block_size)
+      else:
+        weak = None
+      pos += 1
+      unmatched_bytes += 1
+      if unmatched_bytes >= DELTA_MAX_UNMATCHED_BYTES:
+        # Rolling costs a loop iteration per byte, so long unmatched runs are
+        # skipped a chunk at a time as literals. Rolling over one block after
+        # each skip finds any base block the data lines up with again.
+        pos = window.end(pos + CHUNK_SIZE_BYTES)
+        weak = None
+        unmatched_bytes = DELTA_MAX_UNMATCHED_BYTES - block_size
+      if pos - literal_start >= CHUNK_SIZE_BYTES:
+        if copy_count:
+          yield struct.pack('>cII', b'C', copy_start, copy_count)
+          copy_count = 0
+        yield struct.pack('>cI', b'L', pos - literal_start)
+        yield window.get(literal_start, pos)
+        literal_start = pos
+        window.discard(pos)
+    if copy_count:
+      yield struct.pack('>cII', b'C', copy_start, copy_count)
+    if literal_start < pos:
+      yield struct.pack('>cI', b'L', pos - literal_start)
+      yield window.get(literal_start, pos)
+
+  @staticmethod
+  def apply(base_fp, block_size, chunks, out_fp):
+    '''Writes the file described by the delta in [chunks] to [out_fp].
+
+    Returns the number of bytes written.
+    '''
+    reader = ChunkReader(chunks)
+    written_bytes = 0
+    while True:
+      op = reader.read(1)
+      if not op:
+        return written_bytes
+      if op == b'C':
+        start, count = struct.unpack('>II', reader.read(8))
+        base_fp.seek(start * block_size)
+        remaining = count * block_size
+        while remaining > 0:
+          data = base_fp.read(min(remaining, CHUNK_SIZE_BYTES))
+          if not data:
+            break
+          out_fp.write(data)
+          written_bytes += len(data)
+          remaining -= len(data)
+      elif op == b'L':
+        length, = struct.unpack('>I', reader.read(4))
+        data = reader.read(length)
+        out_fp.write(data)
+        written_bytes += len(data)
+      else:
+        raise HumaReadbleException(
+            'Unknown delta record [{}].'.format(repr(op)))
+
+
+class MerkleTree(object):
+  '''Summarises one root dir with a hash per directory.
+
+  The hash of a directory is the XOR of one leaf hash per file below it,
+  derived from the rel_path and the content digest. XOR lets a file change
+  update its ancestors in O(depth) without rehashing any sibling, and two
+  trees hold the same files iff their root hashes match. [lazy] trees derive
+  leaves from the size and mtime only, so they match the trees of lazy peers
+  that do not have the digests.
+  '''
+
+  def __init__(self, files=None, lazy=False):
+    self._lazy = lazy
+    # Maps rel_dir => hash of every file below it. The root dir is ''.
+    self._hashes = {}
+    # Maps rel_dir => set of child rel_dirs.
+    self._dirs = {}
+    # Maps rel_dir => set of rel_paths of the files directly in it.
+    self._files = {}
+    for rel_path, entry in (files or {}).items():
+      self.update(rel_path, None, entry)
+
+  def dir_hash(self, rel_dir=''):
+    return self._hashes.get(rel_dir, 0)
+
+  def update(self, rel_path, old_entry, new_entry):
+    '''Replaces [old_entry] of [rel_path] with [new_entry].
+
+    Either entry is None if the file did not or no longer exists. The entries
+    have the format of DirCrawler.crawl_and_hash().
+    '''
+    if old_entry is None and new_entry is None:
+      return
+    leaf = 0
+    if old_entry is not None:
+      leaf ^= MerkleTree._leaf(rel_path, old_entry, self._lazy)
+    if new_entry is not None:
+      leaf ^= MerkleTree._leaf(rel_path, new_entry, self._lazy)
+    rel_dir = os.path.dirname(rel_path)
+    if old_entry is None:
+      self._files.setdefault(rel_dir, set()).add(rel_path)
+    elif new_entry is None:
+      self._files[rel_dir].discard(rel_path)
+    child = None
+    while True:
+      self._hashes[rel_dir] = self._hashes.get(rel_dir, 0) ^ leaf
+      if child is not None:
+        if new_entry is None and child not in self._hashes:
+          self._dirs[rel_dir].discard(child)
+        else:
+          self._dirs.setdefault(rel_dir, set()).add(child)
+      if new_entry is None and rel_dir and not self._files.get(rel_dir) and \
+          not self._dirs.get(rel_dir):
+        # Prune dirs without files so they do not linger in the walk.
+        self._hashes.pop(rel_dir, None)
+        self._files.pop(rel_dir, None)
+        self._dirs.pop(rel_dir, None)
+      if not rel_dir:
+        break
+      child = rel_dir
+      rel_dir = os.path.dirname(rel_dir)
+
+  def diff(self, files, other, other_files):
+    '''Returns the rel_paths in [files] missing or different in [other_files].
+
+    [files] and [other_files] are the dicts summarised by this tree and
+    [other]. Only dirs whose hashes differ are walked.
+    '''
+    results = []
+    pending = ['']
+    while pending:
+      rel_dir = pending.pop()
+      if self.dir_hash(rel_dir) == other.dir_hash(rel_dir):
+        continue
+      for rel_path in self._files.get(rel_dir, ()):
+        if StateDiffer.differs(files[rel_path], other_files.get(rel_path)) \
+            is not False:
+          results.append(rel_path)
+      pending.extend(self._dirs.get(rel_dir, ()))
+    return results
+
+  @staticmethod
+  def _leaf(rel_path, entry, lazy=False):
+    if not isinstance(rel_path, bytes):
+      rel_path = rel_path.encode('utf-8')
+    digest = entry[1]
+    if digest is None or lazy:
+      # Files a lazy crawler did not hash are summarised by their metadata.
+      # Mtimes are in ms as those set on written copies may not round trip.
+      digest = 'size={} mtime={}'.format(
+          StateDiffer.size(entry), int(round(entry[0] * 1000)))
+    return int(hashlib.md5(rel_path + b'\0' + digest).hexdigest(), 16)
+
+
+class FileIndexDir(object):
+  '''One dir of a FileIndex.'''
+  __slots__ = ('path', 'files', 'dirs', 'hash')
+
+  def __init__(self, path):
+    # The rel_dir, the one string of it all files and children share.
+    self.path = path
+    # Maps file names => packed records of the files directly in the dir.
+    self.files = {}
+    # The rel_dirs of the child dirs.
+    self.dirs = set()
+    # MerkleTree hash of every file below the dir.
+    self.hash = 0
+
+
+class FileIndex(object):
+  '''Compact mapping of rel_paths to the entries of a root dir's files.
+
+  It behaves like the dicts DirCrawler.crawl_and_hash() returns, but files
+  are grouped by dir so every dir path is stored once and only a name is
+  kept per file. Each entry is packed into one string holding the mtime, the
+  size and the raw digest bytes, half the size of the hex digest alone. Every
+  dir also holds the MerkleTree hash of its files, so a FileIndex can take
+  the place of the MerkleTree of its own files and is updated in place.
+  '''
+  RECORD = struct.Struct('<dq')
+
+  def __init__(self, files=None, lazy=False):
+    # Whether the MerkleTree hashes are [lazy] ones.
+    self._lazy = lazy
+    # Maps rel_dir => FileIndexDir. The root dir is ''.
+    self._dirs = {'': FileIndexDir('')}
+    # Maps raw digests => (rel_dir, name) or a list of them if many files
+    # have the same contents.
+    self._by_digest = {}
+    self._size = 0
+    for rel_path, entry in (files or {}).items():
+      self[rel_path] = entry
+
+  def __len__(self):
+    return self._size
+
+  def __contains__(self, rel_path):
+    rel_dir, name = os.path.split(rel_path)
+    node = self._dirs.get(rel_dir)
+    return node is not None and name in node.files
+
+  def __iter__(self):
+    for rel_dir, node in list(self._dirs.items()):
+      for name in list(node.files):
+        yield os.path.join(rel_dir, name)
+
+  def __getitem__(self, rel_path):
+    entry = self.get(rel_path)
+    if entry is None:
+      raise KeyError(rel_path)
+    return entry
+
+  def __setitem__(self, rel_path, entry):
+    digest = entry[1]
+    size = StateDiffer.size(entry)
+    raw_digest = b''
+    if digest is not None:
+      raw_digest = binascii.unhexlify(digest)
+    rel_dir, name = os.path.split(rel_path)
+    node = self._dirs.get(rel_dir)
+    if node is None:
+      node = self._add_dir(rel_dir)
+    rel_dir = node.path
+    old_record = node.files.get(name)
+    leaf = MerkleTree._leaf(rel_path, entry, self._lazy)
+    if old_record is None:
+      self._size += 1
+    else:
+      leaf ^= MerkleTree._leaf(
+          rel_path, FileIndex._unpack(old_record), self._lazy)
+      self._unlink_digest(old_record[FileIndex.RECORD.size:], rel_dir, name)
+    node.files[name] = FileIndex.RECORD.pack(
+        entry[0], -1 if size is None else size) + raw_digest
+    self._link_digest(raw_digest, rel_dir, name)
+    self._update_hashes(rel_dir, leaf)
+
+  def __delitem__(self, rel_path):
+    if self.pop(rel_path) is None:
+      raise KeyError(rel_path)
+
+  def get(self, rel_path, default=None):
+    rel_dir, name = os.path.split(rel_path)
+    node = self._dirs.get(rel_dir)
+    if node is None:
+      return default
+    record = node.files.get(name)
+    if record is None:
+      return default
+    return FileIndex._unpack(record)
+
+  def pop(self, rel_path, default=None):
+    rel_dir, name = os.path.split(rel_path)
+    node = self._dirs.get(rel_dir)
+    if node is None or name not in node.files:
+      return default
+    rel_dir = node.path
+    record = node.files.pop(name)
+    self._size -= 1
+    entry = FileIndex._unpack(record)
+    self._unlink_digest(record[FileIndex.RECORD.size:], rel_dir, name)
+    self._update_hashes(
+        rel_dir, MerkleTree._leaf(rel_path, entry, self._lazy))
+    self._prune_dirs(rel_dir)
+    return entry
+
+  def keys(self):
+    return list(self)
+
+  def iteritems(self):
+    for rel_dir, node in list(self._dirs.items()):
+      for name, record in list(node.files.items()):
+        yield (os.path.join(rel_dir, name), FileIndex._unpack(record))
+
+  def items(self):
+    return list(self.iteritems())
+
+  def dir_hash(self, rel_dir=''):
+    node = self._dirs.get(rel_dir)
+    if node is None:
+      return 0
+    return node.hash
+
+  def find(self, digest):
+    '''Returns the rel_path of a file whose contents hash to [digest].
+
+    Returns None if there is none.
+    '''
+    paths = self._by_digest.get(binascii.unhexlify(digest))
+    if paths is None:
+      return None
+    if isinstance(paths, list):
+      paths = paths[0]
+    return os.path.join(*paths)
+
+  @staticmethod
+  def _unpack(record):
+    mtime, size = FileIndex.RECORD.unpack_from(record)
+    digest = None
+    if len(record) > FileIndex.RECORD.size:
+      digest = binascii.hexlify(record[FileIndex.RECORD.size:])
+    return (mtime, digest, None if size < 0 else size)
+
+  def _add_dir(self, rel_dir):
+    node = FileIndexDir(rel_dir)
+    self._dirs[rel_dir] = node
+    parent = os.path.dirname(rel_dir)
+    parent_node = self._dirs.get(parent)
+    if parent_node is None:
+      parent_node = self._add_dir(parent)
+    parent_node.dirs.add(rel_dir)
+    return node
+
+  def _update_hashes(self, rel_dir, leaf):
+    '''XORs [leaf] into the hashes of [rel_dir] and every dir above it.'''
+    while True:
+      self._dirs[rel_dir].hash ^= leaf
+      if not rel_dir:
+        break
+      rel_dir = os.path.dirname(rel_dir)
+
+  def _prune_dirs(self, rel_dir):
+    '''Removes [rel_dir] and the dirs above it left without any file.'''
+    while rel_dir:
+      node = self._dirs[rel_dir]
+      if node.files or node.dirs:
+        break
+      del self._dirs[rel_dir]
+      parent = os.path.dirname(rel_dir)
+      self._dirs[parent].dirs.discard(rel_dir)
+      rel_dir = parent
+
+  def _link_digest(self, raw_digest, rel_dir, name):
+    if not raw_digest:
+      return
+    paths = self._by_digest.get(raw_digest)
+    if paths is None:
+      # Most contents are unique, so skip the list for them.
+      self._by_digest[raw_digest] = (rel_dir, name)
+    elif isinstance(paths, list):
+      paths.append((rel_dir, name))
+    else:
+      self._by_digest[raw_digest] = [paths, (rel_dir, name)]
+
+  def _unlink_digest(self, raw_digest, rel_dir, name):
+    if not raw_digest:
+      return
+    paths = self._by_digest.get(raw_digest)
+    if paths is None:
+      return
+    if isinstance(paths, list):
+      paths.remove((rel_dir, name))
+      if len(paths) == 1:
+        self._by_digest[raw_digest] = paths[0]
+    elif paths == (rel_dir, name):
+      del self._by_digest[raw_digest]
+
+
+class StateDiffer(object):
+  def __init__(self):
+    pass
+
+  def diff(self, src, dst, src_trees=None, dst_trees=None):
+    '''Returns all files from src that need to be uploaded to dst
+
+    Both [src] and [dst] should be lists containing dict() with the same
+    exact format as returned from the DirCrawler.crawl_and_hash() method.
+    If both [src_trees] and [dst_trees] are given with one MerkleTree per
+    dict, only the subtrees that differ are compared.
+
+    Returns a tuple. Each position contains the files that need to be uploaded
+    for that same index in [src].
+    '''
+    # Always return no diff
+    assert len(src) == len(dst), \
+        ('Both local and remote need to be monitoring the same amount of '
+            'dirs. local_dirs=[{}] remote_dirs=[{}]').format(len(src), len(dst))
+    dir_count = len(src)
+    results = []
+    if src_trees is not None and dst_trees is not None:
+      for i in range(dir_count):
+        results.append(src_trees[i].diff(src[i], dst_trees[i], dst[i]))
+      return results
+    for i in range(dir_count):
+      src_dir = src[i]
+      dst_dir = dst[i]
+      current_diff = []
+      results.append(current_diff)
+      for path, entry in src_dir.items():
+        assert not os.path.isabs(path), path
+        if StateDiffer.differs(entry, dst_dir.get(path)) is not False:
+          current_diff.append(path)
+    return results
+
+  @staticmethod
+  def differs(entry, other):
+    '''Returns whether [other] has different contents than [entry].
+
+    Digests are compared when both entries have one. Otherwise files of the
+    same size and mtime are taken to be the same and files of different sizes
+    to differ. Returns None if only the digests can tell.
+    '''
+    if other is None:
+      return True
+    if entry[1] is not None and other[1] is not None:
+      return entry[1] != other[1]
+    size = StateDiffer.size(entry)
+    other_size = StateDiffer.size(other)
+    if size is not None and other_size is not None and size != other_size:
+      return True
+    if size == other_size and \
+        abs(entry[0] - other[0]) <= MTIME_TOLERANCE_SECS:
+      return False
+    return None
+
+  @staticmethod
+  def size(entry):
+    '''Returns the size of an entry or None if it does not have one.'''
+    if len(entry) > 2:
+      return entry[2]
+    return None
+
+
+
+#########################################################
+# Remote Server Classes
+#########################################################
+class RemoteServer(object):
+  def __init__(self, args):
+    self.log = Logger(type(self).__name__)
+    self.log.debug('Initializing...')
+    self._args = args
+    self._monitor = DirMonitor(args.dirs, args.monitor,
+        HashPool(args.hash_workers, args.hash_pool), args.index_dir, args.hash,
+        args.exclude, args.gitignore, args.lazy_hash, background_index=True)
+    self._msg_handler = RemoteMessageHandler(self._monitor, args.dedup,
+        args.write_workers, args.durability)
+
+  def __enter__(self):
+    self.log.debug('Entering...')
+    self._socket = create_socket(self._args.ip_version)
+    self._socket.bind(('', self._args.port))
+    self._socket.listen(SERVER_LISTEN_BACKLOG)
+    # Builds the index in the background while clients already connect.
+    self._monitor.start_monitoring()
+    return self
+
+  def run(self):
+    self.log.debug('Running...')
+    # __exit__() may clear self._socket at any time from another thread.
+    server_socket = self._socket
+    self.log.info('Listening for incoming connections in port [{}]...',
+        server_socket.getsockname()[1])
     while True:
-      self.log.info('Listening for incoming connections in port [{}]...'.format(
-          self._args.port))
-      self._socket.listen(1)
-      connection, address = self._socket.accept()
+      try:
+        connection, address = server_socket.accept()
+      except socket.error:
+        if self._socket is None:
+          self.log.info('Server socket closed. Stopping.')
+          return
+        raise
       connection.settimeout(SOCKET_TIMEOUT_SECS)
-      self.log.info('Accepted connection from address: [{}]'.format(
-          str(address)))
-      with StreamHandler(self._args.token, connection) as streamHandler:
-        while True:
-          try:
-            request = streamHandler.recvMessage()
-            response = self._msg_handler.handle_message(request)
-            assert response.type % 2 == 1, \
-                ('All responses must be of an odd type. '
-                    'Found type [{}] instead.').format(response.type_str())
-            streamHandler.sendMessage(response)
-          except socket.timeout:
-            self.log.warn('Socket timed out. Closing the connection.')
-            break
-          except socket.error:
-            self.log.warn('Remote client disconneded. Closing the connection.')
-            break
+      self.log.info('Accepted connection from address: [{}]', str(address))
+      # Every client gets its own thread so independent clients diff and
+      # upload concurrently. FileWriter serialises writes per root dir.
+      thread = threading.Thread(target=self._serve_connection,
+          args=(connection, address), name='Connection{}'.format(address))
+      thread.daemon = True
+      thread.start()
+
+  def _serve_connection(self, connection, address):
+    with StreamHandler(self._args.token, connection) as streamHandler:
+      while True:
+        try:
+          # Clients stay connected while idle and only ping now and then.
+          request = streamHandler.recvMessage(SERVER_IDLE_TIMEOUT_SECS)
+          response = self._msg_handler.handle_message(
+              request, streamHandler)
+          assert response.type % 2 == 1, \
+              ('All responses must be of an odd type. '
+                  'Found type [{}] instead.').format(response.type_str())
+          streamHandler.sendMessage(response)
+        except socket.timeout:
+          self.log.warn('Socket timed out. Closing the connection.')
+          break
+        except socket.error:
+          self.log.warn('Remote client disconneded. Closing the connection.')
+          break
+        except HumaReadbleException as exception:
+          self.log.error('Closing the connection to [{}] after [{}].', address,
+              exception.msg)
+          break
 
   def __exit__(self, exc_type, exc_value, traceback):
     self.log.debug('Exiting...')
     if exc_type and exc_value and traceback:
-      self.log.error('Received exception type=[{}] value=[{}] traceback=[{}]'\
-          .format(exc_type, exc_value, traceback))
+      self.log.error('Received exception type=[{}] value=[{}] traceback=[{}]',
+          exc_type, exc_value, traceback)
     if self._socket:
-      self._socket.close()
+      server_socket = self._socket
       self._socket = None
+      # Wakes up a run() blocked in accept().
+      try:
+        server_socket.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+      server_socket.close()
     if self._monitor:
       self._monitor.stop_monitoring()
       self._monitor = None
 
 
 class FileWriter(object):
-  def __init__(self, dirs):
+  '''Writes uploaded files into temp files and renames them into place.
+
+  Streamed files are handed to a small pool of writer threads, one file per
+  thread at a time, so the connection keeps reading the next file while the
+  disk catches up. Nothing is renamed into place before the whole batch was
+  written, so readers never see a partially written file.
+  '''
+  _libc = None
+
+  def __init__(self, dirs, dedup=None, monitor=None, workers=None,
+      durability=None):
     self.log = Logger(type(self).__name__)
     self._dirs = dirs
+    self._dedup = dedup or DEDUP_COPY
+    # Told about every written file so it never rehashes or re-requests it.
+    self._monitor = monitor
+    self._workers = max(1, workers or DEFAULT_WRITE_WORKERS)
+    self._durability = durability or DURABILITY_BATCH
+    # Only clients writing into the same root dir wait for each other.
+    self._root_locks = [threading.Lock() for root in dirs]
+
+  def write(self, files, stream_handler, copies=None, algorithm=None):
+    '''Writes the contents streamed by [stream_handler] to disk.
+
+    [files] contains one list per root dir with a
+    [rel_path, size, delta, compression, mtime] entry for each file, in the
+    same order their FILE_CHUNK streams follow. The delta is None for full
+    contents or describes the base file the streamed DeltaCodec records
+    apply to. The compression is None if the stream is not compressed. The
+    mtime is optional and set on the written file so lazily hashed copies
+    compare equal without reading them.
+
+    [copies] optionally contains one dict per root dir mapping rel_paths to
+    [src_dir_index, src_rel_path, digest] of a local file with the same
+    contents. Those are copied before any streamed file is written.
+
+    The [algorithm] digest of every file is computed while it is written.
+    '''
+    algorithm = algorithm or HASH_MD5
+    copies = copies or []
+    roots = set(i for i in range(len(files)) if files[i])
+    for i in range(len(copies)):
+      if copies[i]:
+        roots.add(i)
+        roots.update(src[0] for src in copies[i].values())
+    # Each written file appends (dir_index, rel_path, path, tmp_path, bytes,
+    # digest) once its temp file is complete.
+    written = []
+    locks = self._lock_roots(roots)
+    try:
+      for i in range(len(copies)):
+        for rel_path, (src_index, src_rel_path, digest) in copies[i].items():
+          assert not os.path.isabs(rel_path), rel_path
+          assert not os.path.isabs(src_rel_path), src_rel_path
+          path = os.path.join(self._dirs[i], rel_path)
+          src_path = os.path.join(self._dirs[src_index], src_rel_path)
+          tmp_path = FileWriter._tmp_path(path)
+          try:
+            copied_bytes = self._copy_file(src_path, tmp_path, digest,
+                algorithm)
+            written.append((i, rel_path, path, tmp_path, copied_bytes, digest))
+          except (IOError, OSError) as exception:
+            self.log.error('Failed to copy [{}] to [{}] with [{}].', src_path,
+                path, exception)
+      self._write_streams(files, stream_handler, algorithm, written)
+      return self._commit(written, algorithm)
+    finally:
+      self._unlock_roots(locks)
+      # Anything not renamed into place belongs to a failed batch.
+      for entry in written:
+        if os.path.exists(entry[3]):
+          os.remove(entry[3])
+
+  def rename(self, renames, algorithm=None):
+    '''Moves files the client moved without transferring any content.
+
+    [renames] contains one list per root dir of [old_rel_path, new_rel_path,
+    digest]. Files the server does not have with that digest are skipped,
+    the next diff uploads them instead. Returns the number of renamed files.
+    '''
+    algorithm = algorithm or HASH_MD5
+    renamed_files = 0
+    dirnames = set()
+    locks = self._lock_roots(i for i in range(len(renames)) if renames[i])
+    try:
+      with self._index_lock():
+        for i in range(len(renames)):
+          for old, new, digest in renames[i]:
+            if self._rename_file(i, old, new, digest, algorithm, dirnames):
+              renamed_files += 1
+      if self._durability != DURABILITY_NONE:
+        for dirname in dirnames:
+          # A later rename of the batch may have removed it when emptied.
+          if os.path.isdir(dirname):
+            FileWriter._fsync_path(dirname)
+    finally:
+      self._unlock_roots(locks)
+    self.log.info('Renamed a total of [{}] files.', renamed_files)
+    return renamed_files
+
+  def _rename_file(self, dir_index, old, new, digest, algorithm, dirnames):
+    '''Returns True if [old] was renamed and adds the dirs it touched.'''
+    assert not os.path.isabs(old), old
+    assert not os.path.isabs(new), new
+    if self._monitor:
+      entry = self._monitor.get_files()[dir_index].get(old)
+      if entry is not None and entry[1] is None and digest is not None:
+        self._monitor.ensure_digests(dir_index, [old])
+        entry = self._monitor.get_files()[dir_index].get(old)
+      if entry is None or entry[1] != digest:
+        self.log.info('Not renaming [{}] as its contents differ.', old)
+        return False
+    root = self._dirs[dir_index]
+    old_path = os.path.join(root, old)
+    path = os.path.join(root, new)
+    try:
+      dirname = os.path.dirname(path)
+      FileWriter._make_dirs(dirname)
+      os.rename(old_path, path)
+      dirnames.add(dirname)
+      dirnames.add(self._remove_empty_dirs(root, os.path.dirname(old)))
+      if self._monitor:
+        self._monitor.record_moved(
+            dir_index, old, new, os.stat(path), algorithm, digest)
+      return True
+    except (IOError, OSError) as exception:
+      self.log.error('Failed to rename [{}] to [{}] with [{}].', old_path, path,
+          exception)
+      return False
 
-  def write(self, files):
+  def _remove_empty_dirs(self, root, rel_dir):
+    '''Removes [rel_dir] and its parents while they are empty.
+
+    Returns the closest existing dir.
+    '''
+    while rel_dir:
+      path = os.path.join(root, rel_dir)
+      try:
+        os.rmdir(path)
+      except OSError:
+        return path
+      rel_dir = os.path.dirname(rel_dir)
+    return root
+
+  def _lock_roots(self, roots):
+    # Always locked in index order so two writers cannot deadlock.
+    locks = [self._root_locks[i] for i in sorted(set(roots))]
+    for lock in locks:
+      lock.acquire()
+    return locks
+
+  def _unlock_roots(self, locks):
+    for lock in reversed(locks):
+      lock.release()
+
+  def _write_streams(self, files, stream_handler, algorithm, written):
+    '''Writes every streamed file of the batch into its temp file.'''
+    jobs = []
+    for i in range(len(files)):
+      for entry in files[i]:
+        rel_path, size, delta, compression = entry[:4]
+        assert not os.path.isabs(rel_path), rel_path
+        mtime = entry[4] if len(entry) > 4 else None
+        jobs.append((i, rel_path, size, delta, compression, mtime))
+    if not jobs:
+      return
+    queues = []
+    threads = []
+    for unused in range(min(self._workers, len(jobs))):
+      pending = Queue.Queue(WRITE_QUEUE_CHUNKS)
+      thread = threading.Thread(target=self._worker_main,
+          args=(pending, algorithm, written), name='FileWriterThread')
+      thread.daemon = True
+      thread.start()
+      queues.append(pending)
+      threads.append(thread)
+    try:
+      for job_index in range(len(jobs)):
+        # Round robin keeps the files of each thread in stream order.
+        pending = queues[job_index % len(queues)]
+        pending.put(jobs[job_index])
+        try:
+          for data in stream_handler.recvChunks():
+            pending.put(data)
+        except SkippedFileException:
+          # The client could not read it, so the current copy is kept.
+          self.log.warn('Client skipped file [{}].', jobs[job_index][1])
+          pending.put(_ABORT_WRITE)
+          continue
+        except:
+          pending.put(_ABORT_WRITE)
+          raise
+        pending.put(None)
+    finally:
+      for pending in queues:
+        pending.put(None)
+      for thread in threads:
+        thread.join()
+
+  def _worker_main(self, pending, algorithm, written):
+    while True:
+      job = pending.get()
+      if not isinstance(job, tuple):
+        return
+      dir_index, rel_path, size, delta, compression, mtime = job
+      root = self._dirs[dir_index]
+      self.log.debug('Writing [{}] bytes to root=[{}] file=[{}]...', size, root,
+          rel_path)
+      path = os.path.join(root, rel_path)
+      tmp_path = FileWriter._tmp_path(path)
+      chunks = FileWriter._queued_chunks(pending)
+      data_chunks = chunks
+      if compression:
+        data_chunks = StreamCompression.decompress(chunks, compression)
+      try:
+        if delta is None:
+          written_bytes, digest = self._write_file(
+              tmp_path, size, data_chunks, algorithm)
+        else:
+          written_bytes, digest = self._write_delta(
+              path, tmp_path, size, delta, data_chunks, algorithm)
+        if mtime is not None:
+          os.utime(tmp_path, (mtime, mtime))
+        written.append(
+            (dir_index, rel_path, path, tmp_path, written_bytes, digest))
+      except Exception as exception:
+        self.log.error('Failed to write file [{}] with [{}].', path, exception)
+        if os.path.exists(tmp_path):
+          os.remove(tmp_path)
+      finally:
+        # Keep the queue in sync even if the file could not be written.
+        try:
+          for unused in chunks:
+            pass
+        except IOError:
+          pass
+
+  @staticmethod
+  def _queued_chunks(pending):
+    while True:
+      data = pending.get()
+      if data is None:
+        return
+      if data is _ABORT_WRITE:
+        raise IOError('The upload was aborted.')
+      yield data
+
+  def _commit(self, written, algorithm):
+    '''Renames the temp files of a batch into place.
+
+    Returns a tuple (total_files, total_bytes).
+    '''
+    if self._durability == DURABILITY_BATCH:
+      for entry in written:
+        FileWriter._fsync_path(entry[3])
     total_files = 0
     total_bytes = 0
-    try:
-      for i in range(len(files)):
-        root = self._dirs[i]
-        for rel_path, b64contents in files[i].items():
-          contents = base64.b64decode(b64contents)
-          self.log.debug('Writing [{}] bytes to root=[{}] file=[{}]...'\
-              .format(len(contents), root, rel_path))
-          path = os.path.join(root, rel_path)
-          dirname = os.path.dirname(path)
-          if not os.path.isdir(dirname):
-            os.makedirs(dirname)
-          with open(path, 'wb') as fp:
-            fp.write(contents)
+    dirnames = set()
+    with self._index_lock():
+      for dir_index, rel_path, path, tmp_path, written_bytes, digest in written:
+        try:
+          os.rename(tmp_path, path)
           total_files += 1
-          total_bytes += len(contents)
+          total_bytes += written_bytes
+          dirnames.add(os.path.dirname(path))
+          self._record(dir_index, rel_path, path, algorithm, digest)
+        except (IOError, OSError) as exception:
+          self.log.error('Failed to rename [{}] into place with [{}].', path,
+              exception)
+    if self._durability != DURABILITY_NONE:
+      # Makes the renames themselves durable, once per directory.
+      for dirname in dirnames:
+        FileWriter._fsync_path(dirname)
+    METRICS.increment('files_written', total_files)
+    METRICS.increment('bytes_written', total_bytes)
+    self.log.info('Wrote a total of [{}] files and [{}] bytes.', total_files,
+        total_bytes)
+    return (total_files, total_bytes)
+
+  def _index_lock(self):
+    if self._monitor:
+      return self._monitor.index_lock()
+    return threading.Lock()
+
+  def _record(self, dir_index, rel_path, path, algorithm, digest):
+    if self._monitor:
+      self._monitor.record_written(
+          dir_index, rel_path, os.stat(path), algorithm, digest)
+
+  @staticmethod
+  def _tmp_path(path):
+    return os.path.join(os.path.dirname(path),
+        '.{}{}'.format(os.path.basename(path), TMP_FILE_SUFFIX))
+
+  @staticmethod
+  def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  @staticmethod
+  def _preallocate(fp, size):
+    '''Reserves [size] bytes for [fp] up front to limit fragmentation.'''
+    if size < PREALLOCATE_MIN_BYTES:
+      return
+    if FileWriter._libc is None and sys.platform.startswith('linux'):
+      try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.fallocate.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        FileWriter._libc = libc
+      except (OSError, AttributeError):
+        FileWriter._libc = False
+    if FileWriter._libc:
+      # Failures are harmless, the filesystem may simply not support it.
+      FileWriter._libc.fallocate(fp.fileno(), 0, 0, size)
+
+  @staticmethod
+  def _make_dirs(dirname):
+    '''Creates [dirname] even if other writer threads race to create it.'''
+    try:
+      os.makedirs(dirname)
+    except OSError as exception:
+      if exception.errno != errno.EEXIST:
+        raise
+
+  def _open_tmp(self, tmp_path, size):
+    FileWriter._make_dirs(os.path.dirname(tmp_path))
+    fp = open(tmp_path, 'wb')
+    FileWriter._preallocate(fp, size)
+    return fp
+
+  def _close_tmp(self, fp, written_bytes):
+    # The file may have shrunk on the client since its size was sent.
+    fp.truncate(written_bytes)
+    if self._durability == DURABILITY_FILE:
+      fp.flush()
+      os.fsync(fp.fileno())
+    fp.close()
+
+  def _write_file(self, tmp_path, size, chunks, algorithm):
+    '''Returns a tuple (written_bytes, digest).'''
+    written_bytes = 0
+    fp = self._open_tmp(tmp_path, size)
+    try:
+      writer = HashingWriter(fp, algorithm)
+      for data in chunks:
+        writer.write(data)
+        written_bytes += len(data)
     finally:
-      self.log.info('Wrote a total of [{}] files and [{}] bytes.'\
-          .format(total_files, total_bytes))
+      self._close_tmp(fp, written_bytes)
+    return (written_bytes, writer.hexdigest())
+
+  def _copy_file(self, src_path, tmp_path, digest, algorithm):
+    '''Materialises [tmp_path] from [src_path] if it hashes to [digest].
+
+    Returns the number of bytes copied, zero when hardlinked.
+    '''
+    FileWriter._make_dirs(os.path.dirname(tmp_path))
+    try:
+      if self._dedup == DEDUP_HARDLINK:
+        if ContentHash.hash_file(src_path, algorithm) != digest:
+          raise IOError('Source contents changed since the diff.')
+        try:
+          os.link(src_path, tmp_path)
+          return 0
+        except OSError as exception:
+          self.log.warn('Copying [{}] as it cannot be hardlinked [{}].',
+              src_path, exception)
+      with open(src_path, 'rb') as src_fp:
+        copied_bytes, copied_digest = self._write_file(tmp_path,
+            os.fstat(src_fp.fileno()).st_size,
+            iter(lambda: src_fp.read(BUFFER_SIZE_BYTES), b''), algorithm)
+      if copied_digest != digest:
+        raise IOError('Source contents changed since the diff.')
+      return copied_bytes
+    except:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+
+  def _write_delta(self, path, tmp_path, size, delta, chunks, algorithm):
+    '''Returns a tuple (written_bytes, digest).'''
+    with open(path, 'rb') as base_fp:
+      file_stat = os.fstat(base_fp.fileno())
+      if file_stat.st_size != delta['size'] or \
+          file_stat.st_mtime != delta['mtime']:
+        raise IOError('Base file changed since its signatures were sent.')
+      written_bytes = 0
+      fp = self._open_tmp(tmp_path, size)
+      try:
+        writer = HashingWriter(fp, algorithm)
+        written_bytes = DeltaCodec.apply(
+            base_fp, delta['block_size'], chunks, writer)
+      finally:
+        self._close_tmp(fp, written_bytes)
+    return (written_bytes, writer.hexdigest())
+
+
+class ClientSession(object):
+  '''The merged view the server keeps of one client's files.'''
+
+  def __init__(self, session_id, lazy=False):
+    self.id = session_id
+    # Whether the trees are lazy MerkleTrees, like the server's own.
+    self.lazy = lazy
+    self.generation = None
+    self.files = None
+    self.trees = None
+    self.last_used = time.time()
+
+  def apply(self, body):
+    '''Merges a DIFF_REQUEST body into this view.
+
+    Returns False if the request is a delta against a generation this session
+    does not hold, in which case the client must resend a full manifest.
+    '''
+    self.last_used = time.time()
+    if 'files' in body:
+      self.files = [dict(files) for files in body['files']]
+      self.trees = [MerkleTree(files, self.lazy) for files in self.files]
+    elif self.files is None or body.get('base_generation') != self.generation:
+      return False
+    else:
+      changes = body['changes']
+      assert len(changes) == len(self.files), \
+          'Changes for [{}] dirs but session has [{}].'.format(
+              len(changes), len(self.files))
+      for i in range(len(changes)):
+        files = self.files[i]
+        tree = self.trees[i]
+        for rel_path, entry in changes[i]['changed'].items():
+          tree.update(rel_path, files.get(rel_path), entry)
+          files[rel_path] = entry
+        for rel_path in changes[i]['removed']:
+          tree.update(rel_path, files.pop(rel_path, None), None)
+    self.generation = body['generation']
+    return True
 
 
 class RemoteMessageHandler(object):
-  def __init__(self, monitor):
+  def __init__(self, monitor, dedup=None, write_workers=None,
+      durability=None):
     self.log = Logger(type(self).__name__)
     self._monitor = monitor
-    self._differ = StateDiffer()
-    self._writer = FileWriter(self._monitor.get_dirs())
+    self._dedup = dedup or DEDUP_COPY
+    self._writer = FileWriter(self._monitor.get_dirs(), self._dedup,
+        self._monitor, write_workers, durability)
+    self._sessions = {}
+    self._sessions_lock = threading.Lock()
+
+  def _get_session(self, session_id):
+    with self._sessions_lock:
+      session = self._sessions.get(session_id)
+      if session is None:
+        if len(self._sessions) >= MAX_CLIENT_SESSIONS:
+          oldest = min(self._sessions.values(), key=lambda s: s.last_used)
+          self.log.info('Evicting client session [{}].', oldest.id)
+          del self._sessions[oldest.id]
+        session = ClientSession(session_id, self._monitor.is_lazy())
+        self._sessions[session_id] = session
+      return session
 
-  def handle_message(self, req):
+  def handle_message(self, req, stream_handler):
     resp = None
-    self.log.info('RemoteMessageHandler received message of type [{}].'\
-        .format(req.type_str()))
+    self.log.info('RemoteMessageHandler received message of type [{}].',
+        req.type_str())
     # MessageType.PING_REQUEST
     if req.type == MessageType.PING_REQUEST:
       resp = Message(MessageType.PING_RESPONSE)
+      # The server algorithm wins as it may be shared by many clients.
+      algorithm = self._monitor.get_hash_algorithm()
+      if algorithm not in req.body.get('hash_algorithms', [algorithm]):
+        self.log.warn('Client does not support hash algorithm [{}].', algorithm)
+      resp.body['hash_algorithm'] = algorithm
+      resp.body['indexing'] = self._monitor.indexing_progress()
+      resp.body['compression'] = COMPRESSION_NONE
+      for compression in req.body.get('compressions', []):
+        if compression in StreamCompression.available():
+          resp.body['compression'] = compression
+          break
     # MessageType.DIFF_REQUEST
     elif req.type == MessageType.DIFF_REQUEST:
       resp = Message(MessageType.DIFF_RESPONSE)
-      diff = self._differ.diff(req.body['files'], self._monitor.get_files())
-      resp.body['diff'] = diff
+      session = self._get_session(req.body['session'])
+      if session.apply(req.body):
+        # Only the indexed top level dirs of roots still being indexed are
+        # diffed. The client diffs again until every root is indexed.
+        pending = self._monitor.wait_for_index(SERVER_INDEX_WAIT_SECS)
+        diff = self._monitor.diff_from(session.files, session.trees)
+        for i, indexed_dirs in pending.items():
+          diff[i] = [rel_path for rel_path in diff[i]
+              if DirMonitor.top_dir(rel_path) in indexed_dirs]
+        resp.body['pending'] = sorted(pending)
+        diff, resp.body['hash'] = self._resolve_unhashed(session.files, diff)
+        resp.body['diff'], resp.body['copies'] = self._dedup_diff(
+            session.files, diff)
+        resp.body['generation'] = session.generation
+      else:
+        self.log.info('Session [{}] is out of sync. Requesting resync.',
+            session.id)
+        resp.body['resync'] = True
     # MessageType.UPLOAD_REQUEST
     elif req.type == MessageType.UPLOAD_REQUEST:
       uploaded_files = req.body['uploaded_files']
-      self._writer.write(uploaded_files)
+      written_files, written_bytes = self._writer.write(
+          uploaded_files, stream_handler, req.body.get('copies'),
+          self._monitor.get_hash_algorithm())
       resp = Message(MessageType.UPLOAD_RESPONSE)
+      resp.body['batch'] = req.body.get('batch')
+      resp.body['written_files'] = written_files
+      resp.body['written_bytes'] = written_bytes
+    # MessageType.SIGNATURE_REQUEST
+    elif req.type == MessageType.SIGNATURE_REQUEST:
+      resp = Message(MessageType.SIGNATURE_RESPONSE)
+      resp.body['signatures'] = self._signatures(req.body['files'])
+    # MessageType.RENAME_REQUEST
+    elif req.type == MessageType.RENAME_REQUEST:
+      resp = Message(MessageType.RENAME_RESPONSE)
+      resp.body['renamed'] = self._writer.rename(
+          req.body['renames'], self._monitor.get_hash_algorithm())
+    # MessageType.STATS_REQUEST
+    elif req.type == MessageType.STATS_REQUEST:
+      resp = Message(MessageType.STATS_RESPONSE)
+      resp.body['stats'] = METRICS.snapshot()
     else:
       err = ('No idea how to handle MessageType=[{}] so '
              'aborting connection.').format(message.type_str())
       self.log.error(err)
       raise error(err)
-    self.log.info('Responding with MessageType=[{}].'.format(resp.type_str()))
+    self.log.info('Responding with MessageType=[{}].', resp.type_str())
     return resp
 
+  def _resolve_unhashed(self, src, diff):
+    '''Decides the files of [diff] only their digests can tell apart.
+
+    The server hashes its own files that were indexed lazily, at most
+    SERVER_DIFF_HASH_BYTES of them as the client waits for the response on
+    its socket timeout. Files it cannot afford to hash are uploaded. Returns
+    a tuple (diff, hashes) where hashes has one list per root dir of the
+    files the client has to hash before they can be compared.
+    '''
+    results = []
+    hashes = []
+    budget_bytes = SERVER_DIFF_HASH_BYTES
+    for i in range(len(diff)):
+      current = []
+      results.append(current)
+      unhashed = []
+      hashes.append(unhashed)
+      undecided = self._undecided(src[i], i, diff[i], current)
+      if not undecided:
+        continue
+      affordable, budget_bytes = self._affordable(i, undecided, budget_bytes)
+      current.extend(rel_path for rel_path in undecided
+          if rel_path not in affordable)
+      self._monitor.ensure_digests(i, affordable)
+      unhashed.extend(self._undecided(src[i], i, affordable, current))
+    if self._dedup != DEDUP_OFF:
+      self._hash_copy_candidates(src, results, hashes, budget_bytes)
+    if any(hashes):
+      self.log.info('Asking the client to hash [{}] files.',
+          sum(len(unhashed) for unhashed in hashes))
+    return (results, hashes)
+
+  def _undecided(self, files, dir_index, rel_paths, changed):
+    '''Appends the [rel_paths] that differ to [changed].
+
+    Returns the ones that cannot be compared without digests.
+    '''
+    undecided = []
+    entries = self._monitor.entries(dir_index, rel_paths)
+    for rel_path, entry in zip(rel_paths, entries):
+      differs = StateDiffer.differs(files[rel_path], entry)
+      if differs is None:
+        undecided.append(rel_path)
+      elif differs:
+        changed.append(rel_path)
+    return undecided
+
+  def _affordable(self, dir_index, rel_paths, budget_bytes):
+    '''Returns a tuple (rel_paths, budget_bytes) of the [rel_paths] the
+    server can hash within [budget_bytes] and what is left of it.
+
+    Files the server already has digests for cost nothing.
+    '''
+    affordable = set()
+    entries = self._monitor.entries(dir_index, rel_paths)
+    for rel_path, entry in zip(rel_paths, entries):
+      size = 0
+      if entry is not None and entry[1] is None:
+        size = StateDiffer.size(entry) or 0
+      if size <= budget_bytes:
+        budget_bytes -= size
+        affordable.add(rel_path)
+    return (affordable, budget_bytes)
+
+  def _hash_copy_candidates(self, src, diff, hashes, budget_bytes):
+    '''Moves the new files of [diff] that have no digest but the size of an
+    indexed file to [hashes], so _dedup_diff() can look their contents up.
+
+    The server hashes its own unhashed files of those sizes within
+    [budget_bytes]. Candidates of sizes it did not finish are uploaded.
+    '''
+    candidates = []
+    sizes = set()
+    for i in range(len(diff)):
+      current = {}
+      candidates.append(current)
+      entries = self._monitor.entries(i, diff[i])
+      for rel_path, entry in zip(diff[i], entries):
+        size = StateDiffer.size(src[i][rel_path])
+        if entry is None and src[i][rel_path][1] is None and size and \
+            self._monitor.has_size(size):
+          current[rel_path] = size
+          sizes.add(size)
+    if not sizes:
+      return
+    hashed_sizes = self._monitor.ensure_sized_digests(sizes, budget_bytes)
+    for i in range(len(diff)):
+      moved = set(rel_path for rel_path, size in candidates[i].items()
+          if size in hashed_sizes)
+      if moved:
+        hashes[i].extend(sorted(moved))
+        diff[i][:] = [rel_path for rel_path in diff[i]
+            if rel_path not in moved]
+
+  def _dedup_diff(self, src, diff):
+    '''Splits [diff] into the files to upload and the ones to copy locally.
+
+    Returns a tuple (uploads, copies) where copies has one dict per root dir
+    mapping rel_paths to the [src_dir_index, src_rel_path, digest] of a file
+    the server already has with the same contents.
+    '''
+    copies = [dict() for paths in diff]
+    if self._dedup == DEDUP_OFF:
+      return (diff, copies)
+    uploads = []
+    for i in range(len(diff)):
+      current = []
+      uploads.append(current)
+      for rel_path in diff[i]:
+        digest = src[i][rel_path][1]
+        found = None
+        if digest is not None:
+          found = self._monitor.find_digest(digest)
+        if found is None or found == (i, rel_path):
+          current.append(rel_path)
+        else:
+          copies[i][rel_path] = [found[0], found[1], digest]
+    if any(copies):
+      self.log.info('Found [{}] files the server already has contents for.',
+          sum(len(current) for current in copies))
+    return (uploads, copies)
+
+  def _signatures(self, files):
+    '''Returns the block signatures of the files the server already has.
+
+    Files past DELTA_MAX_SIGNED_BYTES in total are left out, since the
+    client waits for the hashing on its socket timeout.
+    '''
+    results = []
+    dirs = self._monitor.get_dirs()
+    budget_bytes = DELTA_MAX_SIGNED_BYTES
+    for i in range(len(files)):
+      current = {}
+      results.append(current)
+      for rel_path in files[i]:
+        assert not os.path.isabs(rel_path), rel_path
+        path = os.path.join(dirs[i], rel_path)
+        try:
+          size = os.path.getsize(path)
+          if DELTA_MIN_FILE_BYTES <= size <= budget_bytes:
+            current[rel_path] = DeltaCodec.signatures(path)
+            budget_bytes -= size
+        except (IOError, OSError):
+          pass
+    return results
+
 
 #########################################################
 # Local Client Classes
@@ -616,11 +3888,20 @@ class LocalClient(object):
     self.log.debug('Initializing...')
     self._args = args
     self._socket = None
+    self._uploader = None
 
   def __enter__(self):
     self.log.debug('Entering...')
-    self._monitor = DirMonitor(self._args.dirs)
+    self._monitor = DirMonitor(self._args.dirs, self._args.monitor,
+        HashPool(self._args.hash_workers, self._args.hash_pool),
+        self._args.index_dir, self._args.hash, self._args.exclude,
+        self._args.gitignore, self._args.lazy_hash)
     self._monitor.start_monitoring()
+    self._uploader = FileUploader(self._monitor,
+        compression=self._args.compression,
+        compression_level=self._args.compression_level,
+        batch_bytes=self._args.upload_batch_bytes,
+        window=self._args.upload_window)
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
@@ -639,32 +3920,74 @@ class LocalClient(object):
       except socket.timeout:
         self.log.warn('Socket timed out. Closing the connection.')
       except socket.error as exception:
-        self.log.warn('Unexpected socket exception [{}]. Closing connection.'\
-            .format(exception))
+        self.log.warn('Unexpected socket exception [{}]. Closing connection.',
+            exception)
       finally:
         self._disconnect()
       time.sleep(1.0)
 
+  def fetch_stats(self):
+    '''Returns the metrics snapshot of the remote server.'''
+    try:
+      self._connect()
+      with StreamHandler(self._args.token, self._socket) as stream_handler:
+        stream_handler.sendMessage(Message(MessageType.STATS_REQUEST))
+        return stream_handler.recvMessage().body['stats']
+    finally:
+      self._disconnect()
+
   def _connect(self):
     self._socket = create_socket(self._args.ip_version)
     self._socket.settimeout(SOCKET_TIMEOUT_SECS)
     remote = self._args.remote
     port = self._args.port
-    self.log.info('Trying to connect to [{}:{}]'.format(remote, port))
+    self.log.info('Trying to connect to [{}:{}]', remote, port)
     if self._args.ip_version == 4:
       self._socket.connect((remote, port))
     elif self._args.ip_version == 6:
       self._socket.connect((remote, port, 0, 0))
     else:
       raise Exception('Unknown IP version: [{}].'.format(ip_version))
-    self.log.info('Successfully connected to [{}:{}]'.format(remote, port))
+    self.log.info('Successfully connected to [{}:{}]', remote, port)
 
   def _process_messages(self):
     with StreamHandler(self._args.token, self._socket) as stream_handler:
-      uploader = FileUploader(self._monitor, stream_handler)
+      self._uploader.set_handler(stream_handler)
+      self._uploader.handshake()
       while True:
-        uploader.upload_files()
-        time.sleep(3.0)
+        generation = self._monitor.generation
+        written = self._uploader.upload_files()
+        # Files just written are diffed again soon so failed writes and
+        # server side changes are retried even without local changes. So are
+        # the roots the server has not indexed yet.
+        retry = written or self._uploader.server_indexing()
+        self._wait_for_changes(generation, SYNC_RETRY_SECS if retry else None)
+
+  def _wait_for_changes(self, generation, timeout_secs=None):
+    '''Returns once the dirs changed after [generation] and settled.
+
+    Pings the server while nothing changes so the connection stays open.
+    Returns early without changes if a [timeout_secs] is given and up first.
+    '''
+    deadline = None
+    if timeout_secs is not None:
+      deadline = time.time() + timeout_secs
+    while True:
+      wait_secs = KEEPALIVE_INTERVAL_SECS
+      if deadline is not None:
+        wait_secs = min(wait_secs, deadline - time.time())
+      if self._monitor.wait_for_change(generation, wait_secs):
+        break
+      if deadline is not None and time.time() >= deadline:
+        return
+      self._uploader.keepalive()
+    # Merge bursts of changes like a checkout into a single sync.
+    deadline = time.time() + SYNC_MAX_DELAY_SECS
+    while time.time() < deadline:
+      generation = self._monitor.generation
+      if not self._monitor.wait_for_change(generation,
+          min(self._args.sync_debounce_secs, deadline - time.time())):
+        break
 
   def _disconnect(self):
     if self._socket:
@@ -673,43 +3996,290 @@ class LocalClient(object):
 
 
 class FileUploader(object):
-  def __init__(self, monitor, stream_handler):
+  def __init__(self, monitor, stream_handler=None,
+      compression=None, compression_level=6, batch_bytes=16 * 1024 * 1024,
+      window=4):
     self.log = Logger(type(self).__name__)
+    self._batch_bytes = batch_bytes
+    self._window = max(1, window)
     self._monitor = monitor
     self._handler = stream_handler
+    self._wanted_compression = compression or COMPRESSION_NONE
+    self._compression = COMPRESSION_NONE
+    self._compression_level = compression_level
+    # The session survives reconnections so only deltas need to be resent.
+    self._session = binascii.hexlify(os.urandom(16))
+    self._acked_generation = None
+    # Root dirs the server skipped in the last diff as it is still indexing.
+    self._pending_roots = []
+
+  def set_handler(self, stream_handler):
+    self._handler = stream_handler
+
+  def handshake(self):
+    '''Agrees on the hash algorithm and compression with the server.'''
+    algorithm = self._monitor.get_hash_algorithm()
+    ping_request = Message(MessageType.PING_REQUEST)
+    ping_request.body['hash_algorithms'] = [algorithm] + [other \
+        for other in ContentHash.available() if other != algorithm]
+    ping_request.body['compressions'] = [self._wanted_compression]
+    self._handler.sendMessage(ping_request)
+    ping_response = self._handler.recvMessage()
+    server_algorithm = ping_response.body['hash_algorithm']
+    if not ContentHash.is_available(server_algorithm):
+      raise HumaReadbleException(
+          'ERROR: The server hashes with unsupported algorithm [{}].'.format(
+              server_algorithm))
+    self._monitor.set_hash_algorithm(server_algorithm)
+    self._compression = ping_response.body.get(
+        'compression', COMPRESSION_NONE)
+    self._log_indexing(ping_response.body.get('indexing'))
+    self.log.info('Uploads will use compression [{}].', self._compression)
 
   def upload_files(self):
+    '''Returns the number of files the server was asked to write.'''
+    # RENAME_REQUEST
+    self._rename()
     # DIFF_REQUEST
+    files, copies = self._diff()
+    uploaded = sum(len(files_per_dir) for files_per_dir in files)
+    copied = sum(len(copies_per_dir) for copies_per_dir in copies)
+    self.log.info('A total of [{}] files need to be uploaded and [{}] '
+        'copied on the server.', uploaded, copied)
+    if not uploaded and not copied:
+      return 0
+    # UPLOAD_REQUEST
+    signatures = self._signatures(files)
+    uploaded_files = self._files_to_upload(files, signatures)
+    batches = self._batches(uploaded_files)
+    if not batches:
+      batches.append([list() for files_per_dir in files])
+    # Keep up to self._window batches in flight so the link never idles
+    # waiting for an ack.
+    in_flight = collections.deque()
+    total_bytes = 0
+    for batch_index in range(len(batches)):
+      if len(in_flight) >= self._window:
+        self._recv_upload_ack(in_flight, len(batches))
+      upload_request = Message(MessageType.UPLOAD_REQUEST)
+      upload_request.body['batch'] = batch_index
+      upload_request.body['uploaded_files'] = batches[batch_index]
+      if batch_index == 0:
+        # The server copies these before writing anything uploaded.
+        upload_request.body['copies'] = copies
+      self._handler.sendMessage(upload_request)
+      total_bytes += self._send_contents(batches[batch_index], signatures)
+      in_flight.append((batch_index, time.time()))
+    while in_flight:
+      self._recv_upload_ack(in_flight, len(batches))
+    self.log.info('Streamed a total of [{}] bytes in [{}] batches.',
+        total_bytes, len(batches))
+    return uploaded + copied
+
+  def keepalive(self):
+    '''Pings the server so it does not close an idle connection.'''
+    self._handler.sendMessage(Message(MessageType.PING_REQUEST))
+    self._log_indexing(self._handler.recvMessage().body.get('indexing'))
+
+  def server_indexing(self):
+    '''Returns whether the last diff skipped roots the server is indexing.'''
+    return bool(self._pending_roots)
+
+  def _log_indexing(self, progress):
+    if progress and progress['indexed_roots'] < progress['roots']:
+      self.log.info('Server indexed [{}] of [{}] root dirs, [{}] top level '
+          'dirs of the others, and stated [{}] files so far.',
+          progress['indexed_roots'], progress['roots'],
+          progress.get('indexed_dirs', 0), progress['stated_files'])
+
+  def _batches(self, uploaded_files):
+    '''Splits [uploaded_files] into batches of at most self._batch_bytes.
+
+    Each batch has the same one list per root dir shape. A file bigger than
+    the limit gets a batch of its own.
+    '''
+    batches = []
+    batch = None
+    batch_bytes = 0
+    for dir_index in range(len(uploaded_files)):
+      for entry in uploaded_files[dir_index]:
+        size = entry[1]
+        if batch is None or (batch_bytes > 0 and
+            batch_bytes + size > self._batch_bytes) or \
+            sum(len(files) for files in batch) >= MAX_UPLOAD_BATCH_FILES:
+          batch = [list() for files in uploaded_files]
+          batches.append(batch)
+          batch_bytes = 0
+        batch[dir_index].append(entry)
+        batch_bytes += size
+    return batches
+
+  def _recv_upload_ack(self, in_flight, total_batches):
+    batch_index, sent_time = in_flight.popleft()
+    upload_response = self._handler.recvMessage()
+    METRICS.observe('upload_batch_seconds', time.time() - sent_time)
+    if upload_response.type != MessageType.UPLOAD_RESPONSE or \
+        upload_response.body.get('batch') != batch_index:
+      raise HumaReadbleException(
+          'ERROR: Expected the ack of upload batch [{}] but got [{}].'.format(
+              batch_index, upload_response))
+    self.log.info('Upload batch [{}/{}] acked after [{:.3f}] secs with [{}] '
+        'files and [{}] bytes written.', batch_index + 1, total_batches,
+        time.time() - sent_time, upload_response.body['written_files'],
+        upload_response.body['written_bytes'])
+
+  def _rename(self):
+    '''Asks the server to move the files moved since the last acked diff.'''
+    if self._acked_generation is None:
+      return
+    renames = self._monitor.moves_since(self._acked_generation)
+    if not renames or not any(renames):
+      return
+    # Files moved while unhashed are hashed so the server can check its copy.
+    unhashed = [[new for old, new, digest in moves if digest is None]
+        for moves in renames]
+    if any(unhashed):
+      for dir_index in range(len(unhashed)):
+        self._monitor.ensure_digests(dir_index, unhashed[dir_index])
+      renames = self._monitor.moves_since(self._acked_generation)
+      if not renames or not any(renames):
+        return
+    rename_request = Message(MessageType.RENAME_REQUEST)
+    rename_request.body['renames'] = renames
+    self._handler.sendMessage(rename_request)
+    rename_response = self._handler.recvMessage()
+    self.log.info('Server renamed [{}] of [{}] moved files.',
+        rename_response.body['renamed'], sum(len(moves) for moves in renames))
+
+  def _diff(self):
+    '''Sends only the changes since the last acked generation.
+
+    Returns a tuple (files, copies) with the paths to upload and the ones the
+    server can copy from contents it already has, one entry per root dir.
+    '''
     diff_request = Message(MessageType.DIFF_REQUEST)
-    diff_request.body['files'] = self._monitor.files
+    diff_request.body['session'] = self._session
+    changes = None
+    if self._acked_generation is not None:
+      generation, changes = self._monitor.changes_since(self._acked_generation)
+    if changes is None:
+      generation, files = self._monitor.snapshot()
+      diff_request.body['files'] = files
+      self.log.info('Sending full manifest for generation [{}].', generation)
+    else:
+      diff_request.body['base_generation'] = self._acked_generation
+      diff_request.body['changes'] = changes
+    diff_request.body['generation'] = generation
     self._handler.sendMessage(diff_request)
     diff_response = self._handler.recvMessage()
+    if diff_response.body.get('resync'):
+      self.log.info('Server requested a resync of session [{}].', self._session)
+      self._acked_generation = None
+      return self._diff()
+    self._acked_generation = diff_response.body['generation']
+    self._pending_roots = diff_response.body.get('pending', [])
+    if self._pending_roots:
+      self.log.info('Server is still indexing root dirs [{}].',
+          self._pending_roots)
+    hashes = diff_response.body.get('hash')
+    if hashes and any(hashes):
+      # The next diff only carries the digests the server asked for.
+      self.log.info('Hashing [{}] files the server could not compare.',
+          sum(len(rel_paths) for rel_paths in hashes))
+      for dir_index in range(len(hashes)):
+        self._monitor.ensure_digests(dir_index, hashes[dir_index])
+      return self._diff()
     files = diff_response.body['diff']
-    self.log.info('A total of [{0}] files need to be uploaded.'\
-        .format(len(files[0])))
-    # UPLOAD_REQUEST
-    upload_request = Message(MessageType.UPLOAD_REQUEST)
-    upload_request.body['uploaded_files'] = self._files_to_upload(files)
-    self._handler.sendMessage(upload_request)
-    upload_response = self._handler.recvMessage()
+    return (files, diff_response.body.get('copies', [dict() for f in files]))
+
+  def _signatures(self, files):
+    '''Fetches server block signatures for files worth a delta transfer.'''
+    dirs = self._monitor.get_dirs()
+    candidates = []
+    # The server stops signing at the same budget, against its own sizes.
+    budget_bytes = DELTA_MAX_SIGNED_BYTES
+    for dir_index in range(len(files)):
+      current = []
+      candidates.append(current)
+      for rel_path in files[dir_index]:
+        abs_path = os.path.join(dirs[dir_index], rel_path)
+        try:
+          size = os.path.getsize(abs_path)
+          if DELTA_MIN_FILE_BYTES <= size <= budget_bytes:
+            current.append(rel_path)
+            budget_bytes -= size
+        except OSError:
+          pass
+    if not any(candidates):
+      return [dict() for current in candidates]
+    signature_request = Message(MessageType.SIGNATURE_REQUEST)
+    signature_request.body['files'] = candidates
+    self._handler.sendMessage(signature_request)
+    signature_response = self._handler.recvMessage()
+    return signature_response.body['signatures']
+
+  def _files_to_upload(self, files, signatures):
+    '''Returns one list per root dir of the files to upload.
 
-  def _files_to_upload(self, files):
+    Each file is described by [rel_path, size, delta, compression, mtime].
+    '''
     results = []
     dirs = self._monitor.get_dirs()
     for dir_index in range(len(files)):
       local_root = dirs[dir_index]
       files_per_dir = files[dir_index]
-      current = {}
+      current = []
       results.append(current)
       for rel_path in files_per_dir:
         assert not os.path.isabs(rel_path), rel_path
         abs_path = os.path.join(local_root, rel_path)
-        with open(abs_path, 'r') as fp:
-          content = fp.read()
-        content = base64.b64encode(content)
-        current[rel_path] = content
+        delta = None
+        signature = signatures[dir_index].get(rel_path)
+        if signature:
+          delta = {
+            'size': signature['size'],
+            'mtime': signature['mtime'],
+            'block_size': signature['block_size'],
+          }
+        try:
+          file_stat = os.stat(abs_path)
+          compression = None
+          if StreamCompression.is_compressible(
+              abs_path, self._compression, self._compression_level):
+            compression = self._compression
+          current.append([rel_path, file_stat.st_size, delta, compression,
+              file_stat.st_mtime])
+        except (IOError, OSError):
+          self.log.warn('File [{}] disappeared before upload.', abs_path)
     return results
 
+  def _send_contents(self, uploaded_files, signatures):
+    '''Streams the contents or deltas of every file straight from disk.'''
+    dirs = self._monitor.get_dirs()
+    total_bytes = 0
+    for dir_index in range(len(uploaded_files)):
+      local_root = dirs[dir_index]
+      for entry in uploaded_files[dir_index]:
+        rel_path, size, delta, compression = entry[:4]
+        abs_path = os.path.join(local_root, rel_path)
+        try:
+          fp = open(abs_path, 'rb')
+        except IOError as exception:
+          self.log.warn('Failed to read file [{}] with [{}].', abs_path,
+              exception)
+          self._handler.sendSkip()
+          continue
+        with fp:
+          if delta is None:
+            pieces = iter(lambda: fp.read(CHUNK_SIZE_BYTES), b'')
+          else:
+            pieces = DeltaCodec.encode(fp, signatures[dir_index][rel_path])
+          if compression:
+            pieces = StreamCompression.compress(
+                pieces, compression, self._compression_level)
+          total_bytes += self._handler.sendChunks(pieces)
+    return total_bytes
+
 
 
 #########################################################
@@ -717,8 +4287,68 @@ class FileUploader(object):
 #########################################################
 SOCKET_TIMEOUT_SECS = 5.0
 BUFFER_SIZE_BYTES = 1024 * 1024
+MAX_FRAME_BYTES = 512 * 1024 * 1024
+CHUNK_SIZE_BYTES = 256 * 1024
+DELTA_MIN_FILE_BYTES = 256 * 1024
+DELTA_MIN_BLOCK_BYTES = 1024
+DELTA_MAX_BLOCK_BYTES = 128 * 1024
+DELTA_MAX_UNMATCHED_BYTES = 256 * 1024
+DELTA_MAX_SIGNED_BYTES = 256 * 1024 * 1024
+TMP_FILE_SUFFIX = '.sync_tmp'
+MAX_UPLOAD_BATCH_FILES = 4096
+COMPRESSION_NONE = 'none'
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_LZMA = 'lzma'
+COMPRESSION_SAMPLE_BYTES = 64 * 1024
+COMPRESSION_MIN_SAMPLE_BYTES = 512
+COMPRESSION_MAX_RATIO = 0.9
+MIN_JOURNAL_ENTRIES = 1024
+MAX_CLIENT_SESSIONS = 16
+DEDUP_OFF = 'off'
+DEDUP_COPY = 'copy'
+DEDUP_HARDLINK = 'hardlink'
+DURABILITY_NONE = 'none'
+DURABILITY_BATCH = 'batch'
+DURABILITY_FILE = 'file'
+DEFAULT_WRITE_WORKERS = 4
+WRITE_QUEUE_CHUNKS = 8
+PREALLOCATE_MIN_BYTES = 1024 * 1024
+MTIME_TOLERANCE_SECS = 0.001
+GITIGNORE_FILE_NAME = '.gitignore'
+GIT_DIR_NAME = '.git'
+DIR_LISTING_MIN_AGE_SECS = 2.0
+# Tells a FileWriter thread to give up on the file it is writing.
+_ABORT_WRITE = object()
+SERVER_LISTEN_BACKLOG = 16
+SERVER_IDLE_TIMEOUT_SECS = 5 * 60.0
+KEEPALIVE_INTERVAL_SECS = 60.0
+SYNC_RETRY_SECS = 3.0
+SERVER_INDEX_WAIT_SECS = 1.0
+SERVER_DIFF_HASH_BYTES = 64 * 1024 * 1024
+SYNC_MAX_DELAY_SECS = 5.0
+DEFAULT_SYNC_DEBOUNCE_SECS = 0.2
 LOG_LEVELS = ('error', 'warn', 'info', 'debug')
+LOG_QUEUE_RECORDS = 10000
+LOG_FLUSH_TIMEOUT_SECS = 5.0
+MONITOR_AUTO = 'auto'
+HASH_POOL_THREAD = 'thread'
+HASH_POOL_PROCESS = 'process'
+MAX_DEFAULT_HASH_WORKERS = 8
+HASH_AUTO = 'auto'
+HASH_MD5 = 'md5'
+DEFAULT_INDEX_DIR = os.path.join('~', '.cache', 'sync_dir_remotely')
+MIN_INDEX_JOURNAL_LINES = 4096
+MONITOR_INOTIFY = 'inotify'
+MONITOR_POLL = 'poll'
+INOTIFY_READ_TIMEOUT_SECS = 1.0
+INOTIFY_COALESCE_SECS = 0.1
+INOTIFY_MAX_BATCH_EVENTS = 64 * 1024
+FULL_CRAWL_INTERVAL_SECS = 10 * 60
+METRICS_PREFIX = 'sync_dir_remotely_'
+METRICS_LATENCY_BUCKETS_SECS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+    0.5, 1.0, 5.0, 10.0, 60.0)
 LOG = Logger('main')
+METRICS = Metrics()
 
 
 
@@ -731,10 +4361,15 @@ def main():
     with  AutoShutdown(args.shutdown_secs) as shutdown:
       args.token = read_token(args.token)
       Logger.LEVEL = args.verbosity
-      LOG.info('Mode: [{}]'.format(args.mode))
+      LOG.info('Mode: [{}]', args.mode)
+      if args.metrics_file:
+        METRICS.start_dumping(args.metrics_file, args.metrics_interval_secs)
       if args.mode == 'remote':
         with RemoteServer(args) as server:
           server.run()
+      elif args.mode == 'stats':
+        print(json.dumps(LocalClient(args).fetch_stats(),
+            indent=2, sort_keys=True))
       else:
         with LocalClient(args) as client:
           client.run()
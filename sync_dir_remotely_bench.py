@@ -0,0 +1,391 @@
+#!/usr/bin/python2.7
+#
+# Benchmarks the stages of sync_dir_remotely.py on a synthetic tree and
+# prints the results as JSON so runs can be compared.
+#
+# Usage:
+#   ./sync_dir_remotely_bench.py --files 100000 --output before.json
+#
+
+#########################################################
+# Imports
+#########################################################
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from sync_dir_remotely import *
+
+
+
+#########################################################
+# Functions
+#########################################################
+def parse_bench_args(argv=None):
+  parser = argparse.ArgumentParser(
+      description='Benchmark the stages of sync_dir_remotely.py.')
+  parser.add_argument(
+      '--files',
+      type=int,
+      default=10000,
+      help='Number of files in the synthetic tree.',
+  )
+
+  parser.add_argument(
+      '--depth',
+      type=int,
+      default=3,
+      help='Number of directory levels below the root.',
+  )
+
+  parser.add_argument(
+      '--fanout',
+      type=int,
+      default=8,
+      help='Number of subdirectories of every directory.',
+  )
+
+  parser.add_argument(
+      '--mean_file_bytes',
+      type=int,
+      default=4096,
+      help='Mean of the exponentially distributed file sizes.',
+  )
+
+  parser.add_argument(
+      '--max_file_bytes',
+      type=int,
+      default=4 * 1024 * 1024,
+      help='Files are never bigger than this.',
+  )
+
+  parser.add_argument(
+      '--changed',
+      type=int,
+      default=10,
+      help='Number of files that differ when benchmarking the diff.',
+  )
+
+  parser.add_argument(
+      '--seed',
+      type=int,
+      default=42,
+      help='Seed of the tree generator so runs are reproducible.',
+  )
+
+  parser.add_argument(
+      '--hash',
+      type=str,
+      default=HASH_MD5,
+      choices=ContentHash.available(),
+      help='Content hash algorithm.',
+  )
+
+  parser.add_argument(
+      '--hash_workers',
+      type=int,
+      default=min(MAX_DEFAULT_HASH_WORKERS, multiprocessing.cpu_count()),
+      help='Number of workers hashing file contents in parallel.',
+  )
+
+  parser.add_argument(
+      '--compression',
+      type=str,
+      default=COMPRESSION_ZLIB,
+      choices=StreamCompression.available(),
+      help='Compression of the loopback sync.',
+  )
+
+  parser.add_argument(
+      '--skip_sync',
+      action='store_true',
+      help='Do not run the loopback sync.',
+  )
+
+  parser.add_argument(
+      '--dir',
+      type=str,
+      default='',
+      help=('Dir to create the temp dir holding the tree in. Defaults to the '
+          'system temp dir.'),
+  )
+
+  parser.add_argument(
+      '--output',
+      type=str,
+      default='',
+      help='Write the JSON results to this file instead of stdout.',
+  )
+
+  parser.add_argument(
+      '-v',
+      '--verbosity',
+      type=int,
+      default=0,
+      help='Log level of sync_dir_remotely while benchmarking.',
+  )
+  return parser.parse_args(argv)
+
+
+def generate_tree(root, files, depth, fanout, mean_file_bytes, max_file_bytes,
+    seed):
+  '''Creates [files] files with random contents below [root].
+
+  The same arguments always produce the same tree. Returns the total bytes.
+  '''
+  rng = random.Random(seed)
+  # Slicing one random block is much faster than generating every byte and
+  # the unique header per file keeps contents distinct.
+  block = bytearray(rng.getrandbits(8) for i in range(BENCH_BLOCK_BYTES))
+  dirs = ['']
+  for level in range(depth):
+    dirs = [os.path.join(parent, 'd{}'.format(i))
+        for parent in dirs for i in range(fanout)]
+  total_bytes = 0
+  for index in range(files):
+    rel_dir = dirs[index % len(dirs)]
+    abs_dir = os.path.join(root, rel_dir)
+    if not os.path.isdir(abs_dir):
+      os.makedirs(abs_dir)
+    size = min(max_file_bytes, int(rng.expovariate(1.0 / mean_file_bytes)))
+    header = 'file {}\n'.format(index)
+    with open(os.path.join(abs_dir, 'f{}.bin'.format(index)), 'wb') as fp:
+      fp.write(header)
+      remaining = max(0, size - len(header))
+      while remaining > 0:
+        start = rng.randrange(len(block))
+        data = block[start:start + remaining]
+        fp.write(data)
+        remaining -= len(data)
+    total_bytes += max(size, len(header))
+  return total_bytes
+
+
+def timed(function, *args):
+  '''Returns a tuple (seconds, result) of calling [function].'''
+  start = time.time()
+  result = function(*args)
+  return (time.time() - start, result)
+
+
+def rate(count, seconds):
+  if seconds <= 0:
+    return None
+  return count / seconds
+
+
+def bench_crawl(root, args, total_bytes):
+  results = {}
+  seconds, paths = timed(DirCrawler(root).crawl)
+  results['crawl'] = {
+    'seconds': seconds,
+    'files': len(paths),
+    'files_per_sec': rate(len(paths), seconds),
+  }
+  pool = HashPool(args.hash_workers, HASH_POOL_THREAD)
+  try:
+    crawler = DirCrawler(root, hash_pool=pool, hash_algorithm=args.hash)
+    seconds, files = timed(crawler.crawl_and_hash)
+    results['crawl_and_hash_cold'] = {
+      'seconds': seconds,
+      'files': len(files),
+      'files_per_sec': rate(len(files), seconds),
+      'bytes_per_sec': rate(total_bytes, seconds),
+    }
+    seconds, files = timed(crawler.crawl_and_hash, files)
+    results['crawl_and_hash_warm'] = {
+      'seconds': seconds,
+      'files': len(files),
+      'files_per_sec': rate(len(files), seconds),
+    }
+  finally:
+    pool.close()
+  return (results, files)
+
+
+def bench_diff(files, args):
+  src = dict(files)
+  dst = dict(files)
+  rng = random.Random(args.seed)
+  for rel_path in rng.sample(sorted(dst), min(args.changed, len(dst))):
+    mtime, digest, size = dst[rel_path]
+    dst[rel_path] = (mtime, 'changed', size)
+  differ = StateDiffer()
+  results = {}
+  seconds, diff = timed(differ.diff, [src], [dst])
+  results['diff'] = {
+    'seconds': seconds,
+    'files': len(src),
+    'changed': len(diff[0]),
+    'files_per_sec': rate(len(src), seconds),
+  }
+  seconds, trees = timed(lambda: ([MerkleTree(src)], [MerkleTree(dst)]))
+  results['merkle_build'] = {
+    'seconds': seconds,
+    'files_per_sec': rate(len(src) * 2, seconds),
+  }
+  seconds, diff = timed(differ.diff, [src], [dst], trees[0], trees[1])
+  results['merkle_diff'] = {
+    'seconds': seconds,
+    'files': len(src),
+    'changed': len(diff[0]),
+  }
+  return results
+
+
+def bench_serde(files):
+  serde = MessageSerde('benchmark')
+  message = Message(MessageType.DIFF_REQUEST)
+  message.body['files'] = [files]
+  seconds, data = timed(serde.serialise, message)
+  results = {}
+  results['serialise_manifest'] = {
+    'seconds': seconds,
+    'bytes': len(data),
+    'bytes_per_sec': rate(len(data), seconds),
+  }
+  seconds, unused = timed(serde.deserialise, bytearray(data))
+  results['deserialise_manifest'] = {
+    'seconds': seconds,
+    'bytes': len(data),
+    'bytes_per_sec': rate(len(data), seconds),
+  }
+  chunk = Message(MessageType.FILE_CHUNK)
+  chunk.payload = os.urandom(CHUNK_SIZE_BYTES)
+  chunks = BENCH_CHUNKS
+
+  def roundtrip_chunks():
+    for i in range(chunks):
+      serde.deserialise(bytearray(serde.serialise(chunk)))
+  seconds, unused = timed(roundtrip_chunks)
+  results['roundtrip_chunks'] = {
+    'seconds': seconds,
+    'bytes': chunks * CHUNK_SIZE_BYTES,
+    'bytes_per_sec': rate(chunks * CHUNK_SIZE_BYTES, seconds),
+  }
+  return results
+
+
+def bench_sync(src_root, dst_root, args, total_bytes):
+  '''Uploads [src_root] into an empty [dst_root] over loopback once.
+
+  Runs the same handshake and upload_files() steps as LocalClient, without
+  its reconnect and polling loop.
+  '''
+  token = 'benchmark'
+  server_args = argparse.Namespace(dirs=[dst_root], monitor=MONITOR_POLL,
+      hash_workers=args.hash_workers, hash_pool=HASH_POOL_THREAD,
+      index_dir='', hash=args.hash, port=0, ip_version=4, token=token,
+      dedup=DEDUP_COPY, write_workers=DEFAULT_WRITE_WORKERS,
+      durability=DURABILITY_NONE, exclude=[], gitignore=False, lazy_hash=False)
+  with RemoteServer(server_args) as server:
+    thread = threading.Thread(target=server.run)
+    thread.daemon = True
+    thread.start()
+    port = server._socket.getsockname()[1]
+    pool = HashPool(args.hash_workers, HASH_POOL_THREAD)
+    monitor = DirMonitor([src_root], MONITOR_POLL, pool, '', args.hash)
+    connection = socket.create_connection(('127.0.0.1', port))
+    connection.settimeout(SOCKET_TIMEOUT_SECS)
+    with StreamHandler(token, connection) as stream_handler:
+      uploader = FileUploader(monitor, stream_handler,
+          compression=args.compression)
+      start = time.time()
+      sent_bytes = stream_handler.sent_bytes
+      uploader.handshake()
+      uploader.upload_files()
+      seconds = time.time() - start
+      # Only what the client sent, not the responses or earlier stages.
+      sent_bytes = stream_handler.sent_bytes - sent_bytes
+    pool.close()
+  synced_files = len(DirCrawler(dst_root).crawl())
+  return {
+    'sync': {
+      'seconds': seconds,
+      'files': synced_files,
+      'files_per_sec': rate(synced_files, seconds),
+      'bytes_per_sec': rate(total_bytes, seconds),
+      'bytes_on_wire': sent_bytes,
+    },
+  }
+
+
+def peak_rss_kb():
+  '''Returns the peak resident set size of this process and its children.
+
+  The sync stage runs its server in this process, so the first figure is
+  the client and the server together.
+  '''
+  usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  if sys.platform == 'darwin':
+    # Reported in bytes instead of kilobytes.
+    usage //= 1024
+    children //= 1024
+  return {'client_and_server': usage, 'children': children}
+
+
+def run(args):
+  work_dir = tempfile.mkdtemp(prefix='sync_bench_', dir=args.dir or None)
+  src_root = os.path.join(work_dir, 'src')
+  dst_root = os.path.join(work_dir, 'dst')
+  try:
+    os.makedirs(src_root)
+    os.makedirs(dst_root)
+    seconds, total_bytes = timed(generate_tree, src_root, args.files,
+        args.depth, args.fanout, args.mean_file_bytes, args.max_file_bytes,
+        args.seed)
+    results = {
+      'generate': {'seconds': seconds, 'bytes': total_bytes},
+    }
+    crawl_results, files = bench_crawl(src_root, args, total_bytes)
+    results.update(crawl_results)
+    results.update(bench_diff(files, args))
+    results.update(bench_serde(files))
+    if not args.skip_sync:
+      results.update(bench_sync(src_root, dst_root, args, total_bytes))
+    return {
+      'config': vars(args),
+      'python': sys.version.split()[0],
+      'results': results,
+      'peak_rss_kb': peak_rss_kb(),
+    }
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+
+#########################################################
+# Constants
+#########################################################
+BENCH_BLOCK_BYTES = 1024 * 1024
+BENCH_CHUNKS = 64
+
+
+
+#########################################################
+# Main
+#########################################################
+def main():
+  args = parse_bench_args()
+  Logger.LEVEL = args.verbosity
+  report = json.dumps(run(args), indent=2, sort_keys=True)
+  Logger.flush()
+  if args.output:
+    with open(args.output, 'w') as fp:
+      fp.write(report + '\n')
+  else:
+    print(report)
+
+
+if __name__ == '__main__':
+  main()
@@ -14,12 +14,19 @@
 import argparse
 import datetime
 import json
+import os
+import shutil
 import socket
+import StringIO
 import struct
+import sys
+import tempfile
+import threading
 import time
 import unittest
 
 from sync_dir_remotely import *
+import sync_dir_remotely_bench
 
 
 
@@ -32,9 +39,91 @@ from sync_dir_remotely import *
 #########################################################
 # Classes
 #########################################################
+class CountingHashPool(HashPool):
+  def __init__(self):
+    HashPool.__init__(self)
+    self.hashed = []
+
+  def hash_paths(self, abs_paths, algorithm):
+    self.hashed.extend(abs_paths)
+    return HashPool.hash_paths(self, abs_paths, algorithm)
+
+
+class CountingStreamHandler(StreamHandler):
+  def __init__(self, token, socket):
+    StreamHandler.__init__(self, token, socket)
+    self.uploads = 0
+    self.acks = 0
+    self.max_in_flight = 0
+
+  def sendMessage(self, message):
+    StreamHandler.sendMessage(self, message)
+    if message.type == MessageType.UPLOAD_REQUEST:
+      self.uploads += 1
+      self.max_in_flight = max(self.max_in_flight, self.uploads - self.acks)
+
+  def recvMessage(self, idle_timeout_secs=None):
+    message = StreamHandler.recvMessage(self, idle_timeout_secs)
+    if message.type == MessageType.UPLOAD_RESPONSE:
+      self.acks += 1
+    return message
+
+
+class LoggerTest(unittest.TestCase):
+  def setUp(self):
+    self.level = Logger.LEVEL
+    self.stdout = sys.stdout
+
+  def tearDown(self):
+    Logger.flush()
+    sys.stdout = self.stdout
+    Logger.LEVEL = self.level
+
+  def test_disabled_levels_do_not_format(self):
+    class Unformattable(object):
+      def __format__(self, spec):
+        raise AssertionError('Formatted a disabled log line.')
+    Logger.LEVEL = 2
+    Logger('test').debug('value=[{}]', Unformattable())
+
+  def test_lines_are_written_in_order_by_the_writer(self):
+    Logger.flush()
+    sys.stdout = StringIO.StringIO()
+    log = Logger('test')
+    for i in range(3):
+      log.info('line [{}] of [{}]', i, 3)
+    log.info('{} stays literal without args')
+    Logger.flush()
+    lines = sys.stdout.getvalue().splitlines()
+    self.assertEqual(4, len(lines))
+    self.assertTrue(lines[0].endswith('<test> line [0] of [3]'))
+    self.assertTrue(lines[2].endswith('<test> line [2] of [3]'))
+    self.assertTrue(lines[3].endswith('{} stays literal without args'))
+
+
+class MetricsTest(unittest.TestCase):
+  def test_snapshot_and_prometheus_text(self):
+    metrics = Metrics()
+    metrics.increment('files_hashed', 2)
+    metrics.increment('files_hashed')
+    with metrics.timer('diff_seconds'):
+      pass
+    metrics.observe('diff_seconds', 0.3)
+    snapshot = metrics.snapshot()
+    self.assertEqual({'files_hashed': 3}, snapshot['counters'])
+    histogram = snapshot['histograms']['diff_seconds']
+    self.assertEqual(2, histogram['count'])
+    self.assertEqual([0.0001, 1], histogram['buckets'][0])
+    self.assertEqual([0.5, 2], histogram['buckets'][7])
+    text = metrics.to_prometheus()
+    self.assertTrue('sync_dir_remotely_files_hashed 3\n' in text)
+    self.assertTrue(
+        'sync_dir_remotely_diff_seconds_bucket{le="+Inf"} 2\n' in text)
+
+
 class MessageSerdeTest(unittest.TestCase):
   def test_symmetry(self):
-    serde = MessageSerde()
+    serde = MessageSerde('token')
     message = Message(42)
     key = 'rui'
     value = ['will', 'it', 'work', '?']
@@ -44,6 +133,127 @@ class MessageSerdeTest(unittest.TestCase):
     self.assertEqual(0, len(unused))
     self.assertEqual(value, actual_msg.body[key])
 
+  def test_oversized_and_negative_frames_are_rejected(self):
+    serde = MessageSerde('token')
+    for body_bytes in [-1, MAX_FRAME_BYTES + 1]:
+      header = MessageSerde.HEADER.pack(42, 'x' * 32, body_bytes)
+      self.assertRaises(HumaReadbleException, serde.parse_header, header)
+      self.assertRaises(HumaReadbleException, serde.deserialise, header)
+
+
+class StreamHandlerTest(unittest.TestCase):
+  def test_send_file_streams_chunks(self):
+    local, remote = socket.socketpair()
+    # A crashed sender then fails the test instead of hanging it.
+    local.settimeout(10.0)
+    remote.settimeout(10.0)
+    contents = os.urandom(CHUNK_SIZE_BYTES * 2 + 17)
+    sender = StreamHandler('token', local)
+    receiver = StreamHandler('token', remote)
+    fp = tempfile.TemporaryFile()
+    fp.write(contents)
+    fp.seek(0)
+    thread = threading.Thread(target=sender.sendFile, args=(fp,))
+    thread.start()
+    chunks = list(receiver.recvChunks())
+    thread.join(10.0)
+    self.assertFalse(thread.is_alive())
+    fp.close()
+    self.assertEqual(3, len(chunks))
+    self.assertEqual(contents, b''.join(bytes(chunk) for chunk in chunks))
+    local.close()
+    remote.close()
+
+
+  def test_recv_message_reads_back_to_back_frames(self):
+    local, remote = socket.socketpair()
+    sender = StreamHandler('token', local)
+    receiver = StreamHandler('token', remote)
+    message = Message(MessageType.PING_REQUEST)
+    message.body['key'] = 'value'
+    sender.sendMessage(message)
+    sender.sendChunk(b'payload')
+    self.assertEqual('value', receiver.recvMessage().body['key'])
+    chunk = receiver.recvMessage()
+    self.assertEqual(MessageType.FILE_CHUNK, chunk.type)
+    self.assertEqual(bytearray(b'payload'), chunk.payload)
+    local.close()
+    self.assertRaises(socket.error, receiver.recvMessage)
+    remote.close()
+
+
+class DeltaCodecTest(unittest.TestCase):
+  def _roundtrip(self, base, target):
+    base_fp = tempfile.NamedTemporaryFile()
+    base_fp.write(base)
+    base_fp.flush()
+    signatures = DeltaCodec.signatures(base_fp.name)
+    target_fp = tempfile.TemporaryFile()
+    target_fp.write(target)
+    target_fp.seek(0)
+    records = list(DeltaCodec.encode(target_fp, signatures))
+    out_fp = tempfile.TemporaryFile()
+    DeltaCodec.apply(base_fp, signatures['block_size'], records, out_fp)
+    out_fp.seek(0)
+    self.assertEqual(target, out_fp.read())
+    return sum(len(record) for record in records)
+
+  def test_roll_matches_adler32(self):
+    data = os.urandom(100)
+    weak = DeltaCodec.weak_hash(data[0:64])
+    for i in range(1, 100 - 64):
+      weak = DeltaCodec.roll(weak, ord(data[i - 1]), ord(data[i + 63]), 64)
+      self.assertEqual(DeltaCodec.weak_hash(data[i:i + 64]), weak)
+
+  def test_edit_and_append_only_send_changed_bytes(self):
+    base = os.urandom(1024 * 1024 + 123)
+    target = base[:5000] + b'edited' + base[5006:] + b'appended'
+    delta_bytes = self._roundtrip(base, target)
+    self.assertTrue(delta_bytes < 4 * DeltaCodec.block_size(len(base)))
+
+  def test_unrelated_and_empty_files(self):
+    self._roundtrip(os.urandom(5000), os.urandom(7000))
+    self._roundtrip(b'', os.urandom(3000))
+    self._roundtrip(os.urandom(3000), b'')
+
+  def test_large_insertions_still_copy_the_rest(self):
+    base = os.urandom(4 * 1024 * 1024)
+    target = os.urandom(DELTA_MAX_UNMATCHED_BYTES + 12345) + base
+    start = time.time()
+    delta_bytes = self._roundtrip(base, target)
+    self.assertTrue(time.time() - start < 5.0)
+    self.assertTrue(delta_bytes < len(target) / 4, delta_bytes)
+
+  def test_unrelated_files_stop_rolling(self):
+    size = 8 * DELTA_MAX_UNMATCHED_BYTES
+    start = time.time()
+    delta_bytes = self._roundtrip(os.urandom(size), os.urandom(size))
+    self.assertTrue(time.time() - start < 5.0)
+    self.assertTrue(delta_bytes < size * 1.01)
+
+
+class StreamCompressionTest(unittest.TestCase):
+  def test_roundtrip(self):
+    data = b'some very compressible text\n' * 50000
+    pieces = [data[i:i + 1000] for i in range(0, len(data), 1000)]
+    for method in StreamCompression.available()[1:]:
+      compressed = list(StreamCompression.compress(pieces, method, 6))
+      self.assertTrue(sum(len(piece) for piece in compressed) < len(data) / 10)
+      output = list(StreamCompression.decompress(compressed, method))
+      self.assertEqual(data, b''.join(output))
+      self.assertTrue(max(len(piece) for piece in output) <= CHUNK_SIZE_BYTES)
+
+  def test_is_compressible_skips_random_data(self):
+    with tempfile.NamedTemporaryFile() as fp:
+      fp.write(os.urandom(COMPRESSION_SAMPLE_BYTES))
+      fp.flush()
+      self.assertFalse(StreamCompression.is_compressible(
+          fp.name, COMPRESSION_ZLIB, 6))
+    self.assertTrue(StreamCompression.is_compressible(
+        'test_data/DirCrawlerTest/TODO1.txt', COMPRESSION_ZLIB, 6))
+    self.assertFalse(StreamCompression.is_compressible(
+        'test_data/DirCrawlerTest/TODO1.txt', COMPRESSION_NONE, 6))
+
 
 class DirCrawlerTest(unittest.TestCase):
   def test_crawl_test_folder(self):
@@ -60,6 +270,190 @@ class DirCrawlerTest(unittest.TestCase):
           files[file_path][1])
 
 
+  def test_crawl_and_hash_with_worker_pools(self):
+    expected = DirCrawler('test_data/DirCrawlerTest').crawl_and_hash()
+    for kind in (HASH_POOL_THREAD, HASH_POOL_PROCESS):
+      pool = HashPool(3, kind)
+      try:
+        crawler = DirCrawler('test_data/DirCrawlerTest', hash_pool=pool)
+        self.assertEqual(expected, crawler.crawl_and_hash())
+      finally:
+        pool.close()
+
+
+  def test_persistent_index_avoids_rehashing_after_restart(self):
+    index_dir = tempfile.mkdtemp()
+    try:
+      pool = CountingHashPool()
+      crawler = DirCrawler('test_data/DirCrawlerTest', hash_pool=pool,
+          index_dir=index_dir)
+      expected = crawler.crawl_and_hash()
+      self.assertEqual(2, len(pool.hashed))
+      pool = CountingHashPool()
+      crawler = DirCrawler('test_data/DirCrawlerTest', hash_pool=pool,
+          index_dir=index_dir)
+      self.assertEqual(expected, crawler.crawl_and_hash())
+      self.assertEqual(0, len(pool.hashed))
+    finally:
+      shutil.rmtree(index_dir)
+
+
+  def test_switching_hash_algorithm_rehashes(self):
+    index_dir = tempfile.mkdtemp()
+    try:
+      crawler = DirCrawler('test_data/DirCrawlerTest', index_dir=index_dir)
+      md5s = crawler.crawl_and_hash()
+      crawler.set_hash_algorithm('sha256')
+      sha256s = crawler.crawl_and_hash(md5s)
+      for rel_path, (mtime, digest, size) in sha256s.items():
+        self.assertNotEqual(md5s[rel_path][1], digest)
+        self.assertEqual(ContentHash.DIGEST_HEX_CHARS, len(digest))
+      crawler = DirCrawler('test_data/DirCrawlerTest', index_dir=index_dir,
+          hash_algorithm=HASH_AUTO)
+      self.assertEqual('sha256', crawler.get_hash_algorithm())
+    finally:
+      shutil.rmtree(index_dir)
+
+
+  def test_unchanged_dirs_are_not_listed_again(self):
+    root = tempfile.mkdtemp()
+    try:
+      os.makedirs(os.path.join(root, 'sub'))
+      for rel_path in ('top.txt', os.path.join('sub', 'a.txt')):
+        with open(os.path.join(root, rel_path), 'w') as fp:
+          fp.write(rel_path)
+      os.symlink(os.path.join(root, 'sub'), os.path.join(root, 'link'))
+      old = time.time() - 60
+      for rel_dir in ('', 'sub'):
+        os.utime(os.path.join(root, rel_dir), (old, old))
+      crawler = DirCrawler(root)
+      listed = []
+      list_dir = crawler._list_dir
+      crawler._list_dir = lambda rel_dir: listed.append(rel_dir) or \
+          list_dir(rel_dir)
+      first = crawler.crawl_and_hash()
+      self.assertEqual(['sub/a.txt', 'top.txt'], sorted(first))
+      self.assertEqual(2, len(listed))
+      with open(os.path.join(root, 'sub', 'a.txt'), 'a') as fp:
+        fp.write(' edited')
+      with open(os.path.join(root, 'sub', 'b.txt'), 'w') as fp:
+        fp.write('b')
+      del listed[:]
+      second = crawler.crawl_and_hash(first)
+      self.assertEqual(['sub'], listed)
+      self.assertEqual(['sub/a.txt', 'sub/b.txt', 'top.txt'], sorted(second))
+      self.assertNotEqual(first['sub/a.txt'][1], second['sub/a.txt'][1])
+    finally:
+      shutil.rmtree(root)
+
+
+  def test_known_files_are_updated_in_place(self):
+    root = tempfile.mkdtemp()
+    index_dir = tempfile.mkdtemp()
+    try:
+      for name in ('a.txt', 'b.txt'):
+        with open(os.path.join(root, name), 'w') as fp:
+          fp.write(name)
+      crawler = DirCrawler(root, index_dir=index_dir)
+      files = crawler.crawl_and_hash()
+      known = crawler._known
+      inode = os.stat(os.path.join(root, 'a.txt')).st_ino
+      os.remove(os.path.join(root, 'a.txt'))
+      files = crawler.crawl_and_hash(files)
+      self.assertEqual(['b.txt'], list(files))
+      # Removed files keep their inode until the next crawl.
+      self.assertEqual(inode, crawler.inode('a.txt'))
+      crawler.crawl_and_hash(files)
+      self.assertIs(known, crawler._known)
+      self.assertEqual(None, crawler.inode('a.txt'))
+      self.assertEqual(DirCrawler.KNOWN_DIGEST_OFFSET + 16,
+          len(known['b.txt']))
+      crawler = DirCrawler(root, index_dir=index_dir)
+      self.assertEqual(['b.txt'], list(crawler._known))
+    finally:
+      shutil.rmtree(root)
+      shutil.rmtree(index_dir)
+
+
+  def test_index_skips_malformed_lines_and_stale_journals(self):
+    index_dir = tempfile.mkdtemp()
+    try:
+      index = HashIndex(index_dir, '/root')
+      index.load()
+      digest = hashlib.md5('a').hexdigest()
+      index.compact([('a.txt', ([1, 2, 3, 4], HASH_MD5, digest))])
+      index.update({'c.txt': ([1, 2, 3, 4], HASH_MD5, None)}, [])
+      index.close()
+      with open(index._journal_path, 'a') as fp:
+        for record in [{'version': HashIndex.VERSION}, ['b.txt', [1]],
+            ['b.txt', [1, 2, 3, 4], 'unknown', None]]:
+          fp.write(json.dumps(record) + '\n')
+        fp.write('["torn')
+      index = HashIndex(index_dir, '/root')
+      self.assertEqual(['a.txt', 'c.txt'], sorted(index.load()))
+      index.close()
+      with open(index._snapshot_path, 'r') as fp:
+        lines = fp.readlines()
+      with open(index._snapshot_path, 'w') as fp:
+        fp.write(json.dumps({'version': -1, 'root': '/root'}) + '\n')
+        fp.writelines(lines[1:])
+      # The journal is dropped along with the snapshot it builds on.
+      index = HashIndex(index_dir, '/root')
+      self.assertEqual({}, index.load())
+      index.close()
+      self.assertEqual(0, os.path.getsize(index._journal_path))
+    finally:
+      shutil.rmtree(index_dir)
+
+
+  def test_excluded_and_gitignored_dirs_are_never_listed(self):
+    root = tempfile.mkdtemp()
+    try:
+      files = ['keep.txt', 'node_modules/dep.js', '.git/HEAD', 'src/main.py',
+          'src/main.pyc', 'src/build/out.bin', 'src/keep.pyc', 'docs/a.md']
+      for rel_path in files:
+        if not os.path.isdir(os.path.join(root, os.path.dirname(rel_path))):
+          os.makedirs(os.path.join(root, os.path.dirname(rel_path)))
+        with open(os.path.join(root, rel_path), 'w') as fp:
+          fp.write(rel_path)
+      with open(os.path.join(root, '.gitignore'), 'w') as fp:
+        fp.write('# Comment\n*.pyc\nbuild/\n')
+      with open(os.path.join(root, 'src', '.gitignore'), 'w') as fp:
+        fp.write('!keep.pyc\n')
+      crawler = DirCrawler(root, ['node_modules/', 'docs/'], gitignore=True)
+      listed = []
+      list_dir = crawler._list_dir
+      crawler._list_dir = lambda rel_dir: listed.append(rel_dir) or \
+          list_dir(rel_dir)
+      self.assertEqual(['.gitignore', 'keep.txt', 'src/.gitignore',
+          'src/keep.pyc', 'src/main.py'], sorted(crawler.crawl()))
+      self.assertEqual(['', 'src'], sorted(listed))
+      self.assertEqual(None, crawler.hash_file('src/build/out.bin'))
+      self.assertEqual(None, crawler.hash_file('node_modules/dep.js'))
+      self.assertNotEqual(None, crawler.hash_file('src/keep.pyc'))
+    finally:
+      shutil.rmtree(root)
+
+
+class GitignoreRulesTest(unittest.TestCase):
+  def test_rules_follow_gitignore_semantics(self):
+    rules = GitignoreRules(['*.log', '!important.log', 'tmp/', '/root.txt',
+        'a/**/z', 'doc/*.md', '\\#hash', 'f[!0-9]o', ''])
+    self.assertTrue(rules.match('x/debug.log'))
+    self.assertFalse(rules.match('x/important.log'))
+    self.assertTrue(rules.match('x/tmp', is_dir=True))
+    self.assertEqual(None, rules.match('x/tmp'))
+    self.assertTrue(rules.match('root.txt'))
+    self.assertEqual(None, rules.match('x/root.txt'))
+    self.assertTrue(rules.match('a/z'))
+    self.assertTrue(rules.match('a/b/c/z'))
+    self.assertTrue(rules.match('doc/x.md'))
+    self.assertEqual(None, rules.match('doc/x/y.md'))
+    self.assertTrue(rules.match('#hash'))
+    self.assertTrue(rules.match('fao'))
+    self.assertEqual(None, rules.match('f1o'))
+
+
 class StateDifferTest(unittest.TestCase):
   def test_one_dir_one_file_no_diff(self):
     src = (
@@ -111,6 +505,702 @@ class StateDifferTest(unittest.TestCase):
     self.assertEqual(1, len(result))
     self.assertEqual(0, len(result[0]))
 
+  def test_unhashed_files_compare_by_size_and_mtime(self):
+    hashed = (1.0, 'md5', 10)
+    self.assertFalse(StateDiffer.differs(hashed, (1.0, None, 10)))
+    self.assertTrue(StateDiffer.differs(hashed, (1.0, None, 11)))
+    self.assertEqual(None, StateDiffer.differs(hashed, (2.0, None, 10)))
+    self.assertTrue(StateDiffer.differs((2.0, 'md5', 10), (1.0, 'x', 10)))
+    src = ({'same': (1.0, None, 10), 'touched': (2.0, None, 10)},)
+    dst = ({'same': hashed, 'touched': hashed},)
+    self.assertEqual([['touched']], StateDiffer().diff(src, dst))
+
+
+
+class MerkleTreeTest(unittest.TestCase):
+  def test_incremental_updates_match_a_rebuild(self):
+    files = {
+      'a.txt': (0, 'a'),
+      os.path.join('x', 'b.txt'): (0, 'b'),
+      os.path.join('x', 'y', 'c.txt'): (0, 'c'),
+    }
+    tree = MerkleTree()
+    for rel_path, entry in files.items():
+      tree.update(rel_path, None, entry)
+    self.assertEqual(MerkleTree(files).dir_hash(), tree.dir_hash())
+    c_path = os.path.join('x', 'y', 'c.txt')
+    tree.update(c_path, files[c_path], (1, 'changed'))
+    tree.update(c_path, (1, 'changed'), None)
+    del files[c_path]
+    self.assertEqual(MerkleTree(files).dir_hash(), tree.dir_hash())
+    self.assertEqual(0, tree.dir_hash(os.path.join('x', 'y')))
+    self.assertEqual(set(), tree._dirs['x'])
+
+  def test_diff_matches_state_differ(self):
+    src = {'a.txt': (0, 'a'), os.path.join('x', 'b.txt'): (0, 'b'),
+        os.path.join('z', 'c.txt'): (0, 'c')}
+    dst = {'a.txt': (5, 'a'), os.path.join('x', 'b.txt'): (0, 'old'),
+        os.path.join('w', 'd.txt'): (0, 'd')}
+    differ = StateDiffer()
+    expected = differ.diff((src,), (dst,))
+    actual = differ.diff((src,), (dst,), [MerkleTree(src)], [MerkleTree(dst)])
+    self.assertEqual(sorted(expected[0]), sorted(actual[0]))
+    self.assertEqual(
+        sorted([os.path.join('x', 'b.txt'), os.path.join('z', 'c.txt')]),
+        sorted(actual[0]))
+
+
+class FileIndexTest(unittest.TestCase):
+  def test_behaves_like_a_dict_and_a_merkle_tree(self):
+    digests = [ContentHash.hash_file(__file__, HASH_MD5),
+        ContentHash.hash_file(sync_dir_remotely_bench.__file__, HASH_MD5)]
+    files = {
+      'a.txt': (1.5, digests[0], 10),
+      os.path.join('x', 'b.txt'): (2.0, digests[1], 20),
+      os.path.join('x', 'y', 'c.txt'): (3.0, digests[0], 10),
+    }
+    index = FileIndex(files)
+    self.assertEqual(3, len(index))
+    self.assertEqual(files, dict(index.iteritems()))
+    self.assertEqual(sorted(files), sorted(index))
+    self.assertEqual((2.0, digests[1], 20), index[os.path.join('x', 'b.txt')])
+    self.assertFalse('x' in index)
+    self.assertEqual(MerkleTree(files).dir_hash('x'), index.dir_hash('x'))
+    self.assertEqual(os.path.join('x', 'b.txt'), index.find(digests[1]))
+    c_path = os.path.join('x', 'y', 'c.txt')
+    index[c_path] = (4.0, None, 30)
+    self.assertEqual((4.0, None, 30), index.pop(c_path))
+    self.assertEqual('a.txt', index.find(digests[0]))
+    self.assertEqual(None, index.pop(c_path))
+    del files[c_path]
+    self.assertEqual(files, dict(index.iteritems()))
+    self.assertEqual(MerkleTree(files).dir_hash(), index.dir_hash())
+    self.assertEqual(0, index.dir_hash(os.path.join('x', 'y')))
+    differ = StateDiffer()
+    src = dict(files)
+    src['new.txt'] = (0, digests[0], 10)
+    self.assertEqual([['new.txt']],
+        differ.diff([src], [index], [MerkleTree(src)], [index]))
+
+
+class DirMonitorTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self._write('a.txt', 'a')
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def _write(self, rel_path, contents):
+    path = os.path.join(self.root, rel_path)
+    with open(path, 'wb') as fp:
+      fp.write(contents)
+    # Make sure the mtime moves even on coarse filesystem clocks.
+    mtime = time.time() + len(contents)
+    os.utime(path, (mtime, mtime))
+
+  def test_changes_since_only_reports_the_delta(self):
+    monitor = DirMonitor([self.root])
+    generation, files = monitor.snapshot()
+    self.assertEqual(['a.txt'], list(files[0].keys()))
+    self._write('b.txt', 'bb')
+    os.remove(os.path.join(self.root, 'a.txt'))
+    monitor._crawl_all()
+    new_generation, changes = monitor.changes_since(generation)
+    self.assertEqual(generation + 1, new_generation)
+    self.assertEqual(['b.txt'], list(changes[0]['changed'].keys()))
+    self.assertEqual(['a.txt'], changes[0]['removed'])
+    _, changes = monitor.changes_since(new_generation)
+    self.assertEqual({'changed': {}, 'removed': []}, changes[0])
+
+
+  def test_wait_for_change_wakes_up_on_index_changes(self):
+    monitor = DirMonitor([self.root], MONITOR_POLL)
+    generation = monitor.generation
+    self.assertFalse(monitor.wait_for_change(generation, 0.05))
+    self._write('b.txt', 'bb')
+    timer = threading.Timer(0.05, monitor._crawl_all)
+    timer.start()
+    start = time.time()
+    self.assertTrue(monitor.wait_for_change(generation, 10.0))
+    self.assertTrue(time.time() - start < 5.0)
+    timer.join()
+
+
+  def test_lazy_hashing_only_hashes_on_demand(self):
+    pool = CountingHashPool()
+    monitor = DirMonitor([self.root], MONITOR_POLL, pool,
+        hash_algorithm=HASH_MD5, lazy_hash=True)
+    entry = monitor.get_files()[0]['a.txt']
+    self.assertEqual(None, entry[1])
+    self.assertEqual(1, entry[2])
+    self.assertEqual([], pool.hashed)
+    monitor.ensure_digests(0, ['a.txt', 'missing.txt'])
+    digest = monitor.entries(0, ['a.txt'])[0][1]
+    self.assertEqual(hashlib.md5('a').hexdigest(), digest)
+    self.assertEqual((0, 'a.txt'), monitor.find_digest(digest))
+
+
+  def test_lazy_diffs_hash_new_files_sized_like_indexed_ones(self):
+    monitor = DirMonitor([self.root], MONITOR_POLL,
+        hash_algorithm=HASH_MD5, lazy_hash=True)
+    handler = RemoteMessageHandler(monitor)
+    request = Message(MessageType.DIFF_REQUEST)
+    request.body = {'session': 's', 'generation': 1,
+        'files': [{'copy.txt': [0, None, 1], 'other.txt': [0, None, 7]}]}
+    response = handler.handle_message(request, None)
+    self.assertEqual([['copy.txt']], response.body['hash'])
+    self.assertEqual([['other.txt']], response.body['diff'])
+    digest = hashlib.md5('a').hexdigest()
+    self.assertEqual(digest, monitor.entries(0, ['a.txt'])[0][1])
+    request.body = {'session': 's', 'generation': 2, 'base_generation': 1,
+        'changes': [{'changed': {'copy.txt': [0, digest, 1]}, 'removed': []}]}
+    response = handler.handle_message(request, None)
+    self.assertEqual([[]], response.body['hash'])
+    self.assertEqual([['other.txt']], response.body['diff'])
+    self.assertEqual([{'copy.txt': [0, 'a.txt', digest]}],
+        response.body['copies'])
+
+
+  def test_lazy_diffs_upload_what_the_server_cannot_hash_in_time(self):
+    size = SERVER_DIFF_HASH_BYTES + 1
+    with open(os.path.join(self.root, 'big.bin'), 'wb') as fp:
+      fp.truncate(size)
+    monitor = DirMonitor([self.root], MONITOR_POLL,
+        hash_algorithm=HASH_MD5, lazy_hash=True)
+    handler = RemoteMessageHandler(monitor)
+    request = Message(MessageType.DIFF_REQUEST)
+    request.body = {'session': 's', 'generation': 1,
+        'files': [{'big.bin': [0, None, size], 'copy.bin': [0, None, size]}]}
+    response = handler.handle_message(request, None)
+    self.assertEqual([[]], response.body['hash'])
+    self.assertEqual(['big.bin', 'copy.bin'], sorted(response.body['diff'][0]))
+    self.assertEqual(None, monitor.entries(0, ['big.bin'])[0][1])
+
+
+  def test_lazy_diffs_skip_unchanged_dirs_of_written_files(self):
+    files = {}
+    monitor = DirMonitor([self.root], MONITOR_POLL,
+        hash_algorithm=HASH_MD5, lazy_hash=True)
+    for d in range(5):
+      os.mkdir(os.path.join(self.root, 'dir{}'.format(d)))
+      for f in range(5):
+        rel_path = os.path.join('dir{}'.format(d), '{}.txt'.format(f))
+        self._write(rel_path, rel_path)
+        path = os.path.join(self.root, rel_path)
+        file_stat = os.stat(path)
+        # Written files are indexed with their digest, unlike the client's.
+        monitor.record_written(0, rel_path, file_stat, HASH_MD5,
+            hashlib.md5(rel_path).hexdigest())
+        files[rel_path] = [file_stat.st_mtime, None, file_stat.st_size]
+    handler = RemoteMessageHandler(monitor)
+    request = Message(MessageType.DIFF_REQUEST)
+    request.body = {'session': 's', 'generation': 1, 'files': [files]}
+    differs = StateDiffer.differs
+    calls = []
+    def counting_differs(entry, other):
+      calls.append(entry)
+      return differs(entry, other)
+    StateDiffer.differs = staticmethod(counting_differs)
+    try:
+      handler.handle_message(request, None)
+      del calls[:]
+      changed_path = os.path.join('dir0', '0.txt')
+      request.body = {'session': 's', 'generation': 2, 'base_generation': 1,
+          'changes': [{'changed': {changed_path: [0, None, 1]},
+              'removed': []}]}
+      response = handler.handle_message(request, None)
+    finally:
+      StateDiffer.differs = staticmethod(differs)
+    self.assertEqual([[changed_path]], response.body['diff'])
+    # Only the files of the root and of the changed dir are compared.
+    self.assertTrue(len(calls) <= 8, len(calls))
+
+
+  def test_lazy_moves_are_detected_without_digests(self):
+    monitor = DirMonitor([self.root], MONITOR_POLL,
+        hash_algorithm=HASH_MD5, lazy_hash=True)
+    generation = monitor.generation
+    os.rename(os.path.join(self.root, 'a.txt'),
+        os.path.join(self.root, 'b.txt'))
+    monitor._crawl_all()
+    self.assertEqual([[['a.txt', 'b.txt', None]]],
+        monitor.moves_since(generation))
+    monitor.ensure_digests(0, ['b.txt'])
+    self.assertEqual([[['a.txt', 'b.txt', hashlib.md5('a').hexdigest()]]],
+        monitor.moves_since(generation))
+
+
+  def test_background_index_answers_diffs_for_indexed_roots_only(self):
+    monitor = DirMonitor([self.root], MONITOR_POLL, background_index=True)
+    handler = RemoteMessageHandler(monitor)
+    request = Message(MessageType.DIFF_REQUEST)
+    request.body = {'session': 's', 'generation': 1,
+        'files': [{'a.txt': [0, hashlib.md5('x').hexdigest(), 1],
+            'b.txt': [0, hashlib.md5('y').hexdigest(), 1]}]}
+    response = handler.handle_message(request, None)
+    self.assertEqual([0], response.body['pending'])
+    self.assertEqual([[]], response.body['diff'])
+    ping = handler.handle_message(Message(MessageType.PING_REQUEST), None)
+    self.assertEqual(0, ping.body['indexing']['indexed_roots'])
+    monitor.start_monitoring()
+    try:
+      self.assertEqual({}, monitor.wait_for_index(10.0))
+    finally:
+      monitor.stop_monitoring()
+    request.body = {'session': 's', 'generation': 2, 'base_generation': 1,
+        'changes': [{'changed': {}, 'removed': []}]}
+    response = handler.handle_message(request, None)
+    self.assertEqual([], response.body['pending'])
+    self.assertEqual([['a.txt', 'b.txt']], sorted(response.body['diff']))
+
+
+  def test_background_index_does_not_block_writers(self):
+    for rel_dir in ['a', 'b']:
+      os.mkdir(os.path.join(self.root, rel_dir))
+      self._write(os.path.join(rel_dir, 'x.txt'), rel_dir)
+    monitor = DirMonitor([self.root], MONITOR_POLL, background_index=True)
+    crawler = monitor._crawlers[0]
+    scanning = threading.Event()
+    resume = threading.Event()
+    scan_changes = crawler.scan_changes
+    def slow_scan_changes(files, rel_dir='', recursive=True):
+      if rel_dir == 'b':
+        scanning.set()
+        resume.wait(10.0)
+      return scan_changes(files, rel_dir, recursive)
+    crawler.scan_changes = slow_scan_changes
+    handler = RemoteMessageHandler(monitor)
+    monitor.start_monitoring()
+    try:
+      self.assertTrue(scanning.wait(10.0))
+      self.assertEqual({0: frozenset(['', 'a'])}, monitor.wait_for_index(0))
+      request = Message(MessageType.DIFF_REQUEST)
+      request.body = {'session': 's', 'generation': 1,
+          'files': [{'a/x.txt': [0, hashlib.md5('x').hexdigest(), 1],
+              'b/x.txt': [0, hashlib.md5('x').hexdigest(), 1]}]}
+      response = handler.handle_message(request, None)
+      self.assertEqual([0], response.body['pending'])
+      self.assertEqual([['a/x.txt']], response.body['diff'])
+      path = os.path.join(self.root, 'b', 'new.txt')
+      with open(path, 'wb') as fp:
+        fp.write('new')
+      with monitor.index_lock():
+        monitor.record_written(0, os.path.join('b', 'new.txt'),
+            os.stat(path), HASH_MD5, hashlib.md5('new').hexdigest())
+      resume.set()
+      self.assertEqual({}, monitor.wait_for_index(10.0))
+    finally:
+      resume.set()
+      monitor.stop_monitoring()
+    files = monitor.get_files()[0]
+    self.assertEqual(['a.txt', 'a/x.txt', 'b/new.txt', 'b/x.txt'],
+        sorted(files.keys()))
+    self.assertEqual(hashlib.md5('new').hexdigest(), files['b/new.txt'][1])
+
+
+  def test_find_digest_skips_stale_paths(self):
+    monitor = DirMonitor([self.root], hash_algorithm=HASH_MD5)
+    digest = monitor.get_files()[0]['a.txt'][1]
+    self.assertEqual((0, 'a.txt'), monitor.find_digest(digest))
+    os.rename(os.path.join(self.root, 'a.txt'),
+        os.path.join(self.root, 'b.txt'))
+    monitor._update_files([(0, 'a.txt', None)])
+    self.assertEqual(None, monitor.find_digest(digest))
+    monitor._crawl_all()
+    self.assertEqual((0, 'b.txt'), monitor.find_digest(digest))
+
+
+  def test_moves_are_detected_and_collapsed(self):
+    monitor = DirMonitor([self.root], MONITOR_POLL, hash_algorithm=HASH_MD5)
+    generation = monitor.generation
+    digest = monitor.get_files()[0]['a.txt'][1]
+    os.makedirs(os.path.join(self.root, 'dir'))
+    moved = os.path.join('dir', 'b.txt')
+    os.rename(os.path.join(self.root, 'a.txt'), os.path.join(self.root, moved))
+    monitor._crawl_all()
+    self.assertEqual([[['a.txt', moved, digest]]],
+        monitor.moves_since(generation))
+    os.rename(os.path.join(self.root, moved), os.path.join(self.root, 'c.txt'))
+    monitor._crawl_all()
+    self.assertEqual([[['a.txt', 'c.txt', digest]]],
+        monitor.moves_since(generation))
+    self.assertEqual([[]], monitor.moves_since(monitor.generation))
+
+
+  def _wait_for_generation(self, monitor, generation):
+    deadline = time.time() + 10.0
+    while monitor.generation <= generation and time.time() < deadline:
+      time.sleep(0.05)
+    self.assertTrue(monitor.generation > generation)
+
+  @unittest.skipUnless(InotifyWatcher.is_supported(), 'Requires inotify.')
+  def test_inotify_backend_tracks_files_and_dir_moves(self):
+    monitor = DirMonitor([self.root], MONITOR_INOTIFY).start_monitoring()
+    try:
+      # Wait for the watches to be set up.
+      while not monitor._watches:
+        time.sleep(0.05)
+      generation = monitor.generation
+      os.makedirs(os.path.join(self.root, 'dir'))
+      self._write(os.path.join('dir', 'b.txt'), 'b')
+      self._wait_for_generation(monitor, generation)
+      while os.path.join('dir', 'b.txt') not in monitor.get_files()[0]:
+        time.sleep(0.05)
+      generation = monitor.generation
+      os.rename(os.path.join(self.root, 'dir'),
+          os.path.join(self.root, 'moved'))
+      self._wait_for_generation(monitor, generation)
+      while os.path.join('dir', 'b.txt') in monitor.get_files()[0]:
+        time.sleep(0.05)
+      self.assertEqual(
+          sorted(['a.txt', os.path.join('moved', 'b.txt')]),
+          sorted(monitor.get_files()[0].keys()))
+    finally:
+      monitor.stop_monitoring()
+
+  def test_inotify_fallback_crawl_watches_new_dirs(self):
+    monitor = DirMonitor([self.root], MONITOR_INOTIFY)
+    apply_events = monitor._apply_events
+    def overflow(watcher, events):
+      monitor._apply_events = apply_events
+      return False
+    monitor._apply_events = overflow
+    monitor.start_monitoring()
+    try:
+      while not monitor._watches:
+        time.sleep(0.05)
+      os.makedirs(os.path.join(self.root, 'dir'))
+      self._write(os.path.join('dir', 'b.txt'), 'b')
+      while os.path.join('dir', 'b.txt') not in monitor.get_files()[0]:
+        time.sleep(0.05)
+      # The first crawl may have indexed the file before the overflow.
+      deadline = time.time() + 5.0
+      while (0, 'dir') not in monitor._watches.values() and \
+          time.time() < deadline:
+        time.sleep(0.05)
+      self.assertTrue((0, 'dir') in monitor._watches.values())
+    finally:
+      monitor.stop_monitoring()
+
+
+class FileWriterTest(unittest.TestCase):
+  def setUp(self):
+    self.roots = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    with open(os.path.join(self.roots[0], 'a.txt'), 'w') as fp:
+      fp.write('contents')
+    self.digest = ContentHash.hash_file(
+        os.path.join(self.roots[0], 'a.txt'), HASH_MD5)
+
+  def tearDown(self):
+    for root in self.roots:
+      shutil.rmtree(root)
+
+  def _stream(self, payloads, complete=True):
+    '''Returns a StreamHandler that receives one file per payload.'''
+    local, remote = socket.socketpair()
+    sender = StreamHandler('token', local)
+    for payload in payloads:
+      sender.sendChunks([payload])
+    if not complete:
+      sender.sendChunk(b'partial')
+    local.close()
+    return StreamHandler('token', remote)
+
+  def test_written_files_are_indexed_without_rehashing(self):
+    pool = CountingHashPool()
+    monitor = DirMonitor(self.roots, MONITOR_POLL, pool, None, HASH_MD5)
+    writer = FileWriter(self.roots, monitor=monitor)
+    generation = monitor.generation
+    self.assertEqual((1, 8), writer.write([[], [['b.txt', 8, None, None]]],
+        self._stream([b'uploaded']), algorithm=HASH_MD5))
+    path = os.path.join(self.roots[1], 'b.txt')
+    self.assertEqual(generation + 1, monitor.generation)
+    self.assertEqual(ContentHash.hash_file(path, HASH_MD5),
+        monitor.get_files()[1]['b.txt'][1])
+    del pool.hashed[:]
+    monitor._crawl_all()
+    self.assertEqual([], pool.hashed)
+    self.assertEqual(generation + 1, monitor.generation)
+
+  def test_batches_are_renamed_into_place_only_when_complete(self):
+    writer = FileWriter(self.roots, workers=2, durability=DURABILITY_FILE)
+    files = [[['b.txt', 1, None, None], ['c.txt', 1, None, None]],
+        [['d.txt', 1, None, None]]]
+    self.assertRaises(socket.error, writer.write, files,
+        self._stream([b'b', b'c'], complete=False))
+    self.assertEqual(['a.txt'], os.listdir(self.roots[0]))
+    self.assertEqual([], os.listdir(self.roots[1]))
+    self.assertEqual((3, 3), writer.write(files,
+        self._stream([b'b', b'c', b'd'])))
+    with open(os.path.join(self.roots[1], 'd.txt')) as fp:
+      self.assertEqual('d', fp.read())
+    self.assertEqual(['a.txt', 'b.txt', 'c.txt'],
+        sorted(os.listdir(self.roots[0])))
+
+  def test_parallel_writers_share_new_dirs(self):
+    writer = FileWriter(self.roots, workers=8)
+    for attempt in range(30):
+      rel_dir = os.path.join('new{}'.format(attempt), 'b', 'c', 'd')
+      files = [[os.path.join(rel_dir, '{}.txt'.format(i)), 1, None, None]
+          for i in range(8)]
+      self.assertEqual((8, 8), writer.write([[], files],
+          self._stream([b'x'] * 8)))
+      self.assertEqual(8, len(os.listdir(os.path.join(self.roots[1], rel_dir))))
+
+  def test_renames_move_files_the_server_has(self):
+    monitor = DirMonitor(self.roots, MONITOR_POLL, None, None, HASH_MD5)
+    writer = FileWriter(self.roots, monitor=monitor)
+    moved = os.path.join('dir', 'b.txt')
+    self.assertEqual(1, writer.write(
+        [[[os.path.join('sub', 'a.txt'), 1, None, None]], []],
+        self._stream([b'a']))[0])
+    self.assertEqual(1, writer.rename([[
+      [os.path.join('sub', 'a.txt'), moved, monitor.get_files()[0][
+          os.path.join('sub', 'a.txt')][1]],
+      ['a.txt', 'c.txt', 'stale'],
+    ], []], HASH_MD5))
+    self.assertEqual(['a.txt', 'dir'], sorted(os.listdir(self.roots[0])))
+    self.assertEqual(['a.txt', moved], sorted(monitor.get_files()[0].keys()))
+
+  def test_renames_emptying_a_dir_remove_it(self):
+    monitor = DirMonitor(self.roots, MONITOR_POLL, None, None, HASH_MD5)
+    writer = FileWriter(self.roots, monitor=monitor)
+    sub_paths = [os.path.join('sub', 'a.txt'), os.path.join('sub', 'b.txt')]
+    self.assertEqual(2, writer.write(
+        [[[rel_path, 1, None, None] for rel_path in sub_paths], []],
+        self._stream([b'a', b'b']))[0])
+    files = monitor.get_files()[0]
+    self.assertEqual(2, writer.rename([[
+      [sub_paths[0], 'a2.txt', files[sub_paths[0]][1]],
+      [sub_paths[1], 'b2.txt', files[sub_paths[1]][1]],
+    ], []], HASH_MD5))
+    self.assertEqual(['a.txt', 'a2.txt', 'b2.txt'],
+        sorted(os.listdir(self.roots[0])))
+
+  def test_copies_verify_the_source_digest(self):
+    writer = FileWriter(self.roots)
+    copies = [{}, {
+      os.path.join('sub', 'b.txt'): [0, 'a.txt', self.digest],
+      'c.txt': [0, 'a.txt', 'stale'],
+    }]
+    self.assertEqual((1, 8), writer.write([[], []], None, copies, HASH_MD5))
+    with open(os.path.join(self.roots[1], 'sub', 'b.txt')) as fp:
+      self.assertEqual('contents', fp.read())
+    self.assertEqual(['sub'], os.listdir(self.roots[1]))
+
+  def test_hardlinks_are_broken_before_writing(self):
+    writer = FileWriter(self.roots, DEDUP_HARDLINK)
+    copies = [{'b.txt': [0, 'a.txt', self.digest]}, {}]
+    self.assertEqual((1, 0), writer.write([[], []], None, copies, HASH_MD5))
+    path = os.path.join(self.roots[0], 'b.txt')
+    self.assertEqual(2, os.stat(path).st_nlink)
+    writer.write([[['b.txt', 3, None, None]], []], self._stream([b'new']))
+    with open(os.path.join(self.roots[0], 'a.txt')) as fp:
+      self.assertEqual('contents', fp.read())
+
+
+class ClientSessionTest(unittest.TestCase):
+  def test_apply_full_then_delta(self):
+    session = ClientSession('s')
+    self.assertTrue(session.apply({
+        'generation': 1,
+        'files': [{'a': [0, 'x'], 'b': [0, 'y']}],
+    }))
+    self.assertTrue(session.apply({
+        'generation': 2,
+        'base_generation': 1,
+        'changes': [{'changed': {'c': [1, 'z']}, 'removed': ['a']}],
+    }))
+    self.assertEqual(2, session.generation)
+    self.assertEqual({'b': [0, 'y'], 'c': [1, 'z']}, session.files[0])
+    self.assertEqual(MerkleTree(session.files[0]).dir_hash(),
+        session.trees[0].dir_hash())
+
+  def test_apply_delta_against_unknown_generation_needs_resync(self):
+    session = ClientSession('s')
+    self.assertFalse(session.apply({
+        'generation': 3,
+        'base_generation': 2,
+        'changes': [{'changed': {}, 'removed': []}],
+    }))
+    session.apply({'generation': 1, 'files': [{}]})
+    self.assertFalse(session.apply({
+        'generation': 3,
+        'base_generation': 2,
+        'changes': [{'changed': {}, 'removed': []}],
+    }))
+
+
+
+class RemoteServerTest(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    with open(os.path.join(self.root, 'a.txt'), 'w') as fp:
+      fp.write('a')
+    args = argparse.Namespace(dirs=[self.root], monitor=MONITOR_POLL,
+        hash_workers=1, hash_pool=HASH_POOL_THREAD, index_dir='',
+        hash=HASH_MD5, port=0, ip_version=4, token='token',
+        dedup=DEDUP_COPY, write_workers=1, durability=DURABILITY_NONE,
+        exclude=[], gitignore=False, lazy_hash=False)
+    self.server = RemoteServer(args).__enter__()
+    self.thread = threading.Thread(target=self.server.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def tearDown(self):
+    self.server.__exit__(None, None, None)
+    self.thread.join(SOCKET_TIMEOUT_SECS)
+    shutil.rmtree(self.root)
+
+  def connect(self):
+    port = self.server._socket.getsockname()[1]
+    return socket.create_connection(('127.0.0.1', port))
+
+  def test_idle_client_does_not_block_others(self):
+    idle = self.connect()
+    busy = self.connect()
+    handler = StreamHandler('token', busy)
+    handler.sendMessage(Message(MessageType.PING_REQUEST))
+    self.assertEqual(MessageType.PING_RESPONSE, handler.recvMessage().type)
+    busy.close()
+    idle.close()
+
+
+  def test_stats_report_server_metrics(self):
+    handler = StreamHandler('token', self.connect())
+    handler.sendMessage(Message(MessageType.STATS_REQUEST))
+    response = handler.recvMessage()
+    self.assertEqual(MessageType.STATS_RESPONSE, response.type)
+    self.assertTrue(response.body['stats']['counters']['bytes_received'] > 0)
+    handler.__exit__(None, None, None)
+
+  def test_uploads_keep_a_window_of_batches_in_flight(self):
+    src = tempfile.mkdtemp()
+    try:
+      for i in range(7):
+        with open(os.path.join(src, 'f{}.txt'.format(i)), 'wb') as fp:
+          fp.write('contents {}'.format(i) * (i + 1))
+      connection = self.connect()
+      connection.settimeout(10.0)
+      handler = CountingStreamHandler('token', connection)
+      uploader = FileUploader(DirMonitor([src], MONITOR_POLL), handler,
+          batch_bytes=1, window=2)
+      uploader.handshake()
+      self.assertEqual(7, uploader.upload_files())
+      self.assertEqual(7, handler.uploads)
+      self.assertEqual(2, handler.max_in_flight)
+      self.assertEqual(handler.uploads, handler.acks)
+      for i in range(7):
+        with open(os.path.join(self.root, 'f{}.txt'.format(i)), 'rb') as fp:
+          self.assertEqual('contents {}'.format(i) * (i + 1), fp.read())
+      # Nothing is left to upload once every ack arrived.
+      self.assertEqual(0, uploader.upload_files())
+      handler.__exit__(None, None, None)
+    finally:
+      shutil.rmtree(src)
+
+  def sync(self, src):
+    '''Uploads [src] with compression, returning the bytes sent.'''
+    connection = self.connect()
+    connection.settimeout(10.0)
+    handler = CountingStreamHandler('token', connection)
+    uploader = FileUploader(DirMonitor([src], MONITOR_POLL), handler,
+        compression=COMPRESSION_ZLIB)
+    uploader.handshake()
+    self.assertEqual(1, uploader.upload_files())
+    handler.__exit__(None, None, None)
+    return handler.sent_bytes
+
+  def test_edited_files_are_patched_with_compressed_deltas(self):
+    src = tempfile.mkdtemp()
+    try:
+      abs_path = os.path.join(src, 'a.txt')
+      lines = ''.join('line {:08d} of the file\n'.format(i)
+          for i in range(100000))
+      with open(abs_path, 'wb') as fp:
+        fp.write(lines)
+      full_bytes = self.sync(src)
+      edit = ''.join('edited {:08d}\n'.format(i) for i in range(8000))
+      middle = len(lines) // 2
+      edited = lines[:middle] + edit + lines[middle + len(edit):]
+      with open(abs_path, 'wb') as fp:
+        fp.write(edited)
+      delta_bytes = self.sync(src)
+      with open(os.path.join(self.root, 'a.txt'), 'rb') as fp:
+        self.assertEqual(edited, fp.read())
+      # Less than the edit alone, so the delta was compressed too.
+      self.assertTrue(delta_bytes < len(edit), delta_bytes)
+      self.assertTrue(delta_bytes < full_bytes, (delta_bytes, full_bytes))
+    finally:
+      shutil.rmtree(src)
+
+
+class FileUploaderTest(unittest.TestCase):
+  def test_batches_are_capped_by_bytes(self):
+    uploader = FileUploader(None, batch_bytes=100)
+    uploaded_files = [
+      [['a', 60, None, None], ['b', 60, None, None], ['c', 500, None, None]],
+      [['d', 10, None, None]],
+    ]
+    batches = uploader._batches(uploaded_files)
+    self.assertEqual([
+      [[['a', 60, None, None]], []],
+      [[['b', 60, None, None]], []],
+      [[['c', 500, None, None]], []],
+      [[], [['d', 10, None, None]]],
+    ], batches)
+
+  def test_files_that_vanish_before_the_upload_are_skipped(self):
+    src, dst = tempfile.mkdtemp(), tempfile.mkdtemp()
+    try:
+      for root, contents in [(src, 'new'), (dst, 'old')]:
+        for name in ['a.txt', 'b.txt']:
+          with open(os.path.join(root, name), 'wb') as fp:
+            fp.write(contents)
+      local, remote = socket.socketpair()
+      local.settimeout(10.0)
+      remote.settimeout(10.0)
+      uploader = FileUploader(DirMonitor([src], MONITOR_POLL),
+          StreamHandler('token', local))
+      uploaded_files = uploader._files_to_upload([['a.txt', 'b.txt']], [{}])
+      # Deleted between the DIFF and the UPLOAD.
+      os.remove(os.path.join(src, 'a.txt'))
+      thread = threading.Thread(target=uploader._send_contents,
+          args=(uploaded_files, [{}]))
+      thread.start()
+      writer = FileWriter([dst])
+      self.assertEqual((1, 3), writer.write(
+          uploaded_files, StreamHandler('token', remote)))
+      thread.join(10.0)
+      self.assertFalse(thread.is_alive())
+      for name in ['a.txt', 'b.txt']:
+        with open(os.path.join(dst, name), 'rb') as fp:
+          self.assertEqual('old' if name == 'a.txt' else 'new', fp.read())
+      self.assertEqual(['a.txt', 'b.txt'], sorted(os.listdir(dst)))
+      local.close()
+      remote.close()
+    finally:
+      shutil.rmtree(src)
+      shutil.rmtree(dst)
+
+
+
+class BenchmarkTest(unittest.TestCase):
+  def test_tiny_run_reports_every_stage(self):
+    args = sync_dir_remotely_bench.parse_bench_args(
+        ['--files', '20', '--depth', '2', '--fanout', '2', '--changed', '3'])
+    report = sync_dir_remotely_bench.run(args)
+    results = report['results']
+    self.assertEqual(20, results['crawl_and_hash_cold']['files'])
+    self.assertEqual(3, results['diff']['changed'])
+    self.assertEqual(3, results['merkle_diff']['changed'])
+    self.assertEqual(20, results['sync']['files'])
+    sync = results['sync']
+    self.assertTrue(0 < sync['bytes_on_wire'] <
+        2 * results['generate']['bytes'], sync)
+    self.assertTrue(report['peak_rss_kb']['client_and_server'] > 0)
+
 
 
 #########################################################